@@ -14,7 +14,7 @@ install_requires = [
     'nipype>=1.1.7',
     'pydicom>=1.0.2',
     'networkx>=2.2',
-    'fasteners>=0.7.0',
+    'fasteners>=0.15',
     'future>=0.16.0',
     'pybids>=0.5.1',
     'contextlib2>=0.5.5',
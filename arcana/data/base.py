@@ -18,6 +18,10 @@ class BaseData(object, metaclass=ABCMeta):
     is_fileset = False
     is_field = False
 
+    # Slots are defined so that the items in large trees don't need a
+    # per-instance __dict__ (subclasses that don't define slots still get one)
+    __slots__ = ('_name', '_frequency')
+
     def __init__(self, name, frequency='per_session'):
         assert name is None or isinstance(name, basestring)
         if frequency not in self.VALID_FREQUENCIES:
@@ -103,6 +107,8 @@ class BaseFileset(BaseData, metaclass=ABCMeta):
 
     is_fileset = True
 
+    __slots__ = ('_format',)
+
     def __init__(self, name, format=None, frequency='per_session'):
         super(BaseFileset, self).__init__(name=name, frequency=frequency)
         assert format is None or isinstance(format, FileFormat)
@@ -171,6 +177,8 @@ class BaseField(BaseData, metaclass=ABCMeta):
 
     dtypes = (int, float, str)
 
+    __slots__ = ('_dtype', '_array')
+
     def __init__(self, name, dtype, frequency, array=False):
         super(BaseField, self).__init__(name, frequency)
         if dtype not in self.dtypes + (newstr, None):
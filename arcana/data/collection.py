@@ -1,4 +1,6 @@
 from copy import copy
+from logging import getLogger
+import numpy as np
 from arcana.exceptions import (
     ArcanaError, ArcanaUsageError, ArcanaIndexError)
 from .base import BaseFileset, BaseField
@@ -6,6 +8,10 @@ from .item import Fileset, Field
 from collections import OrderedDict
 from operator import itemgetter
 from itertools import chain
+from arcana.utils.hashing import digest_algorithm
+
+
+logger = getLogger('arcana')
 
 
 DICOM_SERIES_NUMBER_TAG = ('0020', '0011')
@@ -24,6 +30,9 @@ class BaseCollectionMixin(object):
 
     def __init__(self, collection, frequency):
         self._frequency = frequency
+        # Cache of the array indices of the items for the subject/visit
+        # indices they have been requested for (see array_indices)
+        self._array_cache = {}
         if frequency == 'per_study':
             # If wrapped in an iterable
             if not isinstance(collection, self.CollectedClass):
@@ -161,6 +170,149 @@ class BaseCollectionMixin(object):
                         "per_study node").format(self.name))
         return fileset
 
+    def array_indices(self, subject_inds, visit_inds):
+        """
+        Returns the row and column indices of the items in the collection
+        (in iteration order) in a 2-D subject x visit array. Items that don't
+        have a subject and/or visit ID (i.e. frequency != 'per_session') are
+        placed in the first row/column, as they are dialated over the whole
+        row/column by the processor
+
+        Parameters
+        ----------
+        subject_inds : dict[str, int]
+            Mapping from subject ID to row index
+        visit_inds : dict[str, int]
+            Mapping from visit ID to column index
+
+        Returns
+        -------
+        rows : numpy.array[int]
+            The row indices of the items
+        cols : numpy.array[int]
+            The column indices of the items
+        """
+        key = (tuple(subject_inds.items()), tuple(visit_inds.items()))
+        try:
+            return self._array_cache[key]
+        except KeyError:
+            pass
+        inds = [(subject_inds.get(i.subject_id, 0),
+                 visit_inds.get(i.visit_id, 0)) for i in self]
+        rows = np.array([i[0] for i in inds], dtype=int)
+        cols = np.array([i[1] for i in inds], dtype=int)
+        self._array_cache[key] = rows, cols
+        return rows, cols
+
+    @property
+    def exists_mask(self):
+        """
+        A boolean array marking the items of the collection (in iteration
+        order) that exist in the repository. Not cached as items can be
+        provided after the collection is created
+        """
+        return np.fromiter((i.exists for i in self), dtype=bool,
+                           count=len(self))
+
+    @property
+    def altered_mask(self):
+        """
+        A boolean array marking the items of the collection (in iteration
+        order) that exist but whose checksums don't match those recorded in
+        the provenance when they were derived, i.e. have been altered outside
+        of Arcana
+        """
+        mask = np.zeros(len(self), dtype=bool)
+        for i, (item, exists) in enumerate(zip(self, self.exists_mask)):
+            if not exists:
+                continue
+            recorded = item.recorded_checksums
+            if item.checksums_for(digest_algorithm(recorded)) != recorded:
+                logger.warning(
+                    "Checksums for {} do not match those recorded in "
+                    "provenance. Assuming it has been manually "
+                    "corrected outside of Arcana and will therefore "
+                    "not overwrite. Please delete manually if this "
+                    "is not intended".format(repr(item)))
+                mask[i] = True
+        return mask
+
+    def as_array(self, mask, subject_inds, visit_inds):
+        """
+        Places a boolean mask over the items of the collection into a 2-D
+        subject x visit array (see array_indices)
+
+        Parameters
+        ----------
+        mask : numpy.array[bool]
+            A boolean array over the items in iteration order
+        subject_inds : dict[str, int]
+            Mapping from subject ID to row index
+        visit_inds : dict[str, int]
+            Mapping from visit ID to column index
+
+        Returns
+        -------
+        array : 2-D numpy.array[bool]
+            The array with the locations of the masked items marked True
+        """
+        rows, cols = self.array_indices(subject_inds, visit_inds)
+        array = np.zeros((len(subject_inds), len(visit_inds)), dtype=bool)
+        array[rows[mask], cols[mask]] = True
+        return array
+
+    def presence_arrays(self, subject_inds, visit_inds):
+        """
+        Returns 2-D subject x visit arrays marking the locations of the items
+        of the collection that exist, are missing and have been altered
+        outside of Arcana respectively
+
+        Parameters
+        ----------
+        subject_inds : dict[str, int]
+            Mapping from subject ID to row index
+        visit_inds : dict[str, int]
+            Mapping from visit ID to column index
+
+        Returns
+        -------
+        exists : 2-D numpy.array[bool]
+            The locations of the items that exist in the repository
+        missing : 2-D numpy.array[bool]
+            The locations of the items that are missing from the repository
+        altered : 2-D numpy.array[bool]
+            The locations of the items whose checksums don't match those
+            recorded in the provenance
+        """
+        exists = self.exists_mask
+        altered = self.altered_mask
+        return (self.as_array(exists, subject_inds, visit_inds),
+                self.as_array(~exists, subject_inds, visit_inds),
+                self.as_array(altered, subject_inds, visit_inds))
+
+    def masked_items(self, mask, subject_inds, visit_inds):
+        """
+        Returns the items selected by a mask along with their array indices
+        (see array_indices)
+
+        Parameters
+        ----------
+        mask : numpy.array[bool]
+            A boolean array over the items in iteration order
+        subject_inds : dict[str, int]
+            Mapping from subject ID to row index
+        visit_inds : dict[str, int]
+            Mapping from visit ID to column index
+
+        Returns
+        -------
+        items : list[tuple[tuple[int, int], Fileset | Field]]
+            The array indices and items selected by the mask
+        """
+        rows, cols = self.array_indices(subject_inds, visit_inds)
+        items = list(self)
+        return [((rows[i], cols[i]), items[i]) for i in mask.nonzero()[0]]
+
     @property
     def collection(self):
         "Used for duck typing Collection objects with Spec and Match "
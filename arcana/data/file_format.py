@@ -44,11 +44,17 @@ class FileFormat(object):
         A dictionary mapping the name of a repository type to a list of
         alternate names to use to load the file format with (when the format is
         saved by format name, e.g. XNAT, instead of a file with an extension)
+    checksum_algorithm : str | None
+        The algorithm used to calculate the checksums of filesets of this
+        format (e.g. 'fingerprint' for large files where full hashes are too
+        expensive or 'merkle-md5' for directories containing many files). If
+        None the algorithm of the repository is used
     """
 
     def __init__(self, name, extension=None, desc='',
                  directory=False, within_dir_exts=None,
-                 aux_files=None, resource_names=None):
+                 aux_files=None, resource_names=None,
+                 checksum_algorithm=None):
         if not name.islower():
             raise ArcanaUsageError(
                 "All data format names must be lower case ('{}')"
@@ -72,6 +78,7 @@ class FileFormat(object):
         self._resource_names = (resource_names
                                 if resource_names is not None else {})
         self._aux_files = aux_files if aux_files is not None else {}
+        self._checksum_algorithm = checksum_algorithm
         for sc_name, sc_ext in self.aux_files.items():
             if sc_ext == self.ext:
                 raise ArcanaUsageError(
@@ -88,7 +95,8 @@ class FileFormat(object):
                 and self._within_dir_exts ==
                 other._within_dir_exts
                 and self._resource_names == other._resource_names
-                and self.aux_files == other.aux_files)
+                and self.aux_files == other.aux_files
+                and self._checksum_algorithm == other._checksum_algorithm)
         except AttributeError:
             return False
 
@@ -124,6 +132,10 @@ class FileFormat(object):
     def extension(self):
         return self._extension
 
+    @property
+    def checksum_algorithm(self):
+        return self._checksum_algorithm
+
     @property
     def extensions(self):
         return tuple([self._extension] + sorted(self.aux_file_exts))
@@ -22,6 +22,11 @@ class BaseInputMixin(object):
                  study_=None, collection_=None):
         self._pattern = pattern
         self._is_regex = is_regex
+        # The compiled pattern and whether it matches each of the names it
+        # has been tested against, so that regular expressions are only
+        # evaluated once per distinct name in the tree
+        self._pattern_re = None
+        self._name_matches = {}
         self._order = order
         self._from_study = from_study
         self._repository = repository
@@ -77,6 +82,31 @@ class BaseInputMixin(object):
     def pattern(self):
         return self._pattern
 
+    def _matching_names(self, names):
+        """
+        Returns the names that match the pattern of the input
+
+        Parameters
+        ----------
+        names : collection[str]
+            The distinct names of the items in a tree node (supporting O(1)
+            membership tests)
+        """
+        if not self.is_regex:
+            return [self.pattern] if self.pattern in names else []
+        if self._pattern_re is None:
+            self._pattern_re = re.compile(self.pattern)
+        matching = []
+        for name in names:
+            try:
+                is_match = self._name_matches[name]
+            except KeyError:
+                is_match = self._name_matches[name] = bool(
+                    self._pattern_re.match(name))
+            if is_match:
+                matching.append(name)
+        return matching
+
     @property
     def spec_name(self):
         return self.name
@@ -449,13 +479,14 @@ class InputFilesets(BaseInputMixin, BaseFileset):
 
     def _filtered_matches(self, node, valid_formats=None, **kwargs):  # noqa: E501 @UnusedVariable
         if self.pattern is not None:
-            if self.is_regex:
-                pattern_re = re.compile(self.pattern)
-                matches = [f for f in node.filesets
-                           if pattern_re.match(f.basename)]
+            names = self._matching_names(node.fileset_names)
+            if len(names) == 1:
+                matches = list(node.filesets_named(names[0]))
             else:
-                matches = [f for f in node.filesets
-                           if f.basename == self.pattern]
+                # Keep the filesets in node order (i.e. order of acquisition)
+                # when multiple names match so 'order' selects the same scan
+                names = frozenset(names)
+                matches = [f for f in node.filesets if f.basename in names]
         else:
             matches = list(node.filesets)
         if not matches:
@@ -626,13 +657,13 @@ class InputFields(BaseInputMixin, BaseField):
         return dct
 
     def _filtered_matches(self, node, **kwargs):
-        if self.is_regex:
-            pattern_re = re.compile(self.pattern)
-            matches = [f for f in node.fields
-                       if pattern_re.match(f.name)]
+        names = self._matching_names(node.field_names)
+        if len(names) == 1:
+            matches = list(node.fields_named(names[0]))
         else:
-            matches = [f for f in node.fields
-                       if f.name == self.pattern]
+            # Keep the fields in node order when multiple names match
+            names = frozenset(names)
+            matches = [f for f in node.fields if f.name in names]
         if self.from_study is not None:
             matches = [f for f in matches
                        if f.from_study == self.from_study]
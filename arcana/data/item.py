@@ -2,8 +2,10 @@ from past.builtins import basestring
 import os
 from itertools import chain
 import os.path as op
-import hashlib
-from arcana.utils import split_extension, parse_value
+from arcana.utils import (
+    split_extension, parse_value, hash_files, intern_id)
+from arcana.utils.hashing import (
+    DEFAULT_HASH_ALGORITHM, leaf_algorithm, combine_checksums)
 from arcana.exceptions import (
     ArcanaError, ArcanaFileFormatError, ArcanaUsageError, ArcanaNameError,
     ArcanaDataNotDerivedYetError)
@@ -15,10 +17,17 @@ class BaseItemMixin(object):
 
     is_spec = False
 
+    # The slots of the mixin are added to the slots of the concrete item
+    # classes, as they can't be defined in both of their bases
+    __slots__ = ()
+    ITEM_SLOTS = ('_subject_id', '_visit_id', '_repository', '_from_study',
+                  '_exists', '_record')
+
     def __init__(self, subject_id, visit_id, repository, from_study,
                  exists, record):
-        self._subject_id = subject_id
-        self._visit_id = visit_id
+        # IDs are interned as they are repeated across all items in the tree
+        self._subject_id = intern_id(subject_id)
+        self._visit_id = intern_id(visit_id)
         self._repository = repository
         self._from_study = from_study
         self._exists = exists
@@ -178,6 +187,10 @@ class Fileset(BaseItemMixin, BaseFileset):
         The quality label assigned to the fileset (e.g. as is saved on XNAT)
     """
 
+    __slots__ = BaseItemMixin.ITEM_SLOTS + (
+        '_path', '_aux_files', '_uri', '_id', '_checksums', '_resource_name',
+        '_quality', '_potential_aux_files')
+
     def __init__(self, name, format=None, frequency='per_session',
                  path=None, aux_files=None, id=None, uri=None, subject_id=None,
                  visit_id=None, repository=None, from_study=None,
@@ -233,8 +246,10 @@ class Fileset(BaseItemMixin, BaseFileset):
         of the format class that take the fileset as the first argument
         """
         try:
-            frmt = self.__dict__['_format']
-        except KeyError:
+            # Accessed directly to avoid recursion if the slot isn't set yet
+            # (e.g. while unpickling)
+            frmt = object.__getattribute__(self, '_format')
+        except AttributeError:
             frmt = None
         else:
             try:
@@ -368,8 +383,12 @@ class Fileset(BaseItemMixin, BaseFileset):
                     "('{}')".format("', '".join(aux_files.keys()),
                                     "', '".join(self.format.aux_files.keys())))
             self._aux_files = aux_files
-        self._checksums = self.calculate_checksums()
-        self.put()  # Push to repository
+        # Push to repository, which can calculate the checksums while
+        # transferring the files so they only need to be read once
+        self._checksums = None
+        self.put()
+        if self._checksums is None:
+            self._checksums = self.calculate_checksums()
 
     @path.setter
     def path(self, path):
@@ -383,8 +402,8 @@ class Fileset(BaseItemMixin, BaseFileset):
                 "Cannot get paths of fileset ({}) that hasn't had its format "
                 "set".format(self))
         if self.format.directory:
-            return chain(*((op.join(root, f) for f in files)
-                           for root, _, files in os.walk(self.path)))
+            return (op.join(root, f)
+                    for root, _, files in os.walk(self.path) for f in files)
         else:
             return chain([self.path], self.aux_files.values())
 
@@ -482,14 +501,54 @@ class Fileset(BaseItemMixin, BaseFileset):
                 self._checksums = self.calculate_checksums()
         return self._checksums
 
-    def calculate_checksums(self):
-        checksums = {}
-        for fpath in self.paths:
-            with open(fpath, 'rb') as f:
-                checksums[op.relpath(fpath, self.path)] = hashlib.md5(
-                    f.read()).hexdigest()
+    @property
+    def checksum_algorithm(self):
+        """
+        The algorithm used to calculate the checksums of the fileset, which
+        is specified by its format or otherwise its repository
+        """
+        if (self.format is not None and
+                self.format.checksum_algorithm is not None):
+            return self.format.checksum_algorithm
+        if self.repository is not None:
+            return self.repository.checksum_algorithm
+        return DEFAULT_HASH_ALGORITHM
+
+    def checksums_for(self, algorithm=None):
+        """
+        Returns the checksums of the fileset calculated with the given
+        algorithm, so they can be compared with checksums that were recorded
+        in provenance with a different algorithm to the current one
+
+        Parameters
+        ----------
+        algorithm : str | None
+            The algorithm to use. If None the checksum algorithm of the
+            fileset is used
+        """
+        if algorithm is None or algorithm == self.checksum_algorithm:
+            return self.checksums
+        if not self.exists:
+            raise ArcanaDataNotDerivedYetError(
+                self.name,
+                "Cannot access checksums of {} as it hasn't been derived yet"
+                .format(self))
+        checksums = None
+        if self.repository is not None:
+            checksums = self.repository.get_checksums(self,
+                                                      algorithm=algorithm)
+        if checksums is None:
+            checksums = self.calculate_checksums(algorithm=algorithm)
         return checksums
 
+    def calculate_checksums(self, algorithm=None):
+        if algorithm is None:
+            algorithm = self.checksum_algorithm
+        return combine_checksums(
+            dict(hash_files(self.paths, base_path=self.path,
+                            algorithm=leaf_algorithm(algorithm))),
+            algorithm)
+
     @classmethod
     def from_path(cls, path, **kwargs):
         if not op.exists(path):
@@ -550,7 +609,9 @@ class Fileset(BaseItemMixin, BaseFileset):
 
     def put(self):
         if self.repository is not None and self._path is not None:
-            self.repository.put_fileset(self)
+            checksums = self.repository.put_fileset(self)
+            if checksums is not None:
+                self._checksums = checksums
 
     def contents_equal(self, other, **kwargs):
         """
@@ -602,6 +663,8 @@ class Field(BaseItemMixin, BaseField):
         if applicable
     """
 
+    __slots__ = BaseItemMixin.ITEM_SLOTS + ('_value',)
+
     def __init__(self, name, value=None, dtype=None,
                  frequency='per_session', array=None, subject_id=None,
                  visit_id=None, repository=None, from_study=None,
@@ -742,6 +805,12 @@ class Field(BaseItemMixin, BaseField):
         """
         return self.value
 
+    def checksums_for(self, algorithm=None):  # @UnusedVariable
+        """
+        For duck-typing with filesets in checksum management
+        """
+        return self.value
+
     def initkwargs(self):
         dct = BaseField.initkwargs(self)
         dct.update(BaseItemMixin.initkwargs(self))
@@ -16,12 +16,15 @@ from nipype.pipeline import engine as pe
 from nipype.interfaces.utility import IdentityInterface
 from logging import getLogger
 from arcana.utils import extract_package_version
+from arcana.utils.hashing import (
+    digest_algorithm, is_joined, item_algorithm, joined_digest, compact_joined)
 from arcana.__about__ import __version__
 from arcana.exceptions import (
     ArcanaDesignError, ArcanaError, ArcanaUsageError, ArcanaNoConverterError,
     ArcanaDataNotDerivedYetError, ArcanaNameError)
 from .provenance import (
-    Record, ARCANA_DEPENDENCIES, PROVENANCE_VERSION)
+    Record, ARCANA_DEPENDENCIES, PROVENANCE_VERSION, static_prov_hash,
+    static_prov_ref)
 
 
 logger = getLogger('arcana')
@@ -112,6 +115,8 @@ class Pipeline(object):
         # to compare with records saved in the repository when checking for
         # mismatches
         self._prov = None
+        self._static_prov_hashes = {}
+        self._static_prov_ref = None
         self._inputnodes = None
         self._outputnodes = None
 
@@ -730,6 +735,41 @@ class Pipeline(object):
                 "provenance is accessed")
         return self._prov
 
+    def static_prov_hash(self, include=None, exclude=None):
+        """
+        The hash of the sections of the expected provenance that are the same
+        for all nodes the pipeline is run over (see
+        arcana.pipeline.provenance.static_prov_hash), calculated once per
+        combination of include and exclude paths
+
+        Parameters
+        ----------
+        include : list[str] | None
+            Paths in the provenance to include. If None all are included
+        exclude : list[str] | None
+            Paths in the provenance to exclude. If None none are excluded
+        """
+        key = (tuple(include) if include is not None else None,
+               tuple(exclude) if exclude is not None else None)
+        try:
+            return self._static_prov_hashes[key]
+        except KeyError:
+            hsh = self._static_prov_hashes[key] = static_prov_hash(
+                self.prov, include=include, exclude=exclude)
+            return hsh
+
+    @property
+    def static_prov_ref(self):
+        """
+        The reference to the sections of the expected provenance that are the
+        same for all nodes the pipeline is run over, i.e. the hash of their
+        content they are stored under (see
+        arcana.pipeline.provenance.static_prov_ref)
+        """
+        if self._static_prov_ref is None:
+            self._static_prov_ref = static_prov_ref(self.prov)
+        return self._static_prov_ref
+
     def cap(self):
         """
         "Caps" the construction of the pipeline, signifying that no more inputs
@@ -926,7 +966,7 @@ class Pipeline(object):
             'joined_ids': self._joined_ids()}
         return prov
 
-    def expected_record(self, node):
+    def expected_record(self, node, record=None):
         """
         Constructs the provenance record that would be saved in the given node
         if the pipeline was run on the current state of the repository
@@ -936,6 +976,10 @@ class Pipeline(object):
         node : arcana.repository.tree.TreeNode
             A node of the Tree representation of the study data stored in the
             repository (i.e. a Session, Visit, Subject or Tree node)
+        record : arcana.provenance.Record | None
+            The record currently saved in the node. If provided, the checksums
+            of the inputs and outputs are calculated with the same algorithms
+            as those recorded in it so that they can be compared like with like
 
         Returns
         -------
@@ -943,6 +987,11 @@ class Pipeline(object):
             The record that would be produced if the pipeline is run over the
             study tree.
         """
+        if record is not None:
+            recorded_inputs = record.inputs
+            recorded_outputs = record.outputs
+        else:
+            recorded_inputs = recorded_outputs = {}
         exp_inputs = {}
         # Get checksums/values of all inputs that would have been used in
         # previous runs of an equivalent pipeline to compare with that saved
@@ -952,16 +1001,22 @@ class Pipeline(object):
             # and need to be joined
             iterators_to_join = (self.iterators(inpt.frequency) -
                                  self.iterators(node.frequency))
+            algorithm = digest_algorithm(recorded_inputs.get(inpt.name))
+            # Joined inputs that were compacted into a single digest are
+            # compacted in the same way (see Processor.compact_joins)
+            compact = is_joined(algorithm)
+            algorithm = item_algorithm(algorithm)
             if not iterators_to_join:
                 # No iterators to join so we can just extract the checksums
                 # of the corresponding input
                 exp_inputs[inpt.name] = inpt.collection.item(
-                    node.subject_id, node.visit_id).checksums
+                    node.subject_id, node.visit_id).checksums_for(algorithm)
             elif len(iterators_to_join) == 1:
                 # Get list of checksums dicts for each node of the input
                 # frequency that relates to the current node
                 exp_inputs[inpt.name] = [
-                    inpt.collection.item(n.subject_id, n.visit_id).checksums
+                    inpt.collection.item(
+                        n.subject_id, n.visit_id).checksums_for(algorithm)
                     for n in node.nodes(inpt.frequency)]
             else:
                 # In the case where the node is the whole treee and the input
@@ -970,16 +1025,20 @@ class Pipeline(object):
                 exp_inputs[inpt.name] = []
                 for subj in node.subjects:
                     exp_inputs[inpt.name].append([
-                        inpt.collection.item(s.subject_id,
-                                             s.visit_id).checksums
+                        inpt.collection.item(
+                            s.subject_id, s.visit_id).checksums_for(algorithm)
                         for s in subj.sessions])
+            if compact:
+                exp_inputs[inpt.name] = compact_joined(
+                    exp_inputs[inpt.name], len(iterators_to_join))
         # Get checksums/value for all outputs of the pipeline. We are assuming
         # that they exist here (otherwise they will be None)
         exp_outputs = {}
         for output in self.outputs:
             try:
                 exp_outputs[output.name] = output.collection.item(
-                    node.subject_id, node.visit_id).checksums
+                    node.subject_id, node.visit_id).checksums_for(
+                        digest_algorithm(recorded_outputs.get(output.name)))
             except ArcanaDataNotDerivedYetError:
                 pass
         exp_prov = copy(self.prov)
@@ -989,7 +1048,12 @@ class Pipeline(object):
             exp_outputs = json.loads(json.dumps(exp_outputs))
         exp_prov['inputs'] = exp_inputs
         exp_prov['outputs'] = exp_outputs
-        exp_prov['joined_ids'] = self._joined_ids()
+        exp_joined_ids = self._joined_ids()
+        if record is not None:
+            for key, ids in record.joined_ids.items():
+                if isinstance(ids, basestring) and key in exp_joined_ids:
+                    exp_joined_ids[key] = joined_digest(exp_joined_ids[key])
+        exp_prov['joined_ids'] = exp_joined_ids
         return Record(
             self.name, node.frequency, node.subject_id, node.visit_id,
             self.study.name, exp_prov)
@@ -1,11 +1,16 @@
 from past.builtins import basestring
+import os.path as op
 import json
 import re
+import hashlib
+from collections import OrderedDict
+from functools import partial
 from copy import deepcopy
 from pprint import pformat
 from datetime import datetime
 from deepdiff import DeepDiff
 from arcana.exceptions import ArcanaError, ArcanaUsageError
+from arcana.utils import intern_id
 from arcana.__about__ import install_requires
 
 
@@ -13,6 +18,184 @@ PROVENANCE_VERSION = '1.0'
 
 ARCANA_DEPENDENCIES = [re.split(r'[><=]+', r)[0] for r in install_requires]
 
+# The sections of the provenance that are specific to each node the pipeline
+# is run over. The remaining sections (e.g. 'workflow' and 'study') are the
+# same for all nodes of a pipeline
+NODE_PROV_KEYS = ('inputs', 'outputs', 'joined_ids', 'datetime')
+
+# Key that references the static sections of the provenance by their content
+# hash when they are stored separately to the node-specific sections, and
+# the name of the directory they are stored in (see Record.save)
+STATIC_REF_KEY = '__static_ref__'
+STATIC_PROV_DIR = '.__prov_static__'
+
+# The sections of the provenance that are saved at the start of records, so
+# that they can be decoded without decoding the rest of the record (in
+# particular the workflow graph, see decode_head)
+HEAD_PROV_KEYS = ('datetime', 'outputs', 'inputs', 'joined_ids',
+                  STATIC_REF_KEY)
+
+
+def decode_head(content, keys=HEAD_PROV_KEYS):
+    """
+    Decodes the leading items of the JSON object in `content` for as long as
+    their keys are in `keys`, leaving the remainder of the object undecoded
+
+    Parameters
+    ----------
+    content : str
+        The JSON encoded provenance record
+    keys : iterable[str]
+        The keys of the items to decode
+
+    Returns
+    -------
+    head : dict[str, *]
+        The decoded leading items
+    """
+    keys = frozenset(keys)
+    decoder = json.JSONDecoder()
+    head = {}
+
+    def skip_ws(idx):
+        while idx < len(content) and content[idx] in ' \t\n\r':
+            idx += 1
+        return idx
+
+    idx = skip_ws(0)
+    if content[idx:idx + 1] != '{':
+        return head
+    idx += 1
+    while True:
+        idx = skip_ws(idx)
+        if content[idx:idx + 1] != '"':
+            break
+        key, idx = decoder.raw_decode(content, idx)
+        if key not in keys:
+            break
+        idx = skip_ws(idx)
+        if content[idx:idx + 1] != ':':
+            break
+        head[key], idx = decoder.raw_decode(content, skip_ws(idx + 1))
+        idx = skip_ws(idx)
+        if content[idx:idx + 1] != ',':
+            break
+        idx += 1
+    return head
+
+
+def _load_saved_static(static_dir, path, static_ref):
+    """
+    Loads the static sections of the provenance referenced by a record saved
+    at 'path' (see Record.load)
+    """
+    if static_dir is None:
+        static_dir = Record._find_static_dir(path)
+    with open(op.join(static_dir, static_ref + '.json')) as f:
+        return json.load(f)
+
+
+def prov_entries(prov, keys, include=None, exclude=None):
+    """
+    Flattens the given sections of a provenance dictionary into a canonical
+    list of (path, type, value) entries, where the paths are in the format
+    used by DeepDiff (e.g. "root['workflow']['nodes']"). Only paths that are
+    included and not excluded (see Record.mismatches) are listed, containers
+    being listed by their keys or length. If the entries of two provenance
+    dictionaries are equal then DeepDiff won't find any included changes
+    between them (although the converse doesn't hold, e.g. for reordered
+    lists)
+
+    Parameters
+    ----------
+    prov : dict[str, *]
+        The provenance dictionary
+    keys : iterable[str]
+        The top-level sections of the provenance to list
+    include : list[str | re.Pattern] | None
+        Paths in the provenance to include. If None all are included
+    exclude : list[str | re.Pattern] | None
+        Paths in the provenance to exclude. If None none are excluded
+
+    Returns
+    -------
+    entries : list[tuple[str, str, *]]
+        The path, type and value (or keys/length for containers) of each
+        included node of the provenance
+    """
+    include_res = ([Record._gen_prov_path_regex(p) for p in include]
+                   if include is not None else None)
+    exclude_res = ([Record._gen_prov_path_regex(p) for p in exclude]
+                   if exclude is not None else [])
+    entries = []
+
+    def add_entries(value, path):
+        if any(rx.match(path) for rx in exclude_res):
+            return  # Sub-paths of excluded paths are also excluded
+        included = (include_res is None or
+                    any(rx.match(path) for rx in include_res))
+        type_name = type(value).__name__
+        if isinstance(value, dict):
+            names = sorted(value, key=str)
+            if included:
+                entries.append((path, type_name, [str(n) for n in names]))
+            for name in names:
+                add_entries(value[name], "{}['{}']".format(path, name))
+        elif isinstance(value, (list, tuple)):
+            if included:
+                entries.append((path, type_name, len(value)))
+            for i, item in enumerate(value):
+                add_entries(item, '{}[{}]'.format(path, i))
+        elif included:
+            entries.append((path, type_name, value))
+
+    for key in sorted(keys):
+        if key in prov:
+            add_entries(prov[key], "root['{}']".format(key))
+    return entries
+
+
+def static_prov_hash(prov, include=None, exclude=None):
+    """
+    Calculates a hash of the canonicalised sections of a provenance
+    dictionary that are the same for all nodes of a pipeline (i.e. all but
+    NODE_PROV_KEYS), so they only need to be compared once per pipeline
+
+    Parameters
+    ----------
+    prov : dict[str, *]
+        The provenance dictionary
+    include : list[str | re.Pattern] | None
+        Paths in the provenance to include. If None all are included
+    exclude : list[str | re.Pattern] | None
+        Paths in the provenance to exclude. If None none are excluded
+
+    Returns
+    -------
+    hash : str
+        The hex digest of the included static provenance
+    """
+    entries = prov_entries(
+        prov, (k for k in prov if k not in NODE_PROV_KEYS), include=include,
+        exclude=exclude)
+    return hashlib.md5(repr(entries).encode()).hexdigest()
+
+
+def static_prov_ref(prov):
+    """
+    Returns the reference to the sections of a provenance dictionary that are
+    the same for all nodes of a pipeline (i.e. all but NODE_PROV_KEYS), the
+    SHA-256 of their canonical JSON, which they are stored under when saved
+    separately to the node-specific sections (see Record.save)
+    """
+    return hashlib.sha256(json.dumps(
+        {k: v for k, v in prov.items() if k not in NODE_PROV_KEYS},
+        sort_keys=True).encode()).hexdigest()
+
+
+def _paths_key(paths):
+    return tuple(paths) if paths is not None else None
+
 
 class Record(object):
     """
@@ -38,23 +221,43 @@ class Record(object):
         per-study summary
     from_study : str
         Name of the study that the record was generated by
-    prov : dict[str, *]
+    prov : dict[str, *] | None
         A dictionary containing the provenance recorded/to record
+    content : str | None
+        The JSON encoded provenance of a saved record, which is only decoded
+        in full when it is first required (the sections in HEAD_PROV_KEYS
+        are decoded separately). Used instead of 'prov'
+    load_static : callable | None
+        Returns the static sections of the provenance given the reference
+        to them, if they are referenced by the saved record instead of being
+        included in it (see save)
     """
 
     # For duck-typing with Filesets and Fields
     derived = True
 
     def __init__(self, pipeline_name, frequency, subject_id, visit_id,
-                 from_study, prov):
-        self._prov = deepcopy(prov)
+                 from_study, prov=None, content=None, load_static=None):
+        if prov is not None:
+            self._prov = deepcopy(prov)
+            if 'datetime' not in self._prov:
+                self._prov['datetime'] = datetime.now().isoformat()
+        elif content is None:
+            raise ArcanaUsageError(
+                "Either 'prov' or 'content' needs to be provided to Record")
+        else:
+            self._prov = None
+        self._content = content if prov is None else None
+        self._load_static = load_static
+        # Sections of the provenance decoded from the start of the content
+        self._head = None
         self._pipeline_name = pipeline_name
         self._frequency = frequency
-        self._subject_id = subject_id
-        self._visit_id = visit_id
+        self._subject_id = intern_id(subject_id)
+        self._visit_id = intern_id(visit_id)
         self._from_study = from_study
-        if 'datetime' not in self._prov:
-            self._prov['datetime'] = datetime.now().isoformat()
+        # Static provenance hashes by include/exclude paths
+        self._static_hashes = {}
 
     def __repr__(self):
         return ("{}(pipeline={}, frequency={}, subject_id={}, visit_id={}, "
@@ -63,7 +266,7 @@ class Record(object):
                     self.subject_id, self.visit_id, self.from_study))
 
     def __eq__(self, other):
-        return (self._prov == other._prov and
+        return (self.prov == other.prov and
                 self._frequency == other._frequency and
                 self._subject_id == other._subject_id and
                 self._visit_id == other._visit_id and
@@ -75,15 +278,63 @@ class Record(object):
 
     @property
     def prov(self):
+        if self._prov is None:
+            prov = json.loads(self._content)
+            if STATIC_REF_KEY in prov:
+                if self._load_static is None:
+                    raise ArcanaError(
+                        "Cannot load static provenance referenced by {} as "
+                        "no loader was provided".format(self))
+                prov = self.expand_static_ref(prov, self._load_static)
+            if 'datetime' not in prov:
+                prov['datetime'] = datetime.now().isoformat()
+            self._prov = prov
+            self._content = self._head = self._load_static = None
         return self._prov
 
+    @property
+    def loaded(self):
+        "Whether the provenance has been decoded in full"
+        return self._prov is not None
+
+    def _head_value(self, key):
+        """
+        Returns a section of the provenance, only decoding the start of the
+        content of the record if possible
+        """
+        if self._prov is None:
+            if self._head is None:
+                self._head = decode_head(self._content)
+            try:
+                return self._head[key]
+            except KeyError:
+                pass  # Not at the start of the record so decode in full
+        return self.prov[key]
+
     @property
     def inputs(self):
-        return self._prov['inputs']
+        return self._head_value('inputs')
 
     @property
     def outputs(self):
-        return self._prov['outputs']
+        return self._head_value('outputs')
+
+    @property
+    def joined_ids(self):
+        return self._head_value('joined_ids')
+
+    @property
+    def static_ref(self):
+        """
+        The reference to the static sections of the provenance (see
+        static_prov)
+        """
+        if self._prov is None:
+            if self._head is None:
+                self._head = decode_head(self._content)
+            if STATIC_REF_KEY in self._head:
+                return self._head[STATIC_REF_KEY]
+        return self.static_prov()[0]
 
     @property
     def subject_id(self):
@@ -103,13 +354,31 @@ class Record(object):
 
     @property
     def datetime(self):
-        return self._prov['datetime']
+        return self._head_value('datetime')
 
     @property
     def provenance_version(self):
-        return self._prov[PROVENANCE_VERSION]
+        return self.prov[PROVENANCE_VERSION]
 
-    def save(self, path):
+    def static_prov(self):
+        """
+        Returns the sections of the provenance that are the same for all
+        nodes of the pipeline (i.e. all but NODE_PROV_KEYS) along with the
+        hash of their content, which they can be stored under separately to
+        the node-specific sections so they aren't duplicated for every node
+
+        Returns
+        -------
+        static_ref : str
+            The hex digest of the canonical JSON of the static sections
+        static : dict[str, *]
+            The static sections of the provenance
+        """
+        static = {k: v for k, v in self.prov.items()
+                  if k not in NODE_PROV_KEYS}
+        return static_prov_ref(static), static
+
+    def save(self, path, static_ref=None):
         """
         Saves the provenance object to a JSON file, optionally including
         checksums for inputs and outputs (which are initially produced mid-
@@ -119,31 +388,63 @@ class Record(object):
         ----------
         path : str
             Path to save the generated JSON file
-        inputs : dict[str, str | list[str] | list[list[str]]] | None
-            Checksums of all pipeline inputs used by the pipeline. For inputs
-            of matching frequency to the output derivative associated with the
-            provenance object, the values of the dictionary will be single
-            checksums. If the output is of lower frequency they will be lists
-            of checksums or in the case of 'per_session' inputs to 'per_study'
-            outputs, lists of lists of checksum. They need to be provided here
-            if the provenance object was initialised without checksums
-        outputs : dict[str, str] | None
-            Checksums of all pipeline outputs. They need to be provided here
-            if the provenance object was initialised without checksums
+        static_ref : str | None
+            If provided, only the node-specific sections of the provenance are
+            saved along with this reference to the static sections, which
+            need to be saved separately under it (see static_prov)
         """
+        prov = self.prov
+        if static_ref is not None:
+            prov = {k: v for k, v in prov.items() if k in NODE_PROV_KEYS}
+            prov[STATIC_REF_KEY] = static_ref
+        # Save the sections that are accessed without loading the rest of the
+        # record first (see decode_head)
+        ordered = OrderedDict((k, prov[k]) for k in HEAD_PROV_KEYS
+                              if k in prov)
+        ordered.update((k, v) for k, v in prov.items()
+                       if k not in HEAD_PROV_KEYS)
+        prov = ordered
         with open(path, 'w') as f:
             try:
-                json.dump(self.prov, f, indent=2)
+                json.dump(prov, f, indent=2)
             except TypeError:
                 raise ArcanaError(
                     "Could not serialise provenance record dictionary:\n{}"
                     .format(pformat(self.prov)))
 
+    @classmethod
+    def expand_static_ref(cls, prov, load_static):
+        """
+        Merges the static sections of the provenance referenced by a record
+        that was saved with a static reference back into it
+
+        Parameters
+        ----------
+        prov : dict[str, *]
+            The provenance dictionary as loaded from the saved record
+        load_static : callable
+            Returns the static sections of the provenance given their
+            reference
+
+        Returns
+        -------
+        prov : dict[str, *]
+            The full provenance dictionary
+        """
+        if STATIC_REF_KEY not in prov:
+            return prov
+        expanded = dict(load_static(prov[STATIC_REF_KEY]))
+        expanded.update((k, v) for k, v in prov.items()
+                        if k != STATIC_REF_KEY)
+        return expanded
+
     @classmethod
     def load(cls, pipeline_name, frequency, subject_id, visit_id, from_study,
-             path):
+             path, static_dir=None):
         """
-        Loads a saved provenance object from a JSON file
+        Loads a saved provenance object from a JSON file. Only the sections
+        at the start of the file (see HEAD_PROV_KEYS) are decoded until the
+        rest of the provenance is accessed
 
         Parameters
         ----------
@@ -157,6 +458,11 @@ class Record(object):
             The visit ID of the provenance record
         from_study : str
             Name of the study the derivatives were created for
+        static_dir : str | None
+            The directory the static sections of the provenance are stored
+            in, if the record was saved with a reference to them. If None,
+            the nearest STATIC_PROV_DIR in the parent directories of the
+            record is used
 
         Returns
         -------
@@ -164,11 +470,76 @@ class Record(object):
             The loaded provenance record
         """
         with open(path) as f:
-            prov = json.load(f)
+            content = f.read()
+        # A partial of a module-level function is used instead of a closure
+        # so that loaded records can be pickled (e.g. in tree snapshots)
         return Record(pipeline_name, frequency, subject_id, visit_id,
-                      from_study, prov)
+                      from_study, content=content,
+                      load_static=partial(_load_saved_static, static_dir,
+                                          path))
+
+    @classmethod
+    def _find_static_dir(cls, path):
+        dpath = op.dirname(op.abspath(path))
+        while True:
+            static_dir = op.join(dpath, STATIC_PROV_DIR)
+            if op.isdir(static_dir):
+                return static_dir
+            parent = op.dirname(dpath)
+            if parent == dpath:
+                raise ArcanaError(
+                    "Could not find '{}' directory holding the static "
+                    "provenance referenced by '{}'".format(STATIC_PROV_DIR,
+                                                           path))
+            dpath = parent
+
+    def static_hash(self, include=None, exclude=None):
+        """
+        The hash of the sections of the provenance that are the same for all
+        nodes of the pipeline (see static_prov_hash), cached for each
+        combination of include and exclude paths
+        """
+        key = (_paths_key(include), _paths_key(exclude))
+        try:
+            return self._static_hashes[key]
+        except KeyError:
+            hsh = self._static_hashes[key] = static_prov_hash(
+                self.prov, include=include, exclude=exclude)
+            return hsh
+
+    def matches(self, other, include=None, exclude=None,
+                other_static_hash=None):
+        """
+        Quickly checks whether there are no mismatches between the provenance
+        objects by comparing the hashes of their static sections and then
+        the canonicalised node-specific sections. Note that a False result
+        doesn't mean there are mismatches (e.g. for reordered lists), just
+        that they need to be checked with 'mismatches'
+
+        Parameters
+        ----------
+        other : Provenance
+            The provenance object to compare against
+        include : list[list[str]] | None
+            Paths in the provenance to include in the match. If None all are
+            incluced
+        exclude : list[list[str]] | None
+            Paths in the provenance to exclude from the match. In None all are
+            excluded
+        other_static_hash : str | None
+            The static hash of the other provenance object if it has already
+            been calculated, e.g. once for all nodes of a pipeline
+        """
+        if other_static_hash is None:
+            other_static_hash = other.static_hash(include, exclude)
+        if self.static_hash(include, exclude) != other_static_hash:
+            return False
+        return (
+            prov_entries(self.prov, NODE_PROV_KEYS, include, exclude) ==
+            prov_entries(other.prov, NODE_PROV_KEYS, include, exclude))
 
-    def mismatches(self, other, include=None, exclude=None):
+    def mismatches(self, other, include=None, exclude=None,
+                   other_static_hash=None):
         """
         Compares information stored within provenance objects with the
         exception of version information to see if they match. Matches are
@@ -185,12 +556,19 @@ class Record(object):
         exclude : list[list[str]] | None
             Paths in the provenance to exclude from the match. In None all are
             excluded
+        other_static_hash : str | None
+            The static hash of the other provenance object if it has already
+            been calculated, e.g. once for all nodes of a pipeline
         """
+        # Only run the full diff to report the mismatches if the static
+        # hashes or node-specific sections differ
+        if self.matches(other, include, exclude, other_static_hash):
+            return {}
         if include is not None:
             include_res = [self._gen_prov_path_regex(p) for p in include]
         if exclude is not None:
             exclude_res = [self._gen_prov_path_regex(p) for p in exclude]
-        diff = DeepDiff(self._prov, other._prov, ignore_order=True)
+        diff = DeepDiff(self.prov, other.prov, ignore_order=True)
         # Create regular expresssions for the include and exclude paths in
         # the format that deepdiff uses for nested dictionary/lists
 
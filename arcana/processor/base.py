@@ -5,13 +5,19 @@ import os.path as op
 from collections import defaultdict, OrderedDict
 import shutil
 from itertools import repeat
+from concurrent.futures import ThreadPoolExecutor
+import json
+import hashlib
 from copy import copy, deepcopy
 from logging import getLogger
 import numpy as np
 from nipype.pipeline import engine as pe
 from nipype.interfaces.utility import IdentityInterface, Merge
-from arcana.repository.interfaces import RepositorySource, RepositorySink
+from arcana.repository.interfaces import (
+    RepositorySource, RepositorySink, JoinChecksums)
+from arcana.pipeline.provenance import Record
 from arcana.utils import get_class_info
+from arcana.__about__ import __version__
 from arcana.exceptions import (
     ArcanaMissingDataException,
     ArcanaNoRunRequiredException, ArcanaUsageError, ArcanaDesignError,
@@ -59,6 +65,48 @@ class Processor(object):
     default_mem_gb : float
         The default memory assumed to be required for nodes where it isn't
         specified
+    snapshot_tree : bool
+        Whether to save a snapshot of the repository tree in the working
+        directory before each run, which is loaded by the worker processes
+        instead of pickling the tree with every node that references the
+        repository
+    compact_joins : bool
+        Whether the checksums/values of inputs that are joined over subjects
+        and/or visits (e.g. 'per_session' inputs to 'per_study' pipelines),
+        and the joined IDs, are reduced to single digests of the joined items
+        in provenance records instead of storing the full lists
+    joined_sidecar : bool
+        Whether to save the full lists of joined checksums/values and IDs in
+        sidecars to the provenance records that have joined inputs. Requires
+        'compact_joins' to be set. Note that the full lists need to be passed
+        through to the sinks in this case instead of just their digests
+    num_check_threads : int | None
+        The maximum number of threads used to check the provenance of
+        existing derivatives against the pipeline. If None the default of
+        concurrent.futures.ThreadPoolExecutor is used
+    retain_work_dir : bool
+        Whether to retain the working directories of workflows between runs
+        so that the results of intermediate nodes can be reused by resumed or
+        repeated runs. The working directories are keyed by the static
+        provenance of the pipelines (i.e. their interfaces, parameters and
+        requirement versions), so results are only reused by equivalent
+        pipelines, and inputs are hashed by content within them. Overrides
+        'clean_work_dir_between_runs'. Cannot be used with repositories that
+        move outputs into place (i.e. BasicRepo(sink_strategy='move'))
+    work_dir_budget_gb : float | None
+        The maximum combined size of the retained working directories. If
+        exceeded, the least recently used directories are deleted after each
+        run. If None the retained directories aren't deleted
+    run_manifest : bool
+        Whether to record the requests that have been run, along with a
+        digest of the state of the data they use (the inputs, outputs and
+        provenance records of the pipelines and their prerequisites)
+        afterwards, in a manifest in the working directory. Requests that
+        are repeated while the data is unchanged are then declared up to
+        date without constructing and checking the pipelines. NB: changes to
+        the code of pipelines that aren't reflected in the study provenance
+        (i.e. parameters, inputs, environment or package versions) won't be
+        detected
 
     NB: Other keyword wargs are passed to the wrapped Nipype plugin. Some
     useful ones for debugging are 'remove_unnecessary_outputs=False' and
@@ -70,6 +118,14 @@ class Processor(object):
 
     WORKFLOW_MAX_NAME_LEN = 100
 
+    TREE_SNAPSHOT_SUFFIX = '.tree_snapshot.pkl'
+
+    RUN_MANIFEST_FNAME = 'run_manifest.json'
+
+    # Sub-directory of the work directory that retained working directories
+    # of workflows are stored in, keyed by the provenance of their pipelines
+    RETAINED_DIR = 'retained'
+
     # The default paths in the provenance JSON to check for mismatches that
     # would require the derivative to be reprocessed
     DEFAULT_PROV_CHECK = ['workflow', 'inputs', 'outputs', 'joined_ids']
@@ -87,7 +143,10 @@ class Processor(object):
                  max_process_time=None,
                  clean_work_dir_between_runs=True,
                  default_wall_time=DEFAULT_WALL_TIME,
-                 default_mem_gb=DEFAULT_MEM_GB, **kwargs):
+                 default_mem_gb=DEFAULT_MEM_GB, snapshot_tree=False,
+                 compact_joins=False, joined_sidecar=False,
+                 num_check_threads=None, run_manifest=False,
+                 retain_work_dir=False, work_dir_budget_gb=None, **kwargs):
         self._work_dir = work_dir
         self._max_process_time = max_process_time
         self._reprocess = reprocess
@@ -100,6 +159,17 @@ class Processor(object):
         self._init_plugin()
         self._study = None
         self._clean_work_dir_between_runs = clean_work_dir_between_runs
+        self._snapshot_tree = snapshot_tree
+        if joined_sidecar and not compact_joins:
+            raise ArcanaUsageError(
+                "'joined_sidecar' can only be set when 'compact_joins' is "
+                "also set")
+        self._compact_joins = compact_joins
+        self._joined_sidecar = joined_sidecar
+        self._num_check_threads = num_check_threads
+        self._run_manifest = run_manifest
+        self._retain_work_dir = retain_work_dir
+        self._work_dir_budget_gb = work_dir_budget_gb
 
     def __repr__(self):
         return "{}(work_dir={})".format(
@@ -142,7 +212,34 @@ class Processor(object):
     def default_wall_time(self):
         return self._default_wall_time
 
+    @property
+    def compact_joins(self):
+        return self._compact_joins
+
+    @property
+    def joined_sidecar(self):
+        return self._joined_sidecar
+
+    @property
+    def run_manifest(self):
+        return self._run_manifest
+
+    @property
+    def retain_work_dir(self):
+        return self._retain_work_dir
+
+    @property
+    def work_dir_budget_gb(self):
+        return self._work_dir_budget_gb
+
     def bind(self, study):
+        if (self._retain_work_dir and
+                getattr(study.repository, 'sink_strategy', None) == 'move'):
+            # The outputs would be moved out of the retained node directories
+            # so couldn't be sunk again when the cached results are reused
+            raise ArcanaUsageError(
+                "Cannot retain working directories when outputs are moved "
+                "into {} (i.e. sink_strategy='move')".format(study.repository))
         cpy = deepcopy(self)
         cpy._study = study
         return cpy
@@ -196,7 +293,26 @@ class Processor(object):
         session_ids = kwargs.pop('session_ids', None)
         clean_work_dir = kwargs.pop('clean_work_dir',
                                     self._clean_work_dir_between_runs)
+        if self._retain_work_dir:
+            clean_work_dir = False
         required_outputs = kwargs.pop('required_outputs', repeat(None))
+        # The request to record in the run manifest, which is provided by
+        # Study.data if it has already checked the manifest
+        manifest_request = kwargs.pop('manifest_request', None)
+        if (self._run_manifest and manifest_request is None and
+                not kwargs.get('force')):
+            manifest_request = {
+                'pipelines': [
+                    (p.name, sorted(r) if r is not None else None)
+                    for p, r in zip(pipelines, required_outputs)],
+                'subject_ids': subject_ids,
+                'visit_ids': visit_ids,
+                'session_ids': session_ids}
+            if self.up_to_date(manifest_request):
+                logger.info("Not running '{}' as the study data is unchanged "
+                            "since they were last run".format(
+                                "', '".join(p.name for p in pipelines)))
+                return None
         # Create name by combining pipelines
         name = '_'.join(p.name for p in pipelines)
         # Clean work dir if required
@@ -208,7 +324,187 @@ class Processor(object):
         # workflow names exceeding system limits.
         name = name[:self.WORKFLOW_MAX_NAME_LEN]
         workflow = pe.Workflow(name=name, base_dir=self.work_dir)
+        # Resolve the stack of pipelines to process along with their
+        # prerequisites
+        stack, subject_inds, visit_inds = self._resolve_stack(
+            pipelines, required_outputs, subject_ids=subject_ids,
+            visit_ids=visit_ids, session_ids=session_ids)
+        # Iterate through stack of required pipelines from upstream to
+        # downstream
+        for pipeline, req_outputs, flt_array in reversed(list(stack.values())):
+            try:
+                self._connect_pipeline(
+                    pipeline, req_outputs, workflow, subject_inds, visit_inds,
+                    flt_array, **kwargs)
+            except ArcanaNoRunRequiredException:
+                logger.info("Not running '{}' pipeline as its outputs "
+                            "are already present in the repository"
+                            .format(pipeline.name))
+        # Save complete graph for debugging purposes
+#         workflow.write_graph(graph2use='flat', format='svg')
+#         print('Graph saved in {} directory'.format(os.getcwd()))
+        # Actually run the generated workflow
+        retained_dir = None
+        if workflow._get_all_nodes():  # Check if workflow has any nodes to run
+            if self._snapshot_tree:
+                os.makedirs(self.work_dir, exist_ok=True)
+                self.study.repository.save_snapshot(
+                    op.join(self.work_dir, name + self.TREE_SNAPSHOT_SUFFIX))
+            if self._retain_work_dir:
+                # Run the workflow in a directory keyed by the provenance of
+                # the pipelines (now they have been capped) so that results
+                # are only reused by equivalent pipelines, hashing the inputs
+                # of the nodes by content instead of timestamps
+                retained_dir = self._retained_dir(
+                    p for p, _, _ in stack.values())
+                os.makedirs(retained_dir, exist_ok=True)
+                # Mark as recently used for garbage collection
+                os.utime(retained_dir)
+                workflow.base_dir = retained_dir
+                workflow.config['execution']['hash_method'] = 'content'
+            result = workflow.run(plugin=self._plugin)
+            sunk_nodes = self._sunk_nodes(result)
+        else:
+            result = None
+            sunk_nodes = []
+        if self._retain_work_dir and self._work_dir_budget_gb is not None:
+            self.collect_retained_garbage(keep=retained_dir)
+        # Update the cached tree of filesets in the repository as it will
+        # change after the pipeline has run.
+        self.study.clear_caches(updated_nodes=sunk_nodes)
+        if (self._run_manifest and manifest_request is not None and
+                not kwargs.get('force')):
+            self._save_up_to_date(manifest_request,
+                                  [p for p, _, _ in stack.values()])
+        return result
+
+    def plan(self, *pipelines, **kwargs):
+        """
+        Determines what running the pipelines would do without running
+        anything, i.e. resolves the stack of pipelines and the nodes each of
+        them would process, protect or skip along with the reasons, and
+        estimates the cost of running them from the wall times and memory
+        requirements of their nodes. Takes the same arguments as 'run'.
+
+        Note that, as in 'run', errors are raised for nodes with both
+        protected and missing required outputs, but provenance mismatches
+        that would raise an error when 'reprocess' is not set are recorded
+        with the 'conflict' action instead.
+
+        Returns
+        -------
+        plan : dict[str, *]
+            A JSON-serialisable description of the run, with the plan of each
+            pipeline in the order they would be run under 'pipelines' and
+            the totals of the estimated 'cpu_hours' and 'peak_mem_gb'. The
+            estimates of each pipeline assume that all its nodes run for
+            every iteration of the pipeline, so are upper bounds for
+            pipelines that contain joins.
+        """
+        if not pipelines:
+            raise ArcanaUsageError("No pipelines provided to {}.plan"
+                                   .format(self))
+        subject_ids = kwargs.pop('subject_ids', None)
+        visit_ids = kwargs.pop('visit_ids', None)
+        session_ids = kwargs.pop('session_ids', None)
+        kwargs.pop('clean_work_dir', None)
+        kwargs.pop('manifest_request', None)
+        required_outputs = kwargs.pop('required_outputs', repeat(None))
+        stack, subject_inds, visit_inds = self._resolve_stack(
+            pipelines, required_outputs, subject_ids=subject_ids,
+            visit_ids=visit_ids, session_ids=session_ids)
+        inv_subject_inds = {v: k for k, v in subject_inds.items()}
+        inv_visit_inds = {v: k for k, v in visit_inds.items()}
+
+        def session_ids_of(array):
+            return [[inv_subject_inds[s], inv_visit_inds[v]]
+                    for s, v in zip(*np.nonzero(array))]
+
+        pipeline_plans = []
+        for pipeline, req_outputs, flt_array in reversed(list(stack.values())):
+            reasons = []
+            to_process_array, to_protect_array, to_skip_array = (
+                self._pipeline_arrays(
+                    pipeline, req_outputs, subject_inds, visit_inds,
+                    flt_array, reasons=reasons, **kwargs))
+            iterators = pipeline.iterators()
+            # The number of times the nodes of the pipeline would be run
+            if not to_process_array.any():
+                num_runs = 0
+            elif iterators == set(self.study.ITERFIELDS):
+                num_runs = int(to_process_array.sum())
+            elif self.study.SUBJECT_ID in iterators:
+                num_runs = int(to_process_array.any(axis=1).sum())
+            elif self.study.VISIT_ID in iterators:
+                num_runs = int(to_process_array.any(axis=0).sum())
+            else:
+                num_runs = 1
+            nodes = []
+            for node in pipeline.nodes:
+                if isinstance(node.interface, IdentityInterface):
+                    continue  # Input and output nodes
+                nodes.append({
+                    'name': node.name[len(pipeline.name) + 1:],
+                    'wall_time': getattr(node, 'wall_time', None) or 0,
+                    'mem_gb': node.mem_gb,
+                    'n_procs': node.n_procs})
+            cpu_hours = num_runs * sum(
+                n['wall_time'] * n['n_procs'] for n in nodes) / 60.0
+            pipeline_plans.append({
+                'name': pipeline.name,
+                'required_outputs': (sorted(req_outputs)
+                                     if req_outputs is not None else None),
+                'iterators': sorted(iterators),
+                'num_runs': num_runs,
+                'to_process': session_ids_of(to_process_array),
+                'to_protect': session_ids_of(to_protect_array),
+                'to_skip': session_ids_of(to_skip_array * flt_array),
+                'reasons': reasons,
+                'nodes': nodes,
+                'cpu_hours': cpu_hours,
+                'peak_mem_gb': (max(n['mem_gb'] for n in nodes)
+                                if nodes and num_runs else 0)})
+        return {
+            'pipelines': pipeline_plans,
+            'cpu_hours': sum(p['cpu_hours'] for p in pipeline_plans),
+            'peak_mem_gb': max(p['peak_mem_gb'] for p in pipeline_plans)}
+
+    @classmethod
+    def _plan_reason(cls, node, action, reason):
+        return {'frequency': node.frequency, 'subject_id': node.subject_id,
+                'visit_id': node.visit_id, 'action': action,
+                'reason': reason}
+
+    def _resolve_stack(self, pipelines, required_outputs, subject_ids=None,
+                       visit_ids=None, session_ids=None):
+        """
+        Resolves the stack of pipelines (including prerequisites) that need
+        to be considered in order to run the given pipelines, along with the
+        (dialated) arrays of subject/visit IDs to include for each
+
+        Parameters
+        ----------
+        pipelines : list[Pipeline]
+            The pipelines requested to be run
+        required_outputs : iterable[set[str] | None]
+            The required outputs of each pipeline
+        subject_ids : list[str] | None
+            The subset of subject IDs to process (see run)
+        visit_ids : list[str] | None
+            The subset of visit IDs to process (see run)
+        session_ids : list[tuple[str, str]] | None
+            The subset of sessions to process (see run)
 
+        Returns
+        -------
+        stack : OrderedDict[str, tuple[Pipeline, set[str], 2-D numpy.array]]
+            The pipelines to process, along with their required outputs and
+            filter arrays, in reverse order of required execution
+        subject_inds : dict[str, int]
+            A mapping of subject ID to row index in the filter arrays
+        visit_inds : dict[str, int]
+            A mapping of visit ID to column index in the filter arrays
+        """
         # Generate filter array to optionally restrict the run to certain
         # subject and visit IDs.
         tree = self.study.tree
@@ -340,30 +636,229 @@ class Processor(object):
         # Add all primary pipelines to the stack along with their prereqs
         for pipeline, req_outputs in zip(pipelines, required_outputs):
             push_on_stack(pipeline, filter_array, req_outputs)
+        return stack, subject_inds, visit_inds
 
-        # Iterate through stack of required pipelines from upstream to
-        # downstream
-        for pipeline, req_outputs, flt_array in reversed(list(stack.values())):
+    def _retained_dir(self, pipelines):
+        """
+        Returns the path of the retained working directory for a workflow,
+        keyed by the static provenance of its pipelines (see
+        Pipeline.static_prov_ref)
+        """
+        key = hashlib.md5('\n'.join(sorted(
+            p.name + ':' + p.static_prov_ref for p in pipelines)).encode()
+        ).hexdigest()
+        return op.join(self.work_dir, self.RETAINED_DIR, key)
+
+    def collect_retained_garbage(self, keep=None):
+        """
+        Deletes the least recently used retained working directories until
+        their combined size is within 'work_dir_budget_gb'
+
+        Parameters
+        ----------
+        keep : str | None
+            A retained directory that shouldn't be deleted (i.e. the one
+            that was just used)
+
+        Returns
+        -------
+        deleted : list[str]
+            The directories that were deleted
+        """
+        retained_base = op.join(self.work_dir, self.RETAINED_DIR)
+        deleted = []
+        if self._work_dir_budget_gb is None or not op.exists(retained_base):
+            return deleted
+        dirs = []
+        for entry in os.scandir(retained_base):
+            if entry.is_dir(follow_symlinks=False):
+                dirs.append((entry.stat().st_mtime, entry.path,
+                             self._dir_size(entry.path)))
+        total = sum(d[2] for d in dirs)
+        budget = self._work_dir_budget_gb * 1e9
+        for _, path, size in sorted(dirs):
+            if total <= budget:
+                break
+            if path == keep:
+                continue
+            logger.info("Deleting retained working directory {} to keep "
+                        "within budget of {} GB".format(
+                            path, self._work_dir_budget_gb))
+            shutil.rmtree(path, ignore_errors=True)
+            deleted.append(path)
+            total -= size
+        return deleted
+
+    @classmethod
+    def _dir_size(cls, path):
+        size = 0
+        for entry in os.scandir(path):
+            if entry.is_dir(follow_symlinks=False):
+                size += cls._dir_size(entry.path)
+            else:
+                size += entry.stat(follow_symlinks=False).st_size
+        return size
+
+    def up_to_date(self, request):
+        """
+        Checks whether a request to run pipelines is up to date, i.e. whether
+        it has been run before (see run_manifest) and the study data hasn't
+        changed since
+
+        Parameters
+        ----------
+        request : dict
+            A JSON-serialisable description of the request, e.g. the names of
+            the derivatives requested and the subject and visit IDs to filter
+
+        Returns
+        -------
+        up_to_date : bool
+            Whether the request is up to date
+        """
+        if not self._run_manifest:
+            return False
+        entry = self._load_manifest().get(self._request_key(request))
+        if not isinstance(entry, dict):
+            return False
+        return entry['state'] == self._state_digest(entry['specs'],
+                                                    entry['records'])
+
+    def _save_up_to_date(self, request, pipelines):
+        """
+        Records the state of the study data after a request has been run in
+        the run manifest, along with the names of the data specs and
+        provenance records the state was taken from so that it can be checked
+        again without constructing the pipelines
+
+        Parameters
+        ----------
+        request : dict
+            A JSON-serialisable description of the request
+        pipelines : list[Pipeline]
+            The pipelines that were run along with their prerequisites
+        """
+        specs = set()
+        records = set()
+        for pipeline in pipelines:
+            specs.update(pipeline.input_names)
+            specs.update(pipeline.output_names)
+            records.update((pipeline.name, o.frequency)
+                           for o in pipeline.outputs)
+        specs = sorted(specs)
+        records = sorted(records)
+        manifest = self._load_manifest()
+        manifest[self._request_key(request)] = {
+            'specs': specs, 'records': records,
+            'state': self._state_digest(specs, records)}
+        manifest_path = op.join(self.work_dir, self.RUN_MANIFEST_FNAME)
+        os.makedirs(self.work_dir, exist_ok=True)
+        # Written to a temporary file and moved into place as other processes
+        # could be reading the manifest concurrently
+        tmp_path = manifest_path + '.' + str(os.getpid()) + '.tmp'
+        with open(tmp_path, 'w') as f:
+            json.dump(manifest, f, indent=2, sort_keys=True)
+        os.replace(tmp_path, manifest_path)
+
+    def _load_manifest(self):
+        try:
+            with open(op.join(self.work_dir, self.RUN_MANIFEST_FNAME)) as f:
+                return json.load(f)
+        except (IOError, ValueError):
+            return {}
+
+    def _request_key(self, request):
+        """
+        Digest of the request along with the study provenance (parameters,
+        inputs, environment etc...) and processor options that determine
+        which derivatives need to be regenerated
+        """
+        return hashlib.md5(json.dumps(
+            {'request': request,
+             'study': self.study.prov,
+             'arcana_version': __version__,
+             'reprocess': self.reprocess,
+             'prov_check': list(self.prov_check),
+             'prov_ignore': list(self.prov_ignore)},
+            sort_keys=True, default=str).encode()).hexdigest()
+
+    def _state_digest(self, spec_names, records):
+        """
+        Digest of the state of the data of a request, i.e. the states of the
+        existing inputs and derivatives of the pipelines (see
+        Repository.fileset_state) and the datetimes of their provenance
+        records in the tree
+
+        Parameters
+        ----------
+        spec_names : list[str]
+            The names of the inputs and outputs of the pipelines
+        records : list[tuple[str, str]]
+            The name and output frequencies of the pipelines
+        """
+        entries = []
+        for spec_name in spec_names:
             try:
-                self._connect_pipeline(
-                    pipeline, req_outputs, workflow, subject_inds, visit_inds,
-                    flt_array, **kwargs)
-            except ArcanaNoRunRequiredException:
-                logger.info("Not running '{}' pipeline as its outputs "
-                            "are already present in the repository"
-                            .format(pipeline.name))
-        # Save complete graph for debugging purposes
-#         workflow.write_graph(graph2use='flat', format='svg')
-#         print('Graph saved in {} directory'.format(os.getcwd()))
-        # Actually run the generated workflow
-        if workflow._get_all_nodes():  # Check if workflow has any nodes to run
-            result = workflow.run(plugin=self._plugin)
-        else:
-            result = None
-        # Reset the cached tree of filesets in the repository as it will
-        # change after the pipeline has run.
-        self.study.clear_caches()
-        return result
+                bound = self.study.bound_spec(spec_name)
+            except ArcanaMissingDataException:
+                continue  # Missing optional input
+            for item in bound.collection:
+                if not item.exists:
+                    continue
+                if not item.is_fileset:
+                    state = item.value
+                elif item.repository is not None:
+                    state = item.repository.fileset_state(item)
+                else:
+                    state = item.checksums
+                entries.append((spec_name, item.subject_id, item.visit_id,
+                                state))
+        for pipeline_name, frequency in records:
+            for node in self.study.tree.nodes(frequency):
+                try:
+                    record = node.record(pipeline_name, self.study.name)
+                except ArcanaNameError:
+                    continue
+                entries.append((pipeline_name, frequency, node.subject_id,
+                                node.visit_id, record.datetime))
+        entries.sort(key=repr)
+        return hashlib.md5(json.dumps(entries, default=str).encode()
+                           ).hexdigest()
+
+    def _sunk_nodes(self, execgraph):
+        """
+        Collects the tree nodes that derivatives were sunk to from the results
+        of the sink nodes in the executed workflow graph
+
+        Parameters
+        ----------
+        execgraph : networkx.DiGraph | None
+            The execution graph returned by the workflow
+
+        Returns
+        -------
+        sunk_nodes : list[tuple[str, str | None, str | None]] | None
+            The frequency, subject ID and visit ID of each node that
+            derivatives were sunk to, or None if they couldn't be determined
+            from the results of the workflow
+        """
+        if execgraph is None:
+            return None
+        sunk_nodes = []
+        for node in execgraph.nodes():
+            if not isinstance(node.interface, RepositorySink):
+                continue
+            try:
+                record = node.result.outputs.record
+            except (IOError, AttributeError):
+                record = None
+            if not isinstance(record, Record):
+                logger.debug("Could not load record sunk by {}, clearing "
+                             "cached trees instead".format(node))
+                return None
+            sunk_nodes.append(
+                (record.frequency, record.subject_id, record.visit_id))
+        return sunk_nodes
 
     def _connect_pipeline(self, pipeline, required_outputs, workflow,
                           subject_inds, visit_inds, filter_array, force=False):
@@ -397,41 +892,16 @@ class Processor(object):
             array, regardless of whether the parameters|pipeline used
             to generate existing data matches the given pipeline
         """
-        if self.reprocess == 'force':
-            force = True
-        # Close-off construction of the pipeline and created, input and output
-        # nodes and provenance dictionary
-        pipeline.cap()
+        to_process_array = self._pipeline_arrays(
+            pipeline, required_outputs, subject_inds, visit_inds,
+            filter_array, force=force)[0]
         # Prepend prerequisite pipelines to complete workflow if they need
         # to be (re)processed
         final_nodes = []
-        # The array that represents the subject/visit pairs for which any
-        # prerequisite pipeline will be (re)processed, and which therefore
-        # needs to be included in the processing of the current pipeline. Row
-        # indices correspond to subjects and column indices visits
-        prqs_to_process_array = np.zeros((len(subject_inds), len(visit_inds)),
-                                         dtype=bool)
-        # The array that represents the subject/visit pairs for which any
-        # prerequisite pipeline will be skipped due to missing inputs. Row
-        # indices correspond to subjects and column indices visits
-        prqs_to_skip_array = np.zeros((len(subject_inds), len(visit_inds)),
-                                      dtype=bool)
         for getter_name in pipeline.prerequisites:
             prereq = pipeline.study.pipeline(getter_name)
             if prereq.to_process_array.any():
                 final_nodes.append(prereq.node('final'))
-                prqs_to_process_array |= prereq.to_process_array
-            prqs_to_skip_array |= prereq.to_skip_array
-        # Get list of sessions that need to be processed (i.e. if
-        # they don't contain the outputs of this pipeline)
-        to_process_array, to_protect_array, to_skip_array = self._to_process(
-            pipeline, required_outputs, prqs_to_process_array,
-            prqs_to_skip_array, filter_array, subject_inds, visit_inds, force)
-        # Store the arrays signifying which nodes to process, protect or skip
-        # so they can be passed to downstream pipelines
-        pipeline.to_process_array = to_process_array
-        pipeline.to_protect_array = to_protect_array
-        pipeline.to_skip_array = to_skip_array
         # Check to see if there are any sessions to process
         if not to_process_array.any():
             raise ArcanaNoRunRequiredException(
@@ -521,14 +991,25 @@ class Processor(object):
                     continue
                 # Loop over iterators that need to be joined, i.e. that are
                 # present in the input frequency but not the output frequency
-                # and create join nodes
+                # and create join nodes. If joins are compacted (without
+                # sidecars) the join nodes reduce the joined checksums to
+                # digests so the full lists aren't passed to the sink
                 source = sources[input_freq]
-                for iterator in (pipeline.iterators(input_freq)
-                                 - pipeline.iterators(freq)):
+                if self._compact_joins and not self._joined_sidecar:
+                    join_interface_cls = JoinChecksums
+                else:
+                    join_interface_cls = IdentityInterface
+                # NB: visits are joined before subjects so the joined
+                # checksums are nested in the same way as the expected
+                # provenance (see Pipeline.expected_record)
+                for iterator in sorted(
+                        pipeline.iterators(input_freq)
+                        - pipeline.iterators(freq),
+                        key=lambda i: i == self.study.SUBJECT_ID):
                     join = pipeline.add(
                         '{}_to_{}_{}_checksum_join'.format(
                             input_freq, freq, iterator),
-                        IdentityInterface(
+                        join_interface_cls(
                             checksums_to_connect),
                         inputs={
                             tc: (source, tc) for tc in checksums_to_connect},
@@ -542,7 +1023,8 @@ class Processor(object):
                 '{}_sink'.format(freq),
                 RepositorySink(
                     (o.collection for o in outputs), pipeline,
-                    required_outputs),
+                    required_outputs, compact_joins=self._compact_joins,
+                    joined_sidecar=self._joined_sidecar),
                 inputs=to_connect)
             # "De-iterate" (join) over iterators to get back to single child
             # node by the time we connect to the final node of the pipeline Set
@@ -696,9 +1178,82 @@ class Processor(object):
                              visit_it, self.study.SUBJECT_ID)
         return iter_nodes
 
+    def _pipeline_arrays(self, pipeline, required_outputs, subject_inds,
+                         visit_inds, filter_array, force=False, reasons=None):
+        """
+        Caps the pipeline and determines the subject/visit pairs it needs to
+        be (re)processed for, taking into account its prerequisites (which
+        need to have been passed to this method first), and stores the
+        resulting arrays in the pipeline so they can be passed to downstream
+        pipelines
+
+        Parameters
+        ----------
+        pipeline : Pipeline
+            The pipeline to determine the sessions to process
+        required_outputs : set[str] | None
+            The outputs required to be produced by this pipeline. If None all
+            are deemed to be required
+        subject_inds : dct[str, int]
+            A mapping of subject ID to row index in the filter array
+        visit_inds : dct[str, int]
+            A mapping of visit ID to column index in the filter array
+        filter_array : 2-D numpy.array[bool]
+            The subject/visit pairs to include in the current round of
+            processing (see _connect_pipeline)
+        force : bool | 'all'
+            A flag to force the processing of all sessions in the filter
+            array (see _connect_pipeline)
+        reasons : list[dict] | None
+            If provided, the reasons that nodes with existing derivatives
+            will be reprocessed or protected are appended to the list instead
+            of raising errors for provenance mismatches (see _to_process)
+
+        Returns
+        -------
+        to_process_array : 2-D numpy.array[bool]
+            The subject/visit pairs to process
+        to_protect_array : 2-D numpy.array[bool]
+            The subject/visit pairs with protected outputs
+        to_skip_array : 2-D numpy.array[bool]
+            The subject/visit pairs to skip due to missing inputs
+        """
+        if self.reprocess == 'force':
+            force = True
+        # Close-off construction of the pipeline and created, input and output
+        # nodes and provenance dictionary
+        pipeline.cap()
+        # The array that represents the subject/visit pairs for which any
+        # prerequisite pipeline will be (re)processed, and which therefore
+        # needs to be included in the processing of the current pipeline. Row
+        # indices correspond to subjects and column indices visits
+        prqs_to_process_array = np.zeros((len(subject_inds), len(visit_inds)),
+                                         dtype=bool)
+        # The array that represents the subject/visit pairs for which any
+        # prerequisite pipeline will be skipped due to missing inputs. Row
+        # indices correspond to subjects and column indices visits
+        prqs_to_skip_array = np.zeros((len(subject_inds), len(visit_inds)),
+                                      dtype=bool)
+        for getter_name in pipeline.prerequisites:
+            prereq = pipeline.study.pipeline(getter_name)
+            prqs_to_process_array |= prereq.to_process_array
+            prqs_to_skip_array |= prereq.to_skip_array
+        # Get list of sessions that need to be processed (i.e. if
+        # they don't contain the outputs of this pipeline)
+        to_process_array, to_protect_array, to_skip_array = self._to_process(
+            pipeline, required_outputs, prqs_to_process_array,
+            prqs_to_skip_array, filter_array, subject_inds, visit_inds, force,
+            reasons=reasons)
+        # Store the arrays signifying which nodes to process, protect or skip
+        # so they can be passed to downstream pipelines
+        pipeline.to_process_array = to_process_array
+        pipeline.to_protect_array = to_protect_array
+        pipeline.to_skip_array = to_skip_array
+        return to_process_array, to_protect_array, to_skip_array
+
     def _to_process(self, pipeline, required_outputs, prqs_to_process_array,
                     to_skip_array, filter_array, subject_inds, visit_inds,
-                    force):
+                    force, reasons=None):
         """
         Check whether the outputs of the pipeline are present in all sessions
         in the project repository and were generated with matching provenance.
@@ -739,6 +1294,12 @@ class Processor(object):
             as it might be dilated by summary outputs (i.e. of frequency
             'per_visit', 'per_subject' or 'per_study'). So we still loop
             through all outputs and treat them like they don't exist
+        reasons : list[dict] | None
+            If provided, the reasons that nodes with existing derivatives
+            will be reprocessed or protected are appended to the list (as
+            dictionaries with 'frequency', 'subject_id', 'visit_id', 'action'
+            and 'reason' keys), and provenance mismatches that would
+            otherwise raise an error are recorded with the 'conflict' action
 
         Returns
         -------
@@ -802,10 +1363,13 @@ class Processor(object):
             # NB: Study inputs that don't have skip_missing set and have
             # missing data should raise an error before this point
             if input.skip_missing:
-                for item in input.collection:
-                    if not item.exists:
-                        to_skip_array[array_inds(item)] = True
-                        to_skip[array_inds(item)].append(item)
+                collection = input.collection
+                missing = ~collection.exists_mask
+                to_skip_array |= collection.as_array(missing, subject_inds,
+                                                     visit_inds)
+                for inds, item in collection.masked_items(
+                        missing, subject_inds, visit_inds):
+                    to_skip[inds].append(item)
         # Dialate array over all iterators that are joined by the pipeline
         to_skip_array = self._dialate_array(to_skip_array, pipeline.joins)
         # Check data tree for missing required outputs
@@ -813,28 +1377,27 @@ class Processor(object):
             # Check to see if output is required by downstream processing
             required = (required_outputs is None
                         or output.name in required_outputs)
-            for item in output.collection:
-                if item.exists:
-                    # Check to see if checksums recorded when derivative
-                    # was generated by previous run match those of current file
-                    # set. If not we assume they have been manually altered and
-                    # therefore should not be overridden
-                    if item.checksums != item.recorded_checksums:
-                        logger.warning(
-                            "Checksums for {} do not match those recorded in "
-                            "provenance. Assuming it has been manually "
-                            "corrected outside of Arcana and will therefore "
-                            "not overwrite. Please delete manually if this "
-                            "is not intended".format(repr(item)))
-                        to_protect_array[array_inds(item)] = True
-                        to_protect[array_inds(item)].append(item)
-                    elif required:
-                        if force:
-                            to_process_array[array_inds(item)] = True
-                        else:
-                            to_check_array[array_inds(item)] = True
-                elif required:
-                    to_process_array[array_inds(item)] = True
+            collection = output.collection
+            # Check to see if checksums recorded when derivatives were
+            # generated by previous runs match those of current filesets. If
+            # not we assume they have been manually altered and therefore
+            # should not be overridden
+            altered = collection.altered_mask
+            to_protect_array |= collection.as_array(altered, subject_inds,
+                                                    visit_inds)
+            for inds, item in collection.masked_items(
+                    altered, subject_inds, visit_inds):
+                to_protect[inds].append(item)
+            if required:
+                exists = collection.exists_mask
+                unaltered = collection.as_array(exists & ~altered,
+                                                subject_inds, visit_inds)
+                if force:
+                    to_process_array |= unaltered
+                else:
+                    to_check_array |= unaltered
+                to_process_array |= collection.as_array(
+                    ~exists, subject_inds, visit_inds)
         # Filter sessions to process by those requested
         to_process_array *= filter_array
         to_check_array *= (filter_array * np.invert(to_process_array))
@@ -859,41 +1422,74 @@ class Processor(object):
                                 if to_check_array[0, visit_inds[v.id]])
             if 'per_study' in output_freqs:
                 to_check.append(tree)
-            for node in to_check:
-                # Generated expected record from current pipeline/repository-
-                # state
-                requires_reprocess = False
+            # Generate expected records from current pipeline/repository-
+            # state
+
+            def expected(node):
                 try:
                     # Retrieve record stored in tree node
                     record = node.record(pipeline.name, pipeline.study.name)
-                    expected_record = pipeline.expected_record(node)
-
-                    # Compare record with expected
-                    mismatches = record.mismatches(expected_record,
-                                                   self.prov_check,
-                                                   self.prov_ignore)
-                    if mismatches:
-                        msg = ("mismatch in provenance:\n{}\n Add mismatching "
-                               "paths (delimeted by '/') to 'prov_ignore' "
-                               "argument of Processor to ignore"
-                               .format(
-                                   pformat(mismatches)))
-                        requires_reprocess = True
-                except ArcanaNameError:
+                    return (node, record,
+                            pipeline.expected_record(node, record), None)
+                except (ArcanaNameError, ArcanaDataNotDerivedYetError) as e:
+                    return (node, None, None, e)
+
+            checks = self._map_checks(expected, to_check)
+            # Find the nodes whose records could mismatch the expected ones
+            # in a single query of the provenance index of the repository
+            # (None if it doesn't maintain one)
+            stale = self.study.repository.stale_nodes(
+                self.study.name, pipeline.name, pipeline.static_prov_ref,
+                [(n.frequency, n.subject_id, n.visit_id, e.prov)
+                 for n, _, e, _ in checks if e is not None])
+            # Compare records with expected, reusing the hash of the static
+            # part of the expected provenance for all nodes
+            static_hash = pipeline.static_prov_hash(self.prov_check,
+                                                    self.prov_ignore)
+            to_compare = [
+                c for c in checks if c[3] is None and (
+                    stale is None or (c[0].frequency, c[0].subject_id,
+                                      c[0].visit_id) in stale)]
+            mismatches = dict(zip(
+                (id(c[0]) for c in to_compare),
+                self._map_checks(
+                    lambda c: c[1].mismatches(
+                        c[2], self.prov_check, self.prov_ignore,
+                        other_static_hash=static_hash),
+                    to_compare)))
+            # Aggregate the results in the order the nodes were checked so
+            # that the decisions and error messages are deterministic
+            for node, record, expected_record, error in checks:
+                requires_reprocess = False
+                if isinstance(error, ArcanaNameError):
                     msg = "missing provenance record"
                     requires_reprocess = False
                     to_protect_array[array_inds(node)] = True
-                except ArcanaDataNotDerivedYetError as e:
+                    if reasons is not None:
+                        reasons.append(self._plan_reason(node, 'protect',
+                                                         msg))
+                elif isinstance(error, ArcanaDataNotDerivedYetError):
                     msg = ("missing input '{}' and therefore cannot check "
-                           "provenance".format(e.name))
+                           "provenance".format(error.name))
+                    requires_reprocess = True
+                elif mismatches.get(id(node)):
+                    msg = ("mismatch in provenance:\n{}\n Add mismatching "
+                           "paths (delimeted by '/') to 'prov_ignore' "
+                           "argument of Processor to ignore"
+                           .format(
+                               pformat(mismatches[id(node)])))
                     requires_reprocess = True
                 if requires_reprocess:
+                    if reasons is not None:
+                        reasons.append(self._plan_reason(
+                            node, 'reprocess' if self.reprocess
+                            else 'conflict', msg))
                     if self.reprocess:
                         to_process_array[array_inds(node)] = True
                         logger.info(
                             "Reprocessing {} with '{}' due to {}"
                             .format(node, pipeline.name, msg))
-                    else:
+                    elif reasons is None:
                         raise ArcanaReprocessException(
                             "Cannot use derivatives for '{}' pipeline stored "
                             "in {} due to {}, set 'reprocess' "
@@ -971,6 +1567,31 @@ class Processor(object):
                                                pipeline.joins)
         return to_process_array, to_protect_array, to_skip_array
 
+    def _map_checks(self, func, items):
+        """
+        Maps a provenance check over the nodes (or intermediate results) to
+        check in parallel threads, so that retrieval of checksums (which is
+        often I/O bound) overlaps between nodes. The results are returned in
+        the order of the items so they can be aggregated deterministically
+
+        Parameters
+        ----------
+        func : callable
+            The check to apply to each item
+        items : list
+            The items to apply the check to
+
+        Returns
+        -------
+        results : list
+            The results of the check for each item
+        """
+        items = list(items)
+        if len(items) > 1 and self._num_check_threads != 1:
+            with ThreadPoolExecutor(self._num_check_threads) as executor:
+                return list(executor.map(func, items))
+        return [func(i) for i in items]
+
     def _dialate_array(self, array, iterators):
         """
         'Dialates' a to_process/to_protect array to include all subject and/or
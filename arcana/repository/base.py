@@ -1,9 +1,13 @@
 from builtins import object
+import os
+import pickle
+from itertools import chain
 from collections import defaultdict
 from abc import ABCMeta, abstractmethod
 import logging
 from .tree import Tree
-from arcana.exceptions import ArcanaUsageError
+from arcana.exceptions import ArcanaUsageError, ArcanaNameError
+from arcana.utils.hashing import DEFAULT_HASH_ALGORITHM
 
 
 logger = logging.getLogger('arcana')
@@ -13,21 +17,93 @@ def defaultdict_of_dict():
     return defaultdict(dict)
 
 
+class _SnapshotPickler(pickle.Pickler):
+    """
+    Pickles the cached trees of a repository, replacing references to the
+    repository itself (i.e. from the items in the trees) with a persistent ID
+    so the repository isn't pickled within its own snapshot
+    """
+
+    def __init__(self, f, repository, **kwargs):
+        super(_SnapshotPickler, self).__init__(f, **kwargs)
+        self._repository = repository
+
+    def persistent_id(self, obj):
+        if obj is self._repository:
+            return 'repository'
+        return None
+
+
+class _SnapshotUnpickler(pickle.Unpickler):
+
+    def __init__(self, f, repository, **kwargs):
+        super(_SnapshotUnpickler, self).__init__(f, **kwargs)
+        self._repository = repository
+
+    def persistent_load(self, pid):
+        if pid == 'repository':
+            return self._repository
+        raise pickle.UnpicklingError(
+            "Unrecognised persistent ID '{}'".format(pid))
+
+
 class Repository(object, metaclass=ABCMeta):
     """
     Abstract base class for all Repository systems, DaRIS, XNAT and
     local file system. Sets out the interface that all Repository
     classes should implement.
+
+    Parameters
+    ----------
+    subject_id_map : dict[str, str] | callable | None
+        Mapping from the subject IDs in the repository to those used in the
+        study
+    visit_id_map : dict[str, str] | callable | None
+        Mapping from the visit IDs in the repository to those used in the
+        study
+    file_formats : list[FileFormat]
+        File formats to detect the filesets in the repository with
+    checksum_algorithm : str
+        The algorithm used to calculate the checksums of filesets in the
+        repository that are saved in provenance records. Can be a hashlib
+        algorithm (e.g. 'md5' or 'sha256') or 'fingerprint' for a fast
+        fingerprint of the file size and sampled blocks of the files. Either
+        can be prefixed with 'merkle-' to only save the root hash of a Merkle
+        tree of the file digests in provenance (e.g. 'merkle-md5'). Can be
+        overridden for specific file formats
+    lazy_tree : bool
+        Whether to only load the subject, visit and session structure of the
+        repository when its tree is created, and load the filesets, fields
+        and provenance records of each node the first time they are accessed.
+        Studies that only use a small subset of the subjects and visits of a
+        large repository then don't need to search the whole repository for
+        data. Note that the whole contents of a node are loaded when any of
+        them are accessed, so there is no benefit for studies that only use
+        a few of the items in each node. Only supported by repositories that
+        can search single nodes efficiently (i.e. override find_node_data)
     """
 
+    # Version of the format of the tree snapshots written by save_snapshot
+    SNAPSHOT_VERSION = 1
+
     def __init__(self, subject_id_map=None, visit_id_map=None,
-                 file_formats=()):
+                 file_formats=(), checksum_algorithm=DEFAULT_HASH_ALGORITHM,
+                 lazy_tree=False):
         self._connection_depth = 0
         self._subject_id_map = subject_id_map
         self._visit_id_map = visit_id_map
         self._inv_subject_id_map = {}
         self._inv_visit_id_map = {}
         self._file_formats = file_formats
+        self._checksum_algorithm = checksum_algorithm
+        if (lazy_tree and
+                type(self).find_node_data is Repository.find_node_data):
+            # Each node would be loaded by searching the whole repository
+            raise ArcanaUsageError(
+                "Lazy trees are not supported by {} repositories as they "
+                "can't search single nodes efficiently".format(
+                    type(self).__name__))
+        self._lazy_tree = lazy_tree
         self.clear_cache()
 
     def __enter__(self):
@@ -46,6 +122,14 @@ class Repository(object, metaclass=ABCMeta):
         if self._connection_depth == 0:
             self.disconnect()
 
+    @property
+    def checksum_algorithm(self):
+        return self._checksum_algorithm
+
+    @property
+    def lazy_tree(self):
+        return self._lazy_tree
+
     def connect(self):
         """
         If a connection session is required to the repository,
@@ -116,7 +200,7 @@ class Repository(object, metaclass=ABCMeta):
             The value of the Field
         """
 
-    def get_checksums(self, fileset):
+    def get_checksums(self, fileset, algorithm=None):
         """
         Returns the checksums for the files in the fileset that are stored in
         the repository. If no checksums are stored in the repository then this
@@ -127,6 +211,9 @@ class Repository(object, metaclass=ABCMeta):
         ----------
         fileset : Fileset
             The fileset to return the checksums for
+        algorithm : str | None
+            The algorithm the checksums should be calculated with. If None
+            the checksum algorithm of the fileset is used
 
         Returns
         -------
@@ -138,6 +225,27 @@ class Repository(object, metaclass=ABCMeta):
         """
         return None
 
+    def fileset_state(self, fileset):
+        """
+        Returns a token of the current state of a fileset that changes when
+        it is modified, used to detect whether the study data has changed
+        since a request was last run (see Processor.run_manifest). Should be
+        overridden by repositories that can generate such tokens more
+        cheaply than the checksums of the fileset
+
+        Parameters
+        ----------
+        fileset : Fileset
+            The fileset to return the state of
+
+        Returns
+        -------
+        state : dict[str, *]
+            A JSON-serialisable token of the state of each file in the
+            fileset
+        """
+        return fileset.checksums
+
     @abstractmethod
     def put_fileset(self, fileset):
         """
@@ -147,6 +255,12 @@ class Repository(object, metaclass=ABCMeta):
         ----------
         fileset : Fileset
             The fileset to insert into the repository
+
+        Returns
+        -------
+        checksums : dict[str, str] | None
+            The checksums of the files in the fileset if they were calculated
+            while transferring them to the repository, otherwise None
         """
 
     @abstractmethod
@@ -160,6 +274,20 @@ class Repository(object, metaclass=ABCMeta):
             The field to insert into the repository
         """
 
+    def put_fields(self, fields):
+        """
+        Inserts or updates multiple fields into the repository. Can be
+        overridden by repositories that can write multiple fields more
+        efficiently than one at a time
+
+        Parameters
+        ----------
+        fields : list[Field]
+            The fields to insert into the repository
+        """
+        for field in fields:
+            self.put_field(field)
+
     @abstractmethod
     def put_record(self, record):
         """
@@ -167,6 +295,23 @@ class Repository(object, metaclass=ABCMeta):
         summary
         """
 
+    def put_joined_prov(self, record, joined):
+        """
+        Saves the full checksums/values of the joined inputs and the joined
+        IDs of a record whose joins were compacted in a sidecar to the
+        record. Should be overridden by repositories that support sidecars.
+
+        Parameters
+        ----------
+        record : arcana.pipeline.provenance.Record
+            The record the joins were compacted in
+        joined : dict[str, dict]
+            The full joined 'inputs' and 'joined_ids' of the record
+        """
+        logger.warning(
+            "{} doesn't support saving the joined provenance of {} in a "
+            "sidecar".format(self, record))
+
     def tree(self, subject_ids=None, visit_ids=None, **kwargs):
         """
         Return the tree of subject and sessions information within a
@@ -187,6 +332,12 @@ class Repository(object, metaclass=ABCMeta):
             A hierarchical tree of subject, session and fileset
             information for the repository
         """
+        if self.lazy_tree:
+            # Only find the sessions present in the repository, their data
+            # is loaded when it is first accessed
+            return Tree.construct_lazy(
+                self, self.find_session_ids(subject_ids=subject_ids,
+                                            visit_ids=visit_ids), **kwargs)
         # Find all data present in the repository (filtered by the passed IDs)
         return Tree.construct(
             self, *self.find_data(subject_ids=subject_ids,
@@ -221,6 +372,8 @@ class Repository(object, metaclass=ABCMeta):
             subject_ids = frozenset(subject_ids)
         if visit_ids is not None:
             visit_ids = frozenset(visit_ids)
+        if self._cache is None:
+            self._load_snapshot()
         try:
             tree = self._cache[subject_ids][visit_ids][fill]
         except KeyError:
@@ -241,6 +394,229 @@ class Repository(object, metaclass=ABCMeta):
 
     def clear_cache(self):
         self._cache = defaultdict(defaultdict_of_dict)
+        self._snapshot_path = None
+
+    def save_snapshot(self, path):
+        """
+        Saves the cached trees of the repository to a versioned snapshot
+        file. Until the cache is next modified, copies of the repository that
+        are pickled (e.g. to send to worker processes) reference the snapshot
+        instead of containing the cached trees, and load the trees from it
+        the first time they are accessed instead of searching the repository
+        again
+
+        Parameters
+        ----------
+        path : str
+            The path to save the snapshot at
+        """
+        if self._cache is None:
+            self._load_snapshot()
+        tmp_path = path + '.tmp'
+        with open(tmp_path, 'wb') as f:
+            pickle.dump(self.SNAPSHOT_VERSION, f)
+            _SnapshotPickler(
+                f, self, protocol=pickle.HIGHEST_PROTOCOL).dump(self._cache)
+        os.replace(tmp_path, path)
+        self._snapshot_path = path
+
+    @property
+    def snapshot_path(self):
+        return self._snapshot_path
+
+    def _load_snapshot(self):
+        """
+        Loads the cached trees from the snapshot the repository references,
+        falling back to an empty cache if it can't be loaded
+        """
+        path = self._snapshot_path
+        try:
+            with open(path, 'rb') as f:
+                version = pickle.load(f)
+                if version != self.SNAPSHOT_VERSION:
+                    raise ArcanaUsageError(
+                        "Incompatible version of tree snapshot ({}), "
+                        "expected {}".format(version, self.SNAPSHOT_VERSION))
+                self._cache = _SnapshotUnpickler(f, self).load()
+        except (IOError, pickle.UnpicklingError, ArcanaUsageError) as e:
+            logger.warning("Could not load tree snapshot from '{}' ({}), "
+                           "the repository will be searched again"
+                           .format(path, e))
+            self.clear_cache()
+
+    def __getstate__(self):
+        dct = self.__dict__.copy()
+        if self._snapshot_path is not None:
+            # The cached trees are loaded from the snapshot when required
+            dct['_cache'] = None
+        return dct
+
+    def find_node_data(self, frequency, subject_id=None, visit_id=None):
+        """
+        Find the data stored within a single node of the repository. Can be
+        overridden by repositories that can search single nodes more
+        efficiently than filtering the IDs passed to find_data, which is
+        required to support lazy trees (see lazy_tree)
+
+        Parameters
+        ----------
+        frequency : str
+            The frequency of the node
+        subject_id : str | None
+            The subject ID of the node (in the ID space of the study)
+        visit_id : str | None
+            The visit ID of the node (in the ID space of the study)
+
+        Returns
+        -------
+        filesets : list[Fileset]
+            The filesets found in the node
+        fields : list[Field]
+            The fields found in the node
+        records : list[Record]
+            The provenance records found in the node
+        """
+        subject_ids = ([self.inv_map_subject_id(subject_id)]
+                       if subject_id is not None else None)
+        visit_ids = ([self.inv_map_visit_id(visit_id)]
+                     if visit_id is not None else None)
+        return tuple(
+            [i for i in items
+             if (i.frequency == frequency and i.subject_id == subject_id and
+                 i.visit_id == visit_id)]
+            for items in self.find_data(subject_ids=subject_ids,
+                                        visit_ids=visit_ids))
+
+    def find_nodes_data(self, nodes):
+        """
+        Find the data stored within multiple nodes of the repository with a
+        single call to find_data, filtered by the IDs of the nodes. Can be
+        overridden by repositories that can search single nodes efficiently
+        (see find_node_data)
+
+        Parameters
+        ----------
+        nodes : iterable[tuple[str, str | None, str | None]]
+            The frequency, subject ID and visit ID of the nodes (in the ID
+            space of the study)
+
+        Returns
+        -------
+        data : dict[tuple[str, str | None, str | None], tuple[list]]
+            The filesets, fields and provenance records found in each node
+        """
+        nodes = set(nodes)
+        data = {n: ([], [], []) for n in nodes}
+        if not nodes:
+            return data
+        # Summary nodes (with None IDs) aren't excluded by the ID filters
+        subject_ids = [self.inv_map_subject_id(s)
+                       for s in set(s for _, s, _ in nodes) if s is not None]
+        visit_ids = [self.inv_map_visit_id(v)
+                     for v in set(v for _, _, v in nodes) if v is not None]
+        for i, items in enumerate(self.find_data(subject_ids=subject_ids,
+                                                 visit_ids=visit_ids)):
+            for item in items:
+                try:
+                    node_data = data[(item.frequency, item.subject_id,
+                                      item.visit_id)]
+                except KeyError:
+                    continue  # Node matching the ID filters wasn't requested
+                node_data[i].append(item)
+        return data
+
+    def find_session_ids(self, subject_ids=None, visit_ids=None):
+        """
+        Find the subject and visit IDs of the sessions within the repository,
+        used to construct lazy trees. Should be overridden by repositories
+        that can list their sessions without searching for all their data
+
+        Parameters
+        ----------
+        subject_ids : list(str)
+            List of subject IDs with which to filter the sessions with. If
+            None all are returned
+        visit_ids : list(str)
+            List of visit IDs with which to filter the sessions with. If
+            None all are returned
+
+        Returns
+        -------
+        session_ids : list[tuple[str, str]]
+            The subject and visit IDs (in the ID space of the study) of the
+            sessions found in the repository
+        """
+        return list(set(
+            (i.subject_id, i.visit_id)
+            for i in chain(*self.find_data(subject_ids=subject_ids,
+                                           visit_ids=visit_ids))
+            if i.subject_id is not None and i.visit_id is not None))
+
+    def stale_nodes(self, study_name, pipeline_name, static_ref, expected):
+        """
+        Finds the nodes whose provenance records for a pipeline don't match
+        the expected provenance from an index of the records, without
+        loading them. Should be overridden by repositories that maintain
+        such an index.
+
+        Parameters
+        ----------
+        study_name : str
+            Name of the study the records were generated by
+        pipeline_name : str
+            Name of the pipeline that generated the records
+        static_ref : str
+            Reference to the expected provenance sections that are the same
+            for all nodes (see arcana.pipeline.provenance.static_prov_ref)
+        expected : list[tuple[str, str | None, str | None, dict]]
+            The frequency, subject ID, visit ID and expected provenance of
+            each node to check
+
+        Returns
+        -------
+        stale : set[tuple[str, str | None, str | None]] | None
+            The frequency, subject ID and visit ID of the nodes whose records
+            don't match exactly (and therefore need to be compared in full),
+            or None if the repository doesn't maintain an index of its
+            provenance records
+        """
+        return None
+
+    def update_cache(self, nodes):
+        """
+        Updates the cached trees in place with the current contents of the
+        given nodes, e.g. after derivatives have been sunk into them, instead
+        of clearing the cache and rescanning the whole repository. Cached
+        trees that don't contain one of the nodes are dropped from the cache
+        so that they are regenerated on their next access.
+
+        Parameters
+        ----------
+        nodes : iterable[tuple[str, str | None, str | None]]
+            The frequency, subject ID and visit ID of the nodes to update
+        """
+        if self._cache is None:
+            self._load_snapshot()
+        # The cached trees will no longer match the snapshot
+        self._snapshot_path = None
+        cached = [(s, v, f, t) for s, dct in self._cache.items()
+                  for v, fdct in dct.items() for f, t in fdct.items()]
+        trees = list({id(t): t for _, _, _, t in cached}.values())
+        stale = set()
+        nodes_data = self.find_nodes_data(nodes)
+        for (frequency, subject_id, visit_id), data in nodes_data.items():
+            for tree in trees:
+                if id(tree) in stale:
+                    continue
+                try:
+                    node = tree.node(frequency, subject_id, visit_id)
+                except ArcanaNameError:
+                    stale.add(id(tree))
+                else:
+                    node._set_data(*data)
+        for subject_ids, visit_ids, fill, tree in cached:
+            if id(tree) in stale:
+                del self._cache[subject_ids][visit_ids][fill]
 
     def __ne__(self, other):
         return not (self == other)
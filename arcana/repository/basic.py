@@ -3,23 +3,38 @@ import errno
 import os.path as op
 from itertools import chain
 from .base import Repository
+from .index import RepositoryIndex
 import stat
 import shutil
 import logging
 import json
-from fasteners import InterProcessLock
+from collections import OrderedDict
+from functools import partial
+from concurrent.futures import ThreadPoolExecutor
+from fasteners import InterProcessReaderWriterLock
+try:
+    import fcntl
+except ImportError:
+    fcntl = None  # Reflinks are only supported on POSIX systems
 from arcana.data import Fileset, Field
-from arcana.pipeline.provenance import Record
+from arcana.pipeline.provenance import Record, STATIC_PROV_DIR
 from arcana.exceptions import (
     ArcanaError, ArcanaUsageError,
     ArcanaRepositoryError,
     ArcanaMissingDataException,
     ArcanaInsufficientRepoDepthError)
-from arcana.utils import get_class_info, HOSTNAME, split_extension
+from arcana.utils import (
+    get_class_info, HOSTNAME, split_extension, copy_and_hash,
+    copy_and_hash_files, hash_files)
+from arcana.utils.hashing import (
+    DEFAULT_HASH_ALGORITHM, leaf_algorithm, combine_checksums)
 
 
 logger = logging.getLogger('arcana')
 
+# The ioctl request code to clone a file (i.e. create a reflink) on Linux
+FICLONE = 0x40049409
+
 
 class BasicRepo(Repository):
     """
@@ -42,26 +57,95 @@ class BasicRepo(Repository):
         sub-directories for each subject, and if depth == 2 there is
         an additional layer of sub-directories for each visit of each
         subject.
+    num_scan_threads : int | None
+        The number of threads used to scan the sub-directory trees of
+        separate subjects in parallel when searching for data. If None the
+        default of concurrent.futures.ThreadPoolExecutor is used
+    index : bool
+        Whether to maintain a persistent index of the directory listings,
+        fields and provenance records of the repository in a SQLite database
+        in the root directory. When searching for data, only the directories
+        and files that have been modified since they were indexed are read
+        again. The guessed depth of the repository is also stored in the
+        index so it doesn't need to be guessed again
+    cache_checksums : bool
+        Whether to cache the checksums of the files in the repository in
+        the SQLite database in the root directory (see 'index'), keyed by
+        their path, size, modification time and inode, so unchanged files
+        don't need to be hashed again when checking provenance
+    sink_strategy : str
+        How derivatives are committed to the repository from the working
+        directory. Can be one of
+            'copy': copy the files (default)
+            'hardlink': create hard links to the files
+            'reflink': create copy-on-write clones of the files (on
+                       file-systems that support them, e.g. Btrfs, XFS)
+            'move': move the files into the repository
+        If the selected strategy is not possible (e.g. the working directory
+        is on a different file-system) the files are copied instead. Note
+        that with the 'hardlink' strategy the working directory and
+        repository files share the same data, so they shouldn't be modified
+        in place, and with the 'move' strategy the outputs are removed from
+        the working directory
+    dedup_prov : bool
+        Whether to store the sections of the provenance records that are the
+        same for all nodes of a pipeline (e.g. the workflow graph and study
+        parameters) once, under the hash of their content in a hidden
+        directory in the root directory, and only save references to them in
+        the records of each node
     """
 
     type = 'directory'
     SUMMARY_NAME = '__ALL__'
     FIELDS_FNAME = 'fields.json'
     PROV_DIR = '__prov__'
+    JOINED_PROV_SUFFIX = '.joined.json'
     LOCK_SUFFIX = '.lock'
+    TMP_SUFFIX = '.arcana_tmp'
+    OLD_SUFFIX = '.arcana_old'
+    SINK_STRATEGIES = ('copy', 'hardlink', 'reflink', 'move')
+    INDEX_FNAME = '.arcana_index.db'
+    STATIC_PROV_DIR = STATIC_PROV_DIR
     DEFAULT_SUBJECT_ID = 'SUBJECT'
     DEFAULT_VISIT_ID = 'VISIT'
     MAX_DEPTH = 2
 
-    def __init__(self, root_dir, depth=None, **kwargs):
+    def __init__(self, root_dir, depth=None, num_scan_threads=None,
+                 index=False, cache_checksums=False, sink_strategy='copy',
+                 dedup_prov=False, **kwargs):
         super(BasicRepo, self).__init__(**kwargs)
         if not op.exists(root_dir):
             raise ArcanaError(
                 "Base directory for BasicRepo '{}' does not exist"
                 .format(root_dir))
         self._root_dir = op.abspath(root_dir)
+        self._num_scan_threads = num_scan_threads
+        if sink_strategy not in self.SINK_STRATEGIES:
+            raise ArcanaUsageError(
+                "Unrecognised sink strategy '{}', can be one of '{}'"
+                .format(sink_strategy, "', '".join(self.SINK_STRATEGIES)))
+        self._sink_strategy = sink_strategy
+        self._dedup_prov = dedup_prov
+        # Static provenance sections loaded by their (content hash) reference
+        self._static_provs = {}
+        # Field values put within a connection context, which are written
+        # in a single batch per fields JSON on disconnect
+        self._pending_fields = None
+        if index or cache_checksums:
+            db = RepositoryIndex(op.join(self._root_dir, self.INDEX_FNAME))
+        else:
+            db = None
+        self._index = db if index else None
+        self._checksum_cache = db if cache_checksums else None
         if depth is None:
-            depth = self.guess_depth(root_dir)
+            if self._index is not None:
+                depth = self._index.get_meta('depth')
+            if depth is None:
+                depth = self.guess_depth(root_dir)
+                if self._index is not None:
+                    self._index.set_meta('depth', depth)
+            else:
+                depth = int(depth)
         self._depth = depth
 
     def __repr__(self):
@@ -92,6 +176,18 @@ class BasicRepo(Repository):
     def depth(self):
         return self._depth
 
+    @property
+    def index(self):
+        return self._index
+
+    @property
+    def sink_strategy(self):
+        return self._sink_strategy
+
+    @property
+    def dedup_prov(self):
+        return self._dedup_prov
+
     def get_fileset(self, fileset):
         """
         Set the path of the fileset from the repository
@@ -119,59 +215,311 @@ class BasicRepo(Repository):
         """
         Update the value of the field from the repository
         """
-        # Load fields JSON, locking to prevent read/write conflicts
-        # Would be better if only checked if locked to allow
-        # concurrent reads but not possible with multi-process
-        # locks (in my understanding at least).
         fpath = self.fields_json_path(field)
         try:
-            with InterProcessLock(fpath + self.LOCK_SUFFIX,
-                                  logger=logger), open(fpath, 'r') as f:
-                dct = json.load(f)
-            val = dct[field.name]
-            if field.array:
-                val = [field.dtype(v) for v in val]
-            else:
-                val = field.dtype(val)
-        except (KeyError, IOError) as e:
+            val = self._pending_fields[fpath][field.name]
+        except (TypeError, KeyError):
+            # Load fields JSON, holding a shared lock to prevent it being
+            # read while it is being written (concurrent reads are fine)
             try:
-                # Check to see if the IOError wasn't just because of a
-                # missing file
-                if e.errno != errno.ENOENT:
-                    raise
-            except AttributeError:
-                pass
-            raise ArcanaMissingDataException(
-                "{} does not exist in the local repository {}"
-                .format(field.name, self))
+                with self._fields_lock(fpath).read_lock(), open(fpath,
+                                                                'r') as f:
+                    dct = json.load(f)
+                val = dct[field.name]
+            except (KeyError, IOError) as e:
+                try:
+                    # Check to see if the IOError wasn't just because of a
+                    # missing file
+                    if e.errno != errno.ENOENT:
+                        raise
+                except AttributeError:
+                    pass
+                raise ArcanaMissingDataException(
+                    "{} does not exist in the local repository {}"
+                    .format(field.name, self))
+        if field.array:
+            val = [field.dtype(v) for v in val]
+        else:
+            val = field.dtype(val)
         return val
 
+    def get_checksums(self, fileset, algorithm=None):
+        """
+        Returns the checksums of the files in the fileset, only hashing the
+        files that have changed since they were added to the checksum cache
+        (if the checksum cache is enabled)
+        """
+        if self._checksum_cache is None:
+            return None
+        if algorithm is None:
+            algorithm = fileset.checksum_algorithm
+        # Only the digests of the individual files are cached, as the Merkle
+        # root of a directory can be cheaply recalculated from them
+        file_algorithm = leaf_algorithm(algorithm)
+        base_path = fileset.path
+        stats = OrderedDict((p, os.stat(p)) for p in fileset.paths)
+        relpaths = {p: self._relpath(p) for p in stats}
+        cached = self._checksum_cache.digests(relpaths.values(),
+                                              file_algorithm)
+        digests = {}
+        for path, st in stats.items():
+            try:
+                size, mtime_ns, inode, indexed_ns, digest = cached[
+                    relpaths[path]]
+            except KeyError:
+                continue
+            if ((size, mtime_ns, inode) == (st.st_size, st.st_mtime_ns,
+                                            st.st_ino) and
+                    RepositoryIndex.trusted(mtime_ns, indexed_ns)):
+                digests[path] = digest
+        to_hash = [p for p in stats if p not in digests]
+        if to_hash:
+            indexed_ns = RepositoryIndex.now()
+            hashed = hash_files(to_hash, algorithm=file_algorithm)
+            digests.update(hashed)
+            self._checksum_cache.update_digests(
+                [(relpaths[p], stats[p].st_size, stats[p].st_mtime_ns,
+                  stats[p].st_ino, indexed_ns, d) for p, d in hashed.items()],
+                file_algorithm)
+        return combine_checksums(
+            {op.relpath(p, base_path): digests[p] for p in stats}, algorithm)
+
+    def fileset_state(self, fileset):
+        """
+        Returns the digests of the files in the fileset from the checksum
+        cache where they are trusted, otherwise the size, modification time
+        and inode of the files, so that the files don't need to be hashed
+        (see Repository.fileset_state)
+        """
+        stats = OrderedDict((self._relpath(p), os.stat(p))
+                            for p in fileset.paths)
+        if self._checksum_cache is not None:
+            cached = self._checksum_cache.digests(
+                stats.keys(), leaf_algorithm(fileset.checksum_algorithm))
+        else:
+            cached = {}
+        state = {}
+        for relpath, st in stats.items():
+            file_state = (st.st_size, st.st_mtime_ns, st.st_ino)
+            try:
+                size, mtime_ns, inode, indexed_ns, digest = cached[relpath]
+            except KeyError:
+                pass
+            else:
+                if ((size, mtime_ns, inode) == file_state and
+                        RepositoryIndex.trusted(mtime_ns, indexed_ns)):
+                    file_state = digest
+            state[relpath] = file_state
+        return state
+
     def put_fileset(self, fileset):
         """
-        Inserts or updates a fileset in the repository
+        Inserts or updates a fileset in the repository. Files that are
+        copied are hashed while they are copied, in which case the checksums
+        of the fileset are returned
         """
         target_path = self.fileset_path(fileset)
-        if op.isfile(fileset.path):
-            shutil.copyfile(fileset.path, target_path)
-            # Copy side car files into repository
-            for aux_name, aux_path in fileset.format.default_aux_file_paths(
-                    target_path).items():
-                shutil.copyfile(fileset.format.aux_files[aux_name], aux_path)
-        elif op.isdir(fileset.path):
-            if op.exists(target_path):
-                shutil.rmtree(target_path)
-            shutil.copytree(fileset.path, target_path)
+        src_path = fileset.path
+        algorithm = leaf_algorithm(fileset.checksum_algorithm)
+        digests = {}
+        if op.isfile(src_path):
+            target_aux_files = fileset.format.default_aux_file_paths(
+                target_path)
+            self._commit(src_path, target_path, digests, algorithm)
+            # Commit side car files into repository
+            for aux_name, aux_path in target_aux_files.items():
+                self._commit(fileset.aux_files[aux_name], aux_path, digests,
+                             algorithm)
+        elif op.isdir(src_path):
+            target_aux_files = {}
+            self._commit(src_path, target_path, digests, algorithm)
         else:
             assert False
+        if self._sink_strategy == 'move':
+            # The original paths no longer exist so point the fileset to the
+            # files in the repository
+            fileset._path = target_path
+            fileset._aux_files = target_aux_files
+        if self._index is not None:
+            self._index.update_listings(
+                [], remove=[self._relpath(op.dirname(target_path))])
+        if None in digests.values():
+            # Not all files were copied
+            return None
+        return combine_checksums(
+            {op.relpath(p, src_path): d for p, d in digests.items()},
+            fileset.checksum_algorithm)
+
+    def _commit(self, src_path, target_path, digests=None,
+                algorithm=DEFAULT_HASH_ALGORITHM):
+        """
+        Transfers a file or directory into the repository using the sink
+        strategy of the repository. The file or directory is first
+        transferred to a hidden temporary path alongside the target path and
+        then renamed into place, so the target path is never left partially
+        written. The digests of copied files are inserted into `digests`
+        (keyed by source path), with None for files that weren't copied
+        """
+        dname, fname = op.split(target_path)
+        tmp_path = op.join(dname, '.' + fname + self.TMP_SUFFIX)
+        self._remove(tmp_path)
+        if op.isdir(src_path):
+            if self._sink_strategy == 'move' and self._move(src_path,
+                                                            tmp_path):
+                if digests is not None:
+                    digests[src_path] = None
+            else:
+                # Files that need to be copied are collected while the
+                # directory structure is created and then copied in parallel
+                to_copy = []
+                shutil.copytree(src_path, tmp_path,
+                                copy_function=partial(self._transfer_file,
+                                                      digests=digests,
+                                                      to_copy=to_copy))
+                copied_digests = copy_and_hash_files(to_copy,
+                                                     algorithm=algorithm)
+                if digests is not None:
+                    for (src, _), digest in zip(to_copy, copied_digests):
+                        digests[src] = digest
+            if op.exists(target_path):
+                # Directories can't be replaced atomically so move the
+                # existing directory out of the way first
+                old_path = op.join(dname, '.' + fname + self.OLD_SUFFIX)
+                self._remove(old_path)
+                os.rename(target_path, old_path)
+                os.rename(tmp_path, target_path)
+                shutil.rmtree(old_path)
+            else:
+                os.rename(tmp_path, target_path)
+        else:
+            self._transfer_file(src_path, tmp_path, digests=digests,
+                                algorithm=algorithm)
+            os.replace(tmp_path, target_path)
+
+    def _transfer_file(self, src_path, dst_path, digests=None, to_copy=None,
+                       algorithm=DEFAULT_HASH_ALGORITHM):
+        """
+        Transfers a single file using the sink strategy of the repository,
+        falling back to copying it if the strategy isn't possible. Copied
+        files are hashed while they are copied, or if `to_copy` is provided,
+        appended to it to be copied later.
+        """
+        if digests is not None:
+            digests[src_path] = None
+        if self._sink_strategy == 'hardlink':
+            try:
+                os.link(src_path, dst_path)
+                return dst_path
+            except OSError as e:
+                logger.debug("Could not hard link '{}' to '{}' ({}), copying "
+                             "instead".format(src_path, dst_path, e))
+        elif self._sink_strategy == 'reflink':
+            try:
+                self._reflink(src_path, dst_path)
+                return dst_path
+            except OSError as e:
+                logger.debug("Could not reflink '{}' to '{}' ({}), copying "
+                             "instead".format(src_path, dst_path, e))
+        elif self._sink_strategy == 'move':
+            if self._move(src_path, dst_path):
+                return dst_path
+        if to_copy is not None:
+            to_copy.append((src_path, dst_path))
+        elif digests is not None:
+            digests[src_path] = copy_and_hash(src_path, dst_path,
+                                              algorithm=algorithm)
+        else:
+            shutil.copyfile(src_path, dst_path)
+        return dst_path
+
+    @classmethod
+    def _move(cls, src_path, dst_path):
+        try:
+            os.rename(src_path, dst_path)
+        except OSError as e:
+            logger.debug("Could not move '{}' to '{}' ({}), copying instead"
+                         .format(src_path, dst_path, e))
+            return False
+        return True
+
+    @classmethod
+    def _reflink(cls, src_path, dst_path):
+        if fcntl is None:
+            raise OSError(errno.ENOTSUP,
+                          "Reflinks are not supported on this platform")
+        try:
+            with open(src_path, 'rb') as src, open(dst_path, 'wb') as dst:
+                fcntl.ioctl(dst.fileno(), FICLONE, src.fileno())
+        except (OSError, IOError):
+            cls._remove(dst_path)
+            raise
+
+    @classmethod
+    def _remove(cls, path):
+        if op.isdir(path) and not op.islink(path):
+            shutil.rmtree(path)
+        elif op.lexists(path):
+            os.remove(path)
 
     def put_field(self, field):
         """
-        Inserts or updates a field in the repository
+        Inserts or updates a field in the repository. Within a connection
+        context (i.e. 'with repository:') the write is deferred until the
+        context is exited so that all fields of a session are written in one
+        go
         """
         fpath = self.fields_json_path(field)
-        # Open fields JSON, locking to prevent other processes
-        # reading or writing
-        with InterProcessLock(fpath + self.LOCK_SUFFIX, logger=logger):
+        if field.array:
+            value = list(field.value)
+        else:
+            value = field.value
+        if self._pending_fields is not None:
+            try:
+                self._pending_fields[fpath][field.name] = value
+            except KeyError:
+                self._pending_fields[fpath] = OrderedDict(
+                    [(field.name, value)])
+        else:
+            self._write_fields(fpath, {field.name: value})
+
+    def put_fields(self, fields):
+        """
+        Inserts or updates multiple fields in the repository, reading and
+        writing each fields JSON file only once
+        """
+        to_write = OrderedDict()
+        for field in fields:
+            fpath = self.fields_json_path(field)
+            if field.array:
+                value = list(field.value)
+            else:
+                value = field.value
+            to_write.setdefault(fpath, OrderedDict())[field.name] = value
+        for fpath, values in to_write.items():
+            self._write_fields(fpath, values)
+
+    def connect(self):
+        self._pending_fields = OrderedDict()
+
+    def disconnect(self):
+        self._flush_fields()
+        self._pending_fields = None
+
+    def _flush_fields(self):
+        if self._pending_fields:
+            pending = self._pending_fields
+            self._pending_fields = OrderedDict()
+            for fpath, values in pending.items():
+                self._write_fields(fpath, values)
+
+    def _write_fields(self, fpath, values):
+        """
+        Updates the values in a fields JSON file, holding an exclusive lock
+        to prevent other processes reading or writing it at the same time.
+        The updated file is written to a temporary file first and then
+        moved into place so it is never left partially written
+        """
+        with self._fields_lock(fpath).write_lock():
             try:
                 with open(fpath, 'r') as f:
                     dct = json.load(f)
@@ -180,18 +528,54 @@ class BasicRepo(Repository):
                     dct = {}
                 else:
                     raise
-            if field.array:
-                dct[field.name] = list(field.value)
-            else:
-                dct[field.name] = field.value
-            with open(fpath, 'w') as f:
+            dct.update(values)
+            tmp_path = fpath + '.tmp'
+            with open(tmp_path, 'w') as f:
                 json.dump(dct, f, indent=2)
+            os.replace(tmp_path, fpath)
+            if self._index is not None:
+                self._index.update_documents([],
+                                             remove=[self._relpath(fpath)])
+
+    def _fields_lock(self, fpath):
+        return InterProcessReaderWriterLock(fpath + self.LOCK_SUFFIX,
+                                            logger=logger)
 
     def put_record(self, record):
+        # Write any pending fields first so they are present before the
+        # provenance record that refers to them
+        self._flush_fields()
         fpath = self.prov_json_path(record)
         if not op.exists(op.dirname(fpath)):
             os.mkdir(op.dirname(fpath))
-        record.save(fpath)
+        if self._dedup_prov or self._index is not None:
+            static_ref, static = record.static_prov()
+        if self._dedup_prov:
+            static_path = self._static_prov_path(static_ref)
+            if not op.exists(static_path):
+                os.makedirs(op.dirname(static_path), exist_ok=True)
+                # Write to a temporary file first as records of other nodes
+                # could be saving the same static provenance concurrently
+                tmp_path = static_path + '.' + str(os.getpid()) + '.tmp'
+                with open(tmp_path, 'w') as f:
+                    json.dump(static, f, indent=2)
+                os.replace(tmp_path, static_path)
+            record.save(fpath, static_ref=static_ref)
+        else:
+            record.save(fpath)
+        if self._index is not None:
+            relpath = self._relpath(fpath)
+            self._index.update_documents([], remove=[relpath])
+            self._index.update_provenance([RepositoryIndex.provenance_entry(
+                relpath, record.from_study, record.pipeline_name,
+                record.frequency, self.inv_map_subject_id(record.subject_id),
+                self.inv_map_visit_id(record.visit_id), record.prov,
+                static_ref)])
+
+    def put_joined_prov(self, record, joined):
+        fpath = self.joined_prov_path(record)
+        with open(fpath, 'w') as f:
+            json.dump(joined, f, indent=2)
 
     def find_data(self, subject_ids=None, visit_ids=None, **kwargs):
         """
@@ -217,10 +601,167 @@ class BasicRepo(Repository):
         records : list[Record]
             The provenance records found in the repository
         """
+        # Make sure any deferred field writes are included
+        self._flush_fields()
+        # Only need to scan down to the sub-directories of derived study
+        # directories (i.e. to detect provenance dirs) as deeper directories
+        # belong to directory filesets
+        walked = self._walk(max_depth=self._depth + 2)
+        listings = {p: (d, f) for p, d, f in walked}
+        if self._index is not None:
+            documents = self._index.documents()
+            doc_updates = []
+            doc_paths = set()
+            prov_updates = []
+        else:
+            documents = doc_updates = doc_paths = prov_updates = None
+        all_filesets, all_fields, all_records = self._find_in_dirs(
+            walked, listings, subject_ids=subject_ids, visit_ids=visit_ids,
+            documents=documents, doc_updates=doc_updates,
+            doc_paths=doc_paths, prov_updates=prov_updates, **kwargs)
+        # Only prune documents that weren't found from the index if the whole
+        # repository was searched
+        if self._index is not None:
+            removed = ([p for p in documents if p not in doc_paths]
+                       if subject_ids is None and visit_ids is None else [])
+            self._index.update_documents(doc_updates, remove=removed)
+            self._index.update_provenance(prov_updates, remove=removed)
+        return all_filesets, all_fields, all_records
+
+    def find_node_data(self, frequency, subject_id=None, visit_id=None):
+        """
+        Find the data stored within a single node of the repository by only
+        scanning the directory of the node (and its derived study
+        sub-directories)
+
+        Parameters
+        ----------
+        frequency : str
+            The frequency of the node
+        subject_id : str | None
+            The subject ID of the node (in the ID space of the study)
+        visit_id : str | None
+            The visit ID of the node (in the ID space of the study)
+
+        Returns
+        -------
+        filesets : list[Fileset]
+            The filesets found in the node
+        fields : list[Field]
+            The fields found in the node
+        records : list[Record]
+            The provenance records found in the node
+        """
+        self._flush_fields()
+        try:
+            node_dir = self._node_dir(
+                frequency, self.inv_map_subject_id(subject_id),
+                self.inv_map_visit_id(visit_id))
+        except ArcanaInsufficientRepoDepthError:
+            return [], [], []
+        walked = self._walk_subtree(node_dir, depth=0, max_depth=2,
+                                    list_dir=self._list_dir)
+        listings = {p: (d, f) for p, d, f in walked}
+        if self._index is not None:
+            # Only query the entries of the index under the node directory
+            index_prefix = self._relpath(node_dir)
+            documents = self._index.documents(prefix=index_prefix)
+            doc_updates = []
+            doc_paths = set()
+            prov_updates = []
+        else:
+            index_prefix = None
+            documents = doc_updates = doc_paths = prov_updates = None
+        data = self._find_in_dirs(walked, listings, documents=documents,
+                                  doc_updates=doc_updates,
+                                  doc_paths=doc_paths,
+                                  prov_updates=prov_updates,
+                                  index_prefix=index_prefix)
+        if self._index is not None:
+            self._index.update_documents(doc_updates)
+            self._index.update_provenance(prov_updates)
+        return tuple(
+            [i for i in items
+             if (i.frequency == frequency and i.subject_id == subject_id and
+                 i.visit_id == visit_id)]
+            for items in data)
+
+    def find_nodes_data(self, nodes):
+        """
+        Find the data stored within multiple nodes of the repository by only
+        scanning their directories (see find_node_data)
+
+        Parameters
+        ----------
+        nodes : iterable[tuple[str, str | None, str | None]]
+            The frequency, subject ID and visit ID of the nodes (in the ID
+            space of the study)
+
+        Returns
+        -------
+        data : dict[tuple[str, str | None, str | None], tuple[list]]
+            The filesets, fields and provenance records found in each node
+        """
+        return {n: self.find_node_data(*n) for n in set(nodes)}
+
+    def find_session_ids(self, subject_ids=None, visit_ids=None):
+        """
+        Find the subject and visit IDs of the sessions within the repository
+        by only listing the subject and visit directories
+
+        Parameters
+        ----------
+        subject_ids : list(str)
+            List of subject IDs with which to filter the sessions with. If
+            None all are returned
+        visit_ids : list(str)
+            List of visit IDs with which to filter the sessions with. If
+            None all are returned
+
+        Returns
+        -------
+        session_ids : list[tuple[str, str]]
+            The subject and visit IDs (in the ID space of the study) of the
+            sessions found in the repository
+        """
+        if self._depth == 2:
+            ids = []
+            listing = self._list_dir(self.root_dir)
+            for subj_id in (listing[2] if listing is not None else []):
+                listing = self._list_dir(op.join(self.root_dir, subj_id))
+                if listing is not None:
+                    ids.extend((subj_id, v) for v in listing[2])
+        elif self._depth == 1:
+            listing = self._list_dir(self.root_dir)
+            ids = [(s, self.DEFAULT_VISIT_ID)
+                   for s in (listing[2] if listing is not None else [])]
+        else:
+            ids = [(self.DEFAULT_SUBJECT_ID, self.DEFAULT_VISIT_ID)]
+        return [
+            (self.map_subject_id(s), self.map_visit_id(v)) for s, v in ids
+            if (self.SUMMARY_NAME not in (s, v) and
+                not (s.startswith('.') or v.startswith('.')) and
+                (subject_ids is None or s in subject_ids) and
+                (visit_ids is None or v in visit_ids))]
+
+    def _find_in_dirs(self, walked, listings, subject_ids=None,
+                      visit_ids=None, documents=None, doc_updates=None,
+                      doc_paths=None, prov_updates=None, index_prefix=None,
+                      **kwargs):
+        """
+        Creates the filesets, fields and provenance records found in the
+        walked directories (see find_data). Provenance records that are
+        read again or missing from the provenance table of the index are
+        appended to `prov_updates`. If the walked directories are all under
+        `index_prefix`, only the provenance table entries under it are
+        queried
+        """
         all_filesets = []
         all_fields = []
         all_records = []
-        for session_path, dirs, files in os.walk(self.root_dir):
+        if prov_updates is not None:
+            indexed_prov = self._index.provenance_paths(prefix=index_prefix)
+        for session_path, dirs, files in walked:
             relpath = op.relpath(session_path, self.root_dir)
             path_parts = relpath.split(op.sep) if relpath != '.' else []
             ids = self._extract_ids_from_path(path_parts, dirs, files)
@@ -263,7 +804,8 @@ class BasicRepo(Repository):
                             if (split_extension(f)[0] == basename
                                 and f != fname)],
                         **kwargs))
-            for fname in self._filter_dirs(dirs, session_path):
+            for fname in self._filter_dirs(dirs, session_path,
+                                           listings=listings):
                 all_filesets.append(
                     Fileset.from_path(
                         op.join(session_path, fname),
@@ -273,9 +815,9 @@ class BasicRepo(Repository):
                         from_study=from_study,
                         **kwargs))
             if self.FIELDS_FNAME in files:
-                with open(op.join(session_path,
-                                  self.FIELDS_FNAME), 'r') as f:
-                    dct = json.load(f)
+                dct = self._load_json(op.join(session_path,
+                                              self.FIELDS_FNAME),
+                                      documents, doc_updates, doc_paths)
                 all_fields.extend(
                     Field(name=k, value=v, frequency=frequency,
                           subject_id=subj_id, visit_id=visit_id,
@@ -288,14 +830,242 @@ class BasicRepo(Repository):
                         "Found provenance directory in session directory (i.e."
                         " not in study-specific sub-directory)")
                 base_prov_dir = op.join(session_path, self.PROV_DIR)
-                for fname in os.listdir(base_prov_dir):
-                    all_records.append(Record.load(
-                        split_extension(fname)[0],
-                        frequency, subj_id, visit_id, from_study,
-                        op.join(base_prov_dir, fname)))
+                try:
+                    prov_fnames = listings[base_prov_dir][1]
+                except KeyError:
+                    prov_fnames = os.listdir(base_prov_dir)
+                for fname in prov_fnames:
+                    if fname.startswith('.'):
+                        continue  # Skip sidecars (see joined_prov_path)
+                    prov_path = op.join(base_prov_dir, fname)
+                    num_updates = (len(doc_updates)
+                                   if doc_updates is not None else 0)
+                    # Records are only decoded in full when their workflow
+                    # provenance is compared (see Record.prov)
+                    record = Record(
+                        split_extension(fname)[0], frequency, subj_id,
+                        visit_id, from_study,
+                        content=self._read_json(prov_path, documents,
+                                                doc_updates, doc_paths),
+                        load_static=self._load_static_prov)
+                    if prov_updates is not None:
+                        relpath = self._relpath(prov_path)
+                        if (len(doc_updates) > num_updates or
+                                relpath not in indexed_prov):
+                            prov_updates.append(self._provenance_entry(
+                                relpath, record))
+                    all_records.append(record)
         return all_filesets, all_fields, all_records
 
+    def stale_nodes(self, study_name, pipeline_name, static_ref, expected):
+        """
+        Finds the nodes whose provenance records for a pipeline don't match
+        the expected provenance in a single query of the provenance table of
+        the repository index (see Repository.stale_nodes)
+        """
+        if self._index is None:
+            return None
+        stale = self._index.stale_provenance(
+            study_name, pipeline_name, static_ref,
+            [RepositoryIndex.expected_entry(
+                freq, self.inv_map_subject_id(subj_id),
+                self.inv_map_visit_id(visit_id), prov)
+             for freq, subj_id, visit_id, prov in expected])
+        return set(
+            (freq, self.map_subject_id(subj_id or None),
+             self.map_visit_id(visit_id or None))
+            for freq, subj_id, visit_id in stale)
+
+    def _provenance_entry(self, relpath, record):
+        return RepositoryIndex.provenance_entry(
+            relpath, record.from_study, record.pipeline_name,
+            record.frequency, self.inv_map_subject_id(record.subject_id),
+            self.inv_map_visit_id(record.visit_id),
+            {'inputs': record.inputs, 'outputs': record.outputs,
+             'joined_ids': record.joined_ids}, record.static_ref)
+
+    def _static_prov_path(self, static_ref):
+        return op.join(self.root_dir, self.STATIC_PROV_DIR,
+                       static_ref + '.json')
+
+    def _load_static_prov(self, static_ref):
+        """
+        Loads the static sections of provenance referenced by records. As
+        they are stored by the hash of their content they can be cached
+        indefinitely
+        """
+        try:
+            return self._static_provs[static_ref]
+        except KeyError:
+            pass
+        try:
+            with open(self._static_prov_path(static_ref)) as f:
+                static = json.load(f)
+        except IOError:
+            raise ArcanaRepositoryError(
+                "Could not load static provenance '{}' referenced by "
+                "provenance records in {}".format(static_ref, self))
+        self._static_provs[static_ref] = static
+        return static
+
+    def _load_json(self, path, documents=None, updates=None, paths=None):
+        """
+        Loads a JSON file, reusing its contents from the repository index if
+        it hasn't been modified since it was indexed (see _read_json)
+        """
+        return json.loads(self._read_json(path, documents, updates, paths))
+
+    def _read_json(self, path, documents=None, updates=None, paths=None):
+        """
+        Reads the content of a JSON file without decoding it, reusing its
+        contents from the repository index if it hasn't been modified since
+        it was indexed. Files that need to be read again are appended to
+        `updates` and the relative paths of all read files to `paths`
+        """
+        if documents is None:
+            with open(path, 'r') as f:
+                return f.read()
+        relpath = self._relpath(path)
+        paths.add(relpath)
+        st = os.stat(path)
+        try:
+            mtime_ns, size, indexed_ns, content = documents[relpath]
+        except KeyError:
+            content = None
+        else:
+            if not (mtime_ns == st.st_mtime_ns and size == st.st_size and
+                    RepositoryIndex.trusted(mtime_ns, indexed_ns)):
+                content = None
+        if content is None:
+            indexed_ns = RepositoryIndex.now()
+            with open(path, 'r') as f:
+                content = f.read()
+            updates.append((relpath, st.st_mtime_ns, st.st_size,
+                            indexed_ns, content))
+        return content
+
+    def _relpath(self, path):
+        return op.relpath(path, self.root_dir)
+
+    def _walk(self, max_depth=None):
+        """
+        Walks the directory tree under the root directory using os.scandir,
+        scanning the sub-trees of each top-level directory in parallel
+        threads. Produces the same listings, in the same order, as os.walk
+        (top-down without following symlinks)
+
+        Parameters
+        ----------
+        max_depth : int | None
+            The maximum depth (relative to the root directory) of the
+            directories to list. If None the whole tree is walked
+
+        Returns
+        -------
+        walked : list[tuple[str, list[str], list[str]]]
+            The path, sub-directory names and file names of each directory
+            in the walked tree
+        """
+        if self._index is not None:
+            indexed = self._index.listings()
+            updates = []
+            list_dir = partial(self._indexed_list_dir, indexed=indexed,
+                               updates=updates)
+        else:
+            list_dir = self._list_dir
+        listing = list_dir(self.root_dir)
+        if listing is None:
+            return []
+        dirs, files, nested = listing
+        walked = [(self.root_dir, dirs, files)]
+        if nested and (max_depth is None or max_depth > 0):
+            walk_subtree = partial(self._walk_subtree, depth=1,
+                                   max_depth=max_depth, list_dir=list_dir)
+            with ThreadPoolExecutor(self._num_scan_threads) as executor:
+                for subtree in executor.map(
+                        walk_subtree,
+                        (op.join(self.root_dir, d) for d in nested)):
+                    walked.extend(subtree)
+        if self._index is not None:
+            walked_paths = set(self._relpath(p) for p, _, _ in walked)
+            self._index.update_listings(
+                updates, remove=[p for p in indexed if p not in walked_paths])
+        return walked
+
+    @classmethod
+    def _walk_subtree(cls, path, depth, max_depth, list_dir):
+        listing = list_dir(path)
+        if listing is None:
+            return []
+        dirs, files, nested = listing
+        walked = [(path, dirs, files)]
+        if max_depth is None or depth < max_depth:
+            for dname in nested:
+                walked.extend(cls._walk_subtree(op.join(path, dname),
+                                                depth + 1, max_depth,
+                                                list_dir))
+        return walked
+
+    def _indexed_list_dir(self, path, indexed, updates):
+        """
+        Lists a directory, reusing the listing stored in the repository index
+        if the directory hasn't been modified since it was indexed. New
+        listings are appended to `updates`
+        """
+        try:
+            mtime_ns = os.stat(path).st_mtime_ns
+        except OSError:
+            return None
+        relpath = self._relpath(path)
+        try:
+            indexed_mtime_ns, indexed_ns, listing = indexed[relpath]
+        except KeyError:
+            pass
+        else:
+            if (indexed_mtime_ns == mtime_ns and
+                    RepositoryIndex.trusted(mtime_ns, indexed_ns)):
+                return listing
+        indexed_ns = RepositoryIndex.now()
+        listing = self._list_dir(path)
+        if listing is not None:
+            updates.append((relpath, mtime_ns, indexed_ns, listing))
+        return listing
+
+    @classmethod
+    def _list_dir(cls, path):
+        """
+        Lists the sub-directories and files of a directory, using the type
+        information cached in the directory entries to avoid separate stat
+        calls. Sub-directories that aren't symlinks are also returned
+        separately as these are the ones to descend into (as per os.walk)
+        """
+        dirs = []
+        files = []
+        nested = []
+        try:
+            entries = list(os.scandir(path))
+        except OSError:
+            # Same as os.walk, ignore directories that can't be listed
+            return None
+        for entry in entries:
+            try:
+                is_dir = entry.is_dir()
+            except OSError:
+                is_dir = False
+            if is_dir:
+                dirs.append(entry.name)
+                try:
+                    if not entry.is_symlink():
+                        nested.append(entry.name)
+                except OSError:
+                    pass
+            else:
+                files.append(entry.name)
+        return dirs, files, nested
+
     def _extract_ids_from_path(self, path_parts, dirs, files):
+        if any(p.startswith('.') for p in path_parts):
+            return None  # Hidden directories (e.g. static provenance)
         depth = len(path_parts)
         if depth == self._depth:
             # Load input data
@@ -330,31 +1100,48 @@ class BasicRepo(Repository):
     def fileset_path(self, item, fname=None):
         if fname is None:
             fname = item.fname
-        subject_id = self.inv_map_subject_id(item.subject_id)
-        visit_id = self.inv_map_visit_id(item.visit_id)
-        if item.frequency == 'per_study':
+        acq_dir = self._node_dir(item.frequency,
+                                 self.inv_map_subject_id(item.subject_id),
+                                 self.inv_map_visit_id(item.visit_id))
+        if item.from_study is None:
+            sess_dir = acq_dir
+        else:
+            # Append study-name to path (i.e. make a sub-directory to
+            # hold derived products)
+            sess_dir = op.join(acq_dir, item.from_study)
+        # Make session dir if required
+        if item.derived and not op.exists(sess_dir):
+            os.makedirs(sess_dir, stat.S_IRWXU | stat.S_IRWXG)
+        return op.join(sess_dir, fname)
+
+    def _node_dir(self, frequency, subject_id, visit_id):
+        """
+        Returns the directory that holds the acquired data of a node (in
+        the ID space of the repository)
+        """
+        if frequency == 'per_study':
             subj_dir = self.SUMMARY_NAME
             visit_dir = self.SUMMARY_NAME
-        elif item.frequency.startswith('per_subject'):
+        elif frequency.startswith('per_subject'):
             if self.depth < 2:
                 raise ArcanaInsufficientRepoDepthError(
                     "Basic repo needs to have depth of 2 (i.e. sub-directories"
                     " for subjects and visits) to hold 'per_subject' data")
             subj_dir = str(subject_id)
             visit_dir = self.SUMMARY_NAME
-        elif item.frequency.startswith('per_visit'):
+        elif frequency.startswith('per_visit'):
             if self.depth < 1:
                 raise ArcanaInsufficientRepoDepthError(
                     "Basic repo needs to have depth of at least 1 (i.e. "
                     "sub-directories for subjects) to hold 'per_visit' data")
             subj_dir = self.SUMMARY_NAME
             visit_dir = str(visit_id)
-        elif item.frequency.startswith('per_session'):
+        elif frequency.startswith('per_session'):
             subj_dir = str(subject_id)
             visit_dir = str(visit_id)
         else:
             assert False, "Unrecognised frequency '{}'".format(
-                item.frequency)
+                frequency)
         if self.depth == 2:
             acq_dir = op.join(self.root_dir, subj_dir, visit_dir)
         elif self.depth == 1:
@@ -363,16 +1150,7 @@ class BasicRepo(Repository):
             acq_dir = self.root_dir
         else:
             assert False
-        if item.from_study is None:
-            sess_dir = acq_dir
-        else:
-            # Append study-name to path (i.e. make a sub-directory to
-            # hold derived products)
-            sess_dir = op.join(acq_dir, item.from_study)
-        # Make session dir if required
-        if item.derived and not op.exists(sess_dir):
-            os.makedirs(sess_dir, stat.S_IRWXU | stat.S_IRWXG)
-        return op.join(sess_dir, fname)
+        return acq_dir
 
     def fields_json_path(self, field):
         return self.fileset_path(field, self.FIELDS_FNAME)
@@ -382,6 +1160,12 @@ class BasicRepo(Repository):
             record,
             fname=op.join(self.PROV_DIR, record.pipeline_name + '.json'))
 
+    def joined_prov_path(self, record):
+        # Hidden so that it isn't mistaken for a provenance record
+        return self.fileset_path(
+            record, fname=op.join(self.PROV_DIR, '.' + record.pipeline_name +
+                                  self.JOINED_PROV_SUFFIX))
+
     def guess_depth(self, root_dir):
         """
         Try to guess the depth of a directory repository (i.e. whether it has
@@ -396,6 +1180,8 @@ class BasicRepo(Repository):
         """
         deepest = -1
         for path, dirs, files in os.walk(root_dir):
+            # Don't descend into hidden directories
+            dirs[:] = [d for d in dirs if not d.startswith('.')]
             depth = self.path_depth(path)
             filtered_files = self._filter_files(files, path)
             if filtered_files:
@@ -439,13 +1225,24 @@ class BasicRepo(Repository):
                         or f.startswith(cls.FIELDS_FNAME))]
 
     @classmethod
-    def _filter_dirs(cls, dirs, base_dir):
+    def _filter_dirs(cls, dirs, base_dir, listings=None):
         # Filter out hidden directories (i.e. starting with '.')
-        # and derived study directories from fileset names
-        filtered = [
-            op.join(base_dir, d) for d in dirs
-            if not (d.startswith('.') or d == cls.PROV_DIR or (
-                cls.PROV_DIR in os.listdir(op.join(base_dir, d))))]
+        # and derived study directories from fileset names. Sub-directory
+        # listings from a previous scan are used to detect derived study
+        # directories where available instead of listing them again
+        if listings is None:
+            listings = {}
+        filtered = []
+        for d in dirs:
+            if d.startswith('.') or d == cls.PROV_DIR:
+                continue
+            dpath = op.join(base_dir, d)
+            try:
+                subdirs = listings[dpath][0]
+            except KeyError:
+                subdirs = os.listdir(dpath)
+            if cls.PROV_DIR not in subdirs:
+                filtered.append(dpath)
         return filtered
 
     def path_depth(self, dpath):
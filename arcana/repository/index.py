@@ -0,0 +1,356 @@
+import os
+import time
+import json
+import sqlite3
+import logging
+from contextlib import closing
+from arcana.exceptions import ArcanaRepositoryError
+
+
+logger = logging.getLogger('arcana')
+
+
+class RepositoryIndex(object):
+    """
+    A persistent index of the directory listings, JSON metadata files
+    (i.e. fields and provenance records) and file checksums of a
+    directory-based repository, stored in a SQLite database. Entries are
+    keyed by their path relative to the repository root and are only reused
+    while the modification time of the directory or file they were generated
+    from is unchanged. The reference to the static provenance and the input
+    and output digests of each provenance record are also stored in a
+    queryable table, so the records that don't match the expected
+    provenance of a pipeline can be found in a single query.
+
+    Parameters
+    ----------
+    path : str
+        Path to the SQLite database file holding the index (created if it
+        doesn't exist)
+    timeout : float
+        The time (in seconds) to wait for a lock on the database held by
+        another process
+    """
+
+    SCHEMA_VERSION = 2
+    # Modification times within this interval (in ns) of the time the entry
+    # was indexed are treated as unreliable, as further modifications within
+    # the timestamp granularity of the file-system wouldn't change them
+    RACY_INTERVAL = 2 * 10 ** 9
+
+    TABLES = (
+        "CREATE TABLE IF NOT EXISTS meta ("
+        "key TEXT PRIMARY KEY, value TEXT)",
+        "CREATE TABLE IF NOT EXISTS listings ("
+        "path TEXT PRIMARY KEY, mtime_ns INTEGER, indexed_ns INTEGER, "
+        "listing TEXT)",
+        "CREATE TABLE IF NOT EXISTS documents ("
+        "path TEXT PRIMARY KEY, mtime_ns INTEGER, size INTEGER, "
+        "indexed_ns INTEGER, content TEXT)",
+        "CREATE TABLE IF NOT EXISTS digests ("
+        "path TEXT, size INTEGER, mtime_ns INTEGER, "
+        "inode INTEGER, indexed_ns INTEGER, algorithm TEXT, digest TEXT, "
+        "PRIMARY KEY (path, algorithm))",
+        "CREATE TABLE IF NOT EXISTS provenance ("
+        "path TEXT PRIMARY KEY, study TEXT, pipeline TEXT, frequency TEXT, "
+        "subject_id TEXT, visit_id TEXT, static_ref TEXT, inputs TEXT, "
+        "outputs TEXT, joined_ids TEXT)",
+        "CREATE INDEX IF NOT EXISTS provenance_pipeline "
+        "ON provenance (study, pipeline)")
+
+    # Tables that are dropped and regenerated if the index was created by a
+    # previous version of the schema
+    CACHE_TABLES = ('listings', 'documents', 'digests', 'provenance')
+
+    def __init__(self, path, timeout=60.0):
+        self._path = path
+        self._timeout = timeout
+        with closing(self._connect()) as conn, conn:
+            conn.execute(self.TABLES[0])
+            row = conn.execute("SELECT value FROM meta WHERE key = "
+                               "'schema_version'").fetchone()
+            if row is not None and int(row[0]) > self.SCHEMA_VERSION:
+                raise ArcanaRepositoryError(
+                    "Incompatible version of repository index at '{}' ({}), "
+                    "expected {}. Please delete it so it can be regenerated"
+                    .format(path, row[0], self.SCHEMA_VERSION))
+            elif row is not None and int(row[0]) < self.SCHEMA_VERSION:
+                logger.info("Regenerating repository index at '{}' created "
+                            "with previous version of schema ({})"
+                            .format(path, row[0]))
+                for table in self.CACHE_TABLES:
+                    conn.execute("DROP TABLE IF EXISTS {}".format(table))
+            for table in self.TABLES[1:]:
+                conn.execute(table)
+            conn.execute("INSERT OR REPLACE INTO meta VALUES "
+                         "('schema_version', ?)", (str(self.SCHEMA_VERSION),))
+
+    def __repr__(self):
+        return "{}(path='{}')".format(type(self).__name__, self.path)
+
+    @property
+    def path(self):
+        return self._path
+
+    def _connect(self):
+        return sqlite3.connect(self._path, timeout=self._timeout)
+
+    @classmethod
+    def trusted(cls, mtime_ns, indexed_ns):
+        """
+        Whether an entry indexed at `indexed_ns` can be reused for a file or
+        directory with the modification time `mtime_ns`
+        """
+        return mtime_ns + cls.RACY_INTERVAL <= indexed_ns
+
+    @classmethod
+    def now(cls):
+        return time.time_ns()
+
+    def get_meta(self, key):
+        with closing(self._connect()) as conn:
+            row = conn.execute("SELECT value FROM meta WHERE key = ?",
+                               (key,)).fetchone()
+        return row[0] if row is not None else None
+
+    def set_meta(self, key, value):
+        with closing(self._connect()) as conn, conn:
+            conn.execute("INSERT OR REPLACE INTO meta VALUES (?, ?)",
+                         (key, str(value)))
+
+    def listings(self):
+        """
+        Returns all indexed directory listings
+
+        Returns
+        -------
+        listings : dict[str, tuple[int, int, tuple]]
+            The modification time of the directory, the time it was indexed
+            and its listing, keyed by relative path
+        """
+        with closing(self._connect()) as conn:
+            return {
+                p: (m, i, tuple(json.loads(l)))
+                for p, m, i, l in conn.execute(
+                    "SELECT path, mtime_ns, indexed_ns, listing "
+                    "FROM listings")}
+
+    def update_listings(self, updates, remove=()):
+        """
+        Inserts or replaces directory listings in the index
+
+        Parameters
+        ----------
+        updates : list[tuple[str, int, int, tuple]]
+            The relative path, modification time, time of indexing and
+            listing of each directory to update
+        remove : list[str]
+            Relative paths of directories to remove from the index
+        """
+        with closing(self._connect()) as conn, conn:
+            conn.executemany(
+                "INSERT OR REPLACE INTO listings VALUES (?, ?, ?, ?)",
+                ((p, m, i, json.dumps(l)) for p, m, i, l in updates))
+            conn.executemany("DELETE FROM listings WHERE path = ?",
+                             ((p,) for p in remove))
+
+    @classmethod
+    def _under(cls, prefix):
+        """
+        Returns a clause (and its parameters) that restricts a query to the
+        paths under the directory `prefix` (all paths if None). A range of
+        the primary key is used instead of LIKE so that the query can be
+        answered from the index of the table
+        """
+        if prefix is None or prefix == '.':
+            return '', ()
+        prefix = prefix.rstrip(os.sep)
+        return (" WHERE path >= ? AND path < ?",
+                (prefix + os.sep, prefix + chr(ord(os.sep) + 1)))
+
+    def documents(self, prefix=None):
+        """
+        Returns the indexed JSON documents
+
+        Parameters
+        ----------
+        prefix : str | None
+            The relative path of a directory to only return the documents
+            under. If None all documents are returned
+
+        Returns
+        -------
+        documents : dict[str, tuple[int, int, int, str]]
+            The modification time, size, time of indexing and contents of
+            the indexed JSON files, keyed by relative path
+        """
+        clause, params = self._under(prefix)
+        with closing(self._connect()) as conn:
+            return {
+                p: (m, s, i, c) for p, m, s, i, c in conn.execute(
+                    "SELECT path, mtime_ns, size, indexed_ns, content "
+                    "FROM documents" + clause, params)}
+
+    def update_documents(self, updates, remove=()):
+        """
+        Inserts or replaces JSON documents in the index
+
+        Parameters
+        ----------
+        updates : list[tuple[str, int, int, int, str]]
+            The relative path, modification time, size, time of indexing
+            and contents of each file to update
+        remove : list[str]
+            Relative paths of documents to remove from the index
+        """
+        with closing(self._connect()) as conn, conn:
+            conn.executemany(
+                "INSERT OR REPLACE INTO documents VALUES (?, ?, ?, ?, ?)",
+                updates)
+            conn.executemany("DELETE FROM documents WHERE path = ?",
+                             ((p,) for p in remove))
+
+    def digests(self, paths, algorithm):
+        """
+        Returns the cached digests of the given files
+
+        Parameters
+        ----------
+        paths : list[str]
+            Relative paths of the files to return the digests for
+        algorithm : str
+            The algorithm used to calculate the digests
+
+        Returns
+        -------
+        digests : dict[str, tuple[int, int, int, int, str]]
+            The size, modification time, inode, time of indexing and digest
+            of each file found in the cache, keyed by relative path
+        """
+        digests = {}
+        with closing(self._connect()) as conn:
+            for path in paths:
+                row = conn.execute(
+                    "SELECT size, mtime_ns, inode, indexed_ns, digest "
+                    "FROM digests WHERE path = ? AND algorithm = ?",
+                    (path, algorithm)).fetchone()
+                if row is not None:
+                    digests[path] = row
+        return digests
+
+    def update_digests(self, updates, algorithm):
+        """
+        Inserts or replaces the cached digests of files
+
+        Parameters
+        ----------
+        updates : list[tuple[str, int, int, int, int, str]]
+            The relative path, size, modification time, inode, time of
+            indexing and digest of each file
+        algorithm : str
+            The algorithm used to calculate the digests
+        """
+        with closing(self._connect()) as conn, conn:
+            conn.executemany(
+                "INSERT OR REPLACE INTO digests VALUES (?, ?, ?, ?, ?, ?, ?)",
+                ((p, s, m, i, n, algorithm, d)
+                 for p, s, m, i, n, d in updates))
+
+    def update_provenance(self, updates, remove=()):
+        """
+        Inserts or replaces the provenance entries of records
+
+        Parameters
+        ----------
+        updates : list[tuple[str, str, str, str, str, str, str, str, str, str]]
+            The relative path, study name, pipeline name, frequency,
+            subject ID, visit ID (empty strings for summaries), static
+            provenance reference and canonical JSON of the inputs, outputs
+            and joined IDs of each record (see provenance_entry)
+        remove : list[str]
+            Relative paths of records to remove from the index
+        """
+        with closing(self._connect()) as conn, conn:
+            conn.executemany(
+                "INSERT OR REPLACE INTO provenance VALUES "
+                "(?, ?, ?, ?, ?, ?, ?, ?, ?, ?)", updates)
+            conn.executemany("DELETE FROM provenance WHERE path = ?",
+                             ((p,) for p in remove))
+
+    def provenance_paths(self, prefix=None):
+        """
+        Returns the relative paths of the records in the provenance table,
+        optionally only those under the directory `prefix`
+        """
+        clause, params = self._under(prefix)
+        with closing(self._connect()) as conn:
+            return set(p for p, in conn.execute(
+                "SELECT path FROM provenance" + clause, params))
+
+    def stale_provenance(self, study, pipeline, static_ref, expected):
+        """
+        Returns the nodes whose provenance records for the given pipeline
+        don't match the expected provenance (or are missing), as determined
+        by a single query joining the expected values to the indexed ones
+
+        Parameters
+        ----------
+        study : str
+            Name of the study the records were generated by
+        pipeline : str
+            Name of the pipeline that generated the records
+        static_ref : str
+            Reference of the expected static provenance of the pipeline
+        expected : list[tuple[str, str, str, str, str, str]]
+            The frequency, subject ID, visit ID (empty strings for summaries)
+            and canonical JSON of the expected inputs, outputs and joined IDs
+            of each node to check
+
+        Returns
+        -------
+        stale : set[tuple[str, str, str]]
+            The frequency, subject ID and visit ID of the nodes whose records
+            don't match
+        """
+        with closing(self._connect()) as conn, conn:
+            conn.execute(
+                "CREATE TEMP TABLE IF NOT EXISTS expected_provenance ("
+                "frequency TEXT, subject_id TEXT, visit_id TEXT, "
+                "inputs TEXT, outputs TEXT, joined_ids TEXT)")
+            conn.execute("DELETE FROM expected_provenance")
+            conn.executemany(
+                "INSERT INTO expected_provenance VALUES (?, ?, ?, ?, ?, ?)",
+                expected)
+            return set(conn.execute(
+                "SELECT e.frequency, e.subject_id, e.visit_id "
+                "FROM expected_provenance e LEFT JOIN provenance p ON "
+                "p.study = ? AND p.pipeline = ? AND "
+                "p.frequency = e.frequency AND "
+                "p.subject_id = e.subject_id AND p.visit_id = e.visit_id "
+                "WHERE p.path IS NULL OR p.static_ref != ? OR "
+                "p.inputs != e.inputs OR p.outputs != e.outputs OR "
+                "p.joined_ids != e.joined_ids",
+                (study, pipeline, static_ref)))
+
+    @classmethod
+    def provenance_entry(cls, relpath, study, pipeline, frequency,
+                         subject_id, visit_id, prov, static_ref):
+        """
+        Creates an update entry for the provenance record at `relpath`
+        """
+        entry = cls.expected_entry(frequency, subject_id, visit_id, prov)
+        return ((relpath, study, pipeline) + entry[:3] + (static_ref,) +
+                entry[3:])
+
+    @classmethod
+    def expected_entry(cls, frequency, subject_id, visit_id, prov):
+        """
+        Creates an entry for the expected provenance of a node to pass to
+        stale_provenance
+        """
+        return (frequency,
+                subject_id if subject_id is not None else '',
+                visit_id if visit_id is not None else '',
+                json.dumps(prov.get('inputs'), sort_keys=True),
+                json.dumps(prov.get('outputs'), sort_keys=True),
+                json.dumps(prov.get('joined_ids'), sort_keys=True))
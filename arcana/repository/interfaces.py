@@ -2,10 +2,12 @@ from arcana.utils import ExitStack
 from nipype.interfaces.base import (
     traits, DynamicTraitedSpec, Undefined, File, Directory,
     BaseInterface, isdefined)
+from nipype.interfaces.utility import IdentityInterface
 from itertools import chain
 from copy import copy
 from arcana.utils import PATH_SUFFIX, FIELD_SUFFIX, CHECKSUM_SUFFIX
 from arcana.pipeline.provenance import Record
+from arcana.utils.hashing import joined_digest, compact_joined
 from arcana.exceptions import ArcanaError, ArcanaDesignError
 import logging
 
@@ -19,7 +21,7 @@ CHECKSUM_TRAIT = traits.Dict(traits.Str(), traits.Str())
 # Trait for checksums that may be joined over iterators
 JOINED_CHECKSUM_TRAIT = traits.Either(
     CHECKSUM_TRAIT, traits.List(CHECKSUM_TRAIT),
-    traits.List(traits.List(CHECKSUM_TRAIT)))
+    traits.List(traits.List(CHECKSUM_TRAIT)), traits.Str)
 
 
 class RepositoryInterface(BaseInterface):
@@ -179,6 +181,18 @@ class RepositorySource(RepositoryInterface):
         return outputs
 
 
+class JoinChecksums(IdentityInterface):
+    """
+    Join node interface that reduces the joined lists of checksums/values to
+    a single digest (see arcana.utils.hashing.joined_digest), so that only
+    the digests are passed on to the sink when joins are compacted
+    """
+
+    def _list_outputs(self):
+        outputs = super(JoinChecksums, self)._list_outputs()
+        return {k: joined_digest(v) for k, v in outputs.items()}
+
+
 class RepositorySinkOutputSpec(DynamicTraitedSpec):
 
     checksums = traits.Either(
@@ -187,6 +201,10 @@ class RepositorySinkOutputSpec(DynamicTraitedSpec):
               "at this stage it is only used as something to connect to the "
               "\"deiterators\" and eventually the \"final\" node after the "
               "pipeline outputs have been sunk"))
+    record = traits.Any(
+        desc=("The provenance record saved by the sink, used to update the "
+              "cached trees of the repositories in place after the workflow "
+              "has run"))
 
 
 class RepositorySink(RepositoryInterface):
@@ -203,12 +221,25 @@ class RepositorySink(RepositoryInterface):
     required : list[str]
         Names of derivatives that are required by downstream nodes. Any
         undefined required derivatives that are undefined will raise an error.
+    compact_joins : bool
+        Whether to reduce the joined input checksums/values and joined IDs
+        to single digests in the provenance record (see
+        arcana.utils.hashing.joined_digest)
+    joined_sidecar : bool
+        Whether the full joined input checksums/values and IDs are saved in
+        a sidecar to the record (see Repository.put_joined_prov) when the
+        joins are compacted. Requires the joined checksums to be passed to
+        the sink uncompacted
     """
 
     input_spec = RepositorySpec
     output_spec = RepositorySinkOutputSpec
+    # Always sink the outputs, even if the node results are cached in a
+    # retained work directory (see Processor.retain_work_dir)
+    _always_run = True
 
-    def __init__(self, collections, pipeline, required=()):
+    def __init__(self, collections, pipeline, required=(),
+                 compact_joins=False, joined_sidecar=False):
         super(RepositorySink, self).__init__(collections)
         # Add traits for filesets to sink
         for fileset_collection in self.fileset_collections:
@@ -229,7 +260,8 @@ class RepositorySink(RepositoryInterface):
             else:
                 trait_t = self.field_trait(inpt)
                 trait_t = traits.Either(trait_t, traits.List(trait_t),
-                                        traits.List(traits.List(trait_t)))
+                                        traits.List(traits.List(trait_t)),
+                                        traits.Str)
             self._add_trait(self.inputs, inpt.checksum_suffixed_name, trait_t)
             if inpt.is_fileset:
                 self._pipeline_input_filesets.append(inpt.name)
@@ -241,6 +273,13 @@ class RepositorySink(RepositoryInterface):
         self._pipeline_name = pipeline.name
         self._from_study = pipeline.study.name
         self._required = required
+        self._compact_joins = compact_joins
+        self._joined_sidecar = joined_sidecar
+        # The number of iterators each input is joined over before the sink
+        self._join_depths = {
+            i.name: len(pipeline.iterators(i.frequency) -
+                        pipeline.iterators(self.frequency))
+            for i in pipeline.inputs}
 
     def _list_outputs(self):
         outputs = self.output_spec().get()
@@ -289,10 +328,27 @@ class RepositorySink(RepositoryInterface):
             prov = copy(self._prov)
             prov['inputs'] = input_checksums
             prov['outputs'] = output_checksums
+            joined = None
+            if self._compact_joins:
+                joined = {'inputs': {}, 'joined_ids': prov['joined_ids']}
+                for name, depth in self._join_depths.items():
+                    checksums = input_checksums[name]
+                    if depth and not isinstance(checksums, str):
+                        joined['inputs'][name] = checksums
+                        input_checksums[name] = compact_joined(checksums,
+                                                               depth)
+                prov['joined_ids'] = {
+                    k: joined_digest(v)
+                    for k, v in prov['joined_ids'].items()}
             record = Record(self._pipeline_name, self.frequency, subject_id,
                             visit_id, self._from_study, prov)
+            # Only save sidecars for records that have joined inputs
+            save_joined = self._joined_sidecar and joined is not None and (
+                joined['inputs'] or any(joined['joined_ids'].values()))
             for repository in self.repositories:
                 repository.put_record(record)
+                if save_joined:
+                    repository.put_joined_prov(record, joined)
         if missing_inputs:
             raise ArcanaDesignError(
                 "Required derivatives '{}' to were not created by upstream "
@@ -300,4 +356,5 @@ class RepositorySink(RepositoryInterface):
                     "', '".join(missing_inputs), self))
         # Return cache file paths
         outputs['checksums'] = output_checksums
+        outputs['record'] = record
         return outputs
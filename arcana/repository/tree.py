@@ -1,13 +1,14 @@
 from builtins import zip
 from builtins import object
 import weakref
+import threading
 from itertools import chain, groupby
 from collections import defaultdict
 from operator import attrgetter, itemgetter
 from collections import OrderedDict
 import logging
 from arcana.data import BaseFileset, BaseField
-from arcana.utils import split_extension
+from arcana.utils import split_extension, intern_id
 from arcana.exceptions import (
     ArcanaNameError, ArcanaRepositoryError, ArcanaUsageError)
 
@@ -18,22 +19,87 @@ logger = logging.getLogger('arcana')
 
 class TreeNode(object):
 
+    # The attributes that hold the contents of the node, which are loaded
+    # from the repository on first access if the node is lazy (see _unload)
+    LAZY_ATTRS = frozenset((
+        '_filesets', '_fields', '_records', '_fileset_names', '_field_names',
+        '_output_records', '_missing_records', '_duplicate_records'))
+
     def __init__(self, filesets, fields, records):
+        self._tree = None
+        self._set_data(filesets, fields, records)
+
+    def __getattr__(self, name):
+        # Only called if the attribute isn't found by the normal mechanism,
+        # i.e. the contents of lazy nodes that haven't been loaded yet
+        if name in self.LAZY_ATTRS and self.__dict__.get('_lazy', False):
+            self._load()
+            return getattr(self, name)
+        raise AttributeError("'{}' object has no attribute '{}'"
+                             .format(type(self).__name__, name))
+
+    @property
+    def lazy(self):
+        "Whether the contents of the node haven't been loaded yet"
+        return self._lazy
+
+    def _unload(self):
+        """
+        Drops the contents of the node so that they are loaded from the
+        repository the next time they are accessed
+        """
+        for attr in self.LAZY_ATTRS:
+            self.__dict__.pop(attr, None)
+        # Guards against multiple threads loading the node at the same time
+        # (e.g. when checking provenance in parallel)
+        self._load_lock = threading.Lock()
+        self._lazy = True
+
+    def _load(self):
+        """
+        Loads the contents of a lazy node from the repository of its tree
+        """
+        with self._load_lock:
+            if not self._lazy:
+                return  # Loaded by another thread while waiting for the lock
+            self._set_data(*self.tree.repository.find_node_data(
+                self.frequency, self.subject_id, self.visit_id))
+        if self._missing_records:
+            logger.warning(
+                "No provenance records found for {} derivatives in {}. Will "
+                "assume they are \"protected\" (manually created) derivatives"
+                .format(', '.join(self._missing_records), self))
+        if self._duplicate_records:
+            logger.warning(
+                "Duplicate provenance records found for {} in {}. Will select "
+                "the latest record in each case"
+                .format(', '.join(self._duplicate_records), self))
+
+    def _set_data(self, filesets, fields, records):
+        """
+        Sets the filesets, fields and provenance records stored in the node,
+        replacing any that were previously stored (used to update the node
+        in place after new derivatives have been sunk to it). The contents
+        are built before they are assigned and the node is only marked as
+        loaded once they all have been, so that other threads accessing a
+        lazy node wait for it to be loaded (see _load)
+        """
         if filesets is None:
             filesets = []
         if fields is None:
             fields = []
         if records is None:
             records = []
-        # Save filesets and fields in ordered dictionary by name and
-        # name of study that generated them (if applicable)
-        self._filesets = OrderedDict()
+        # Save filesets and fields in dictionaries (which preserve insertion
+        # order and are more compact than OrderedDicts) by name and name of
+        # study that generated them (if applicable)
+        fileset_dct = {}
         for fileset in sorted(filesets):
             id_key = (fileset.id, fileset.from_study)
             try:
-                dct = self._filesets[id_key]
+                dct = fileset_dct[id_key]
             except KeyError:
-                dct = self._filesets[id_key] = OrderedDict()
+                dct = fileset_dct[id_key] = {}
             if fileset.format_name is not None:
                 format_key = fileset.format_name
             else:
@@ -43,29 +109,52 @@ class TreeNode(object):
                     "Attempting to add duplicate filesets to tree ({} and {})"
                     .format(fileset, dct[format_key]))
             dct[format_key] = fileset
-        self._fields = OrderedDict(((f.name, f.from_study), f)
-                                   for f in sorted(fields))
-        self._records = OrderedDict(
+        field_dct = {(f.name, f.from_study): f for f in sorted(fields)}
+        # Index the filesets and fields by name so that inputs with exact
+        # names can be matched to them without scanning the whole node
+        fileset_names = defaultdict(list)
+        for fileset in chain(*(d.values() for d in fileset_dct.values())):
+            fileset_names[fileset.basename].append(fileset)
+        field_names = defaultdict(list)
+        for field in field_dct.values():
+            field_names[field.name].append(field)
+        record_dct = dict(
             ((r.pipeline_name, r.from_study), r)
             for r in sorted(records, key=lambda r: (r.subject_id, r.visit_id,
                                                     r.from_study)))
-        self._missing_records = []
-        self._duplicate_records = []
-        self._tree = None
+        # Index the records by the names of the outputs they list so that
+        # items can be matched up with their records in linear time
+        output_records = defaultdict(list)
+        for record in record_dct.values():
+            for output_name in record.outputs:
+                output_records[(output_name,
+                                record.from_study)].append(record)
+        missing_records = []
+        duplicate_records = []
         # Match up provenance records with items in the node
-        for item in chain(self.filesets, self.fields):
+        for item in chain(chain(*(d.values() for d in fileset_dct.values())),
+                          field_dct.values()):
             if not item.derived:
                 continue  # Skip acquired items
-            records = [r for r in self.records
-                       if (item.from_study == r.from_study and
-                           item.name in r.outputs)]
-            if not records:
-                self._missing_records.append(item.name)
-            elif len(records) > 1:
-                item.record = sorted(records, key=attrgetter('datetime'))[-1]
-                self._duplicate_records.append(item.name)
+            item_records = output_records.get((item.name, item.from_study),
+                                              [])
+            if not item_records:
+                missing_records.append(item.name)
+            elif len(item_records) > 1:
+                item.record = sorted(item_records,
+                                     key=attrgetter('datetime'))[-1]
+                duplicate_records.append(item.name)
             else:
-                item.record = records[0]
+                item.record = item_records[0]
+        self._filesets = fileset_dct
+        self._fields = field_dct
+        self._fileset_names = fileset_names
+        self._field_names = field_names
+        self._records = record_dct
+        self._output_records = output_records
+        self._missing_records = missing_records
+        self._duplicate_records = duplicate_records
+        self._lazy = False
 
     def __eq__(self, other):
         if not (isinstance(other, type(self)) or
@@ -91,6 +180,34 @@ class TreeNode(object):
     def records(self):
         return self._records.values()
 
+    @property
+    def fileset_names(self):
+        """
+        The distinct basenames of the filesets in the node
+        """
+        return self._fileset_names.keys()
+
+    @property
+    def field_names(self):
+        """
+        The distinct names of the fields in the node
+        """
+        return self._field_names.keys()
+
+    def filesets_named(self, name):
+        """
+        Returns all filesets in the node with the given basename (i.e. from
+        any study and in any format)
+        """
+        return self._fileset_names.get(name, [])
+
+    def fields_named(self, name):
+        """
+        Returns all fields in the node with the given name (i.e. from any
+        study)
+        """
+        return self._field_names.get(name, [])
+
     @property
     def subject_id(self):
         "To be overridden by subclasses where appropriate"
@@ -263,6 +380,26 @@ class TreeNode(object):
                      self, pipeline_name, from_study,
                      '; '.join(found))))
 
+    def output_records(self, name, from_study):
+        """
+        Returns the provenance records in the node that list the given
+        derivative in their outputs
+
+        Parameters
+        ----------
+        name : str
+            The name of the derived fileset or field
+        from_study : str
+            The name of the study that the derivative was generated by
+
+        Returns
+        -------
+        records : list[arcana.provenance.Record]
+            The records listing the derivative as an output (more than one if
+            it has been generated by multiple pipelines)
+        """
+        return self._output_records.get((name, from_study), [])
+
     @property
     def data(self):
         return chain(self.filesets, self.fields)
@@ -332,17 +469,19 @@ class TreeNode(object):
         self._tree = weakref.ref(tree)
 
     def __getstate__(self):
+        dct = self.__dict__.copy()
         if self._tree is not None:
-            dct = self.__dict__.copy()
             dct['_tree'] = dct['_tree']()
-        else:
-            dct = self.__dict__
+        # Locks can't be pickled so are recreated when unpickled
+        dct.pop('_load_lock', None)
         return dct
 
     def __setstate__(self, state):
         self.__dict__ = state.copy()
         if self._tree is not None:
             self._tree = weakref.ref(self._tree)
+        if self.__dict__.get('_lazy', False):
+            self._load_lock = threading.Lock()
 
 
 class Tree(TreeNode):
@@ -499,6 +638,35 @@ class Tree(TreeNode):
     def session(self, subject_id, visit_id):
         return self.subject(subject_id).session(visit_id)
 
+    def node(self, frequency, subject_id=None, visit_id=None):
+        """
+        Returns the node of the tree of the given frequency and IDs
+
+        Parameters
+        ----------
+        frequency : str
+            The frequency of the node
+        subject_id : str | None
+            The subject ID of the node (if applicable)
+        visit_id : str | None
+            The visit ID of the node (if applicable)
+
+        Returns
+        -------
+        node : TreeNode
+            The matching node of the tree
+        """
+        if frequency == 'per_session':
+            return self.session(subject_id, visit_id)
+        elif frequency == 'per_subject':
+            return self.subject(subject_id)
+        elif frequency == 'per_visit':
+            return self.visit(visit_id)
+        elif frequency == 'per_study':
+            return self
+        else:
+            assert False
+
     def __iter__(self):
         return self.nodes()
 
@@ -605,6 +773,41 @@ class Tree(TreeNode):
                             visit_id, [], [], [])
                     visit._sessions[subject_id] = session
 
+    @classmethod
+    def construct_lazy(cls, repository, session_ids, **kwargs):
+        """
+        Return the hierarchical tree of the subjects, visits and sessions
+        stored in a repository, where the filesets, fields and provenance
+        records of each node are only loaded from the repository (and then
+        kept) when they are first accessed (see Repository.find_node_data)
+
+        Parameters
+        ----------
+        respository : Repository
+            The repository that the tree comes from
+        session_ids : iterable[tuple[str, str]]
+            The subject and visit IDs of the sessions in the tree
+
+        Returns
+        -------
+        tree : arcana.repository.Tree
+            A hierarchical tree of subject, session and fileset
+            information for the repository
+        """
+        subj_sessions = defaultdict(list)
+        visit_sessions = defaultdict(list)
+        for subj_id, visit_id in set(session_ids):
+            session = Session(subject_id=subj_id, visit_id=visit_id)
+            subj_sessions[subj_id].append(session)
+            visit_sessions[visit_id].append(session)
+        tree = Tree(
+            sorted(Subject(i, sorted(s)) for i, s in subj_sessions.items()),
+            sorted(Visit(i, sorted(s)) for i, s in visit_sessions.items()),
+            repository, **kwargs)
+        for node in tree.nodes():
+            node._unload()
+        return tree
+
     @classmethod
     def construct(cls, repository, filesets=(), fields=(), records=(),
                   file_formats=(), **kwargs):
@@ -704,7 +907,7 @@ class Subject(TreeNode):
     def __init__(self, subject_id, sessions, filesets=None,
                  fields=None, records=None):
         TreeNode.__init__(self, filesets, fields, records)
-        self._id = subject_id
+        self._id = intern_id(subject_id)
         self._sessions = OrderedDict(sorted(
             ((s.visit_id, s) for s in sessions), key=itemgetter(0)))
         for session in self.sessions:
@@ -835,7 +1038,7 @@ class Visit(TreeNode):
     def __init__(self, visit_id, sessions, filesets=None, fields=None,
                  records=None):
         TreeNode.__init__(self, filesets, fields, records)
-        self._id = visit_id
+        self._id = intern_id(visit_id)
         self._sessions = OrderedDict(sorted(
             ((s.subject_id, s) for s in sessions), key=itemgetter(0)))
         for session in sessions:
@@ -958,8 +1161,8 @@ class Session(TreeNode):
     def __init__(self, subject_id, visit_id, filesets=None, fields=None,
                  records=None):
         TreeNode.__init__(self, filesets, fields, records)
-        self._subject_id = subject_id
-        self._visit_id = visit_id
+        self._subject_id = intern_id(subject_id)
+        self._visit_id = intern_id(visit_id)
         self._subject = None
         self._visit = None
 
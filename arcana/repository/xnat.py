@@ -18,7 +18,10 @@ from arcana.exceptions import (
     ArcanaError, ArcanaUsageError, ArcanaFileFormatError,
     ArcanaWrongRepositoryError)
 from arcana.pipeline.provenance import Record
-from arcana.utils import dir_modtime, get_class_info, parse_value
+from arcana.utils import (
+    dir_modtime, get_class_info, parse_value, copy_and_hash_files)
+from arcana.utils.hashing import (
+    DEFAULT_HASH_ALGORITHM, leaf_algorithm, combine_checksums)
 import re
 import xnat
 
@@ -207,7 +210,8 @@ class XnatRepo(Repository):
                     try:
                         with open(md5_path, 'r') as f:
                             cached_checksums = json.load(f)
-                        if cached_checksums == fileset.checksums:
+                        if cached_checksums == self.get_checksums(
+                                fileset, DEFAULT_HASH_ALGORITHM):
                             need_to_download = False
                     except IOError:
                         pass
@@ -277,18 +281,25 @@ class XnatRepo(Repository):
             if os.path.exists(cache_path_dir):
                 shutil.rmtree(cache_path_dir)
             os.makedirs(cache_path_dir, stat.S_IRWXU | stat.S_IRWXG)
+            # Calculate the checksums while copying the files into the
+            # cache so they only need to be read once
             if fileset.format.directory:
-                shutil.copytree(fileset.path, cache_path)
+                to_copy = []
+                shutil.copytree(
+                    fileset.path, cache_path,
+                    copy_function=lambda s, d: to_copy.append((s, d)))
             else:
-                # Copy primary file
-                shutil.copyfile(fileset.path,
-                                op.join(cache_path, fileset.fname))
-                # Copy auxiliaries
-                for sc_fname, sc_path in fileset.aux_file_fnames_and_paths:
-                    shutil.copyfile(sc_path, op.join(cache_path, sc_fname))
+                # Copy primary file and auxiliaries
+                to_copy = [(fileset.path, op.join(cache_path, fileset.fname))]
+                to_copy.extend(
+                    (sc_path, op.join(cache_path, sc_fname))
+                    for sc_fname, sc_path in fileset.aux_file_fnames_and_paths)
+            checksums = {
+                op.relpath(s, fileset.path): d for (s, _), d in zip(
+                    to_copy, copy_and_hash_files(to_copy))}
             with open(cache_path + XnatRepo.MD5_SUFFIX, 'w',
                       **JSON_ENCODING) as f:
-                json.dump(fileset.calculate_checksums(), f, indent=2)
+                json.dump(checksums, f, indent=2)
             # Upload to XNAT
             xscan = self._login.classes.MrScanData(
                 id=fileset.id, type=fileset.basename, parent=xsession)
@@ -312,6 +323,12 @@ class XnatRepo(Repository):
                 xresource.upload(fileset.path, fileset.fname)
                 for sc_fname, sc_path in fileset.aux_file_fnames_and_paths:
                     xresource.upload(sc_path, sc_fname)
+        # The MD5 digests can only be used for the checksums of the fileset
+        # if it uses the default algorithm (or a Merkle tree of it)
+        algorithm = fileset.checksum_algorithm
+        if leaf_algorithm(algorithm) != DEFAULT_HASH_ALGORITHM:
+            return None
+        return combine_checksums(checksums, algorithm)
 
     def put_field(self, field):
         self._check_repository(field)
@@ -353,7 +370,7 @@ class XnatRepo(Repository):
         xresource = xprov.create_resource(record.pipeline_name)
         xresource.upload(cache_path, op.basename(cache_path))
 
-    def get_checksums(self, fileset):
+    def get_checksums(self, fileset, algorithm=None):
         """
         Downloads the MD5 digests associated with the files in the file-set.
         These are saved with the downloaded files in the cache and used to
@@ -368,7 +385,15 @@ class XnatRepo(Repository):
             determine the primary file within the resource and change the
             corresponding key in the checksums dictionary to '.' to match
             the way it is generated locally by Arcana.
+        algorithm : str | None
+            The algorithm of the checksums to return. Only MD5 digests are
+            stored on XNAT so None is returned for other algorithms (apart
+            from Merkle trees of MD5 digests)
         """
+        if algorithm is None:
+            algorithm = fileset.checksum_algorithm
+        if leaf_algorithm(algorithm) != DEFAULT_HASH_ALGORITHM:
+            return None
         if fileset.uri is None:
             raise ArcanaUsageError(
                 "Can't retrieve checksums as URI has not been set for {}"
@@ -382,7 +407,7 @@ class XnatRepo(Repository):
             # match the way that checksums are created by Arcana
             primary = fileset.format.assort_files(checksums.keys())[0]
             checksums['.'] = checksums.pop(primary)
-        return checksums
+        return combine_checksums(checksums, algorithm)
 
     def find_data(self, subject_ids=None, visit_ids=None, **kwargs):
         """
@@ -612,7 +637,7 @@ class XnatRepo(Repository):
         with open(zip_path, 'wb') as f:
             xresource.xnat_session.download_stream(
                 xresource.uri + '/files', f, format='zip', verbose=True)
-        checksums = self.get_checksums(fileset)
+        checksums = self.get_checksums(fileset, DEFAULT_HASH_ALGORITHM)
         # Extract downloaded zip file
         expanded_dir = op.join(tmp_dir, 'expanded')
         try:
@@ -350,6 +350,19 @@ class Study(object):
                 kwargs.update({'subject_ids': subject_ids,
                                'visit_ids': visit_ids,
                                'session_ids': session_ids})
+                # Check whether the same request has already been run on the
+                # current state of the study data, in which case there is no
+                # need to construct and check the pipelines
+                if self.processor.run_manifest and not kwargs.get('force'):
+                    manifest_request = {'names': sorted(names)}
+                    manifest_request.update(kwargs)
+                    if self.processor.up_to_date(manifest_request):
+                        logger.info(
+                            "'{}' are up to date with the study data".format(
+                                "', '".join(names)))
+                        pipeline_getters = {}
+                    kwargs['manifest_request'] = manifest_request
+            if pipeline_getters:
                 try:
                     pipelines, required_outputs = zip(*(
                         (self.pipeline(getter, pipeline_args=args), req_outs)
@@ -595,13 +608,24 @@ class Study(object):
             visit_ids=self._visit_ids,
             fill=self._fill_tree)
 
-    def clear_caches(self):
+    def clear_caches(self, updated_nodes=None):
         """
         Called after a pipeline is run against the study to force an update of
         the derivatives that are now present in the repository if a subsequent
         pipeline is run.
+
+        Parameters
+        ----------
+        updated_nodes : list[tuple[str, str | None, str | None]] | None
+            The frequency, subject ID and visit ID of the nodes that
+            derivatives have been sunk to. If provided, these nodes are
+            updated in place in the cached trees of the repository instead of
+            clearing them
         """
-        self.repository.clear_cache()
+        if updated_nodes is not None:
+            self.repository.update_cache(updated_nodes)
+        else:
+            self.repository.clear_cache()
         self._bound_specs = {}
         self._pipelines_cache = {}
 
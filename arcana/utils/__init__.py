@@ -1,5 +1,8 @@
 from .base import (
-    split_extension, classproperty, lower, JSON_ENCODING, parse_value,
+    split_extension, classproperty, lower, intern_id, JSON_ENCODING,
+    parse_value,
     run_matlab_cmd, find_mismatch, package_dir, dir_modtime,
     PATH_SUFFIX, FIELD_SUFFIX, CHECKSUM_SUFFIX, ExitStack, makedirs,
     get_class_info, HOSTNAME, extract_package_version, wrap_text)
+from .hashing import (
+    hash_file, hash_files, copy_and_hash, copy_and_hash_files)
@@ -1,5 +1,6 @@
 from past.builtins import basestring
 from future.utils import PY3, PY2
+import sys
 import subprocess as sp
 import importlib
 from itertools import zip_longest
@@ -81,6 +82,16 @@ def lower(s):
     return s.lower()
 
 
+def intern_id(id):
+    """
+    Interns subject/visit IDs so that the many items and nodes in a tree that
+    refer to the same ID share a single string object
+    """
+    if isinstance(id, str):
+        return sys.intern(id)
+    return id
+
+
 if PY3:
     JSON_ENCODING = {'encoding': 'utf-8'}
     from os import makedirs  # @UnusedImport
@@ -0,0 +1,455 @@
+import os
+import os.path as op
+import zlib
+import shutil
+import json
+import hashlib
+from functools import partial
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+
+
+# Size of the chunks files are read in when hashing them, so that memory
+# usage doesn't depend on the size of the files
+HASH_CHUNK_SIZE = 2 ** 20
+
+DEFAULT_HASH_ALGORITHM = 'md5'
+
+# Name of the fast fingerprint "algorithm", which combines the size of the
+# file with a CRC32 of sampled blocks of the file (see fingerprint_file)
+FINGERPRINT = 'fingerprint'
+FINGERPRINT_BLOCK_SIZE = 2 ** 16
+FINGERPRINT_NUM_BLOCKS = 16
+
+# Digests calculated with algorithms other than the default are prefixed
+# with the name of the algorithm and this separator so they can be
+# distinguished in provenance records
+ALGORITHM_SEP = ':'
+
+# Algorithms prefixed with this are combined into a single Merkle root hash of
+# the digests of the individual files (calculated with the algorithm after
+# the prefix, e.g. 'merkle-md5'), which is all that is stored in provenance
+MERKLE_PREFIX = 'merkle-'
+
+# Digests of joined lists of checksums/values are prefixed with this and the
+# algorithm of the joined checksums (e.g. 'joined-md5'), so that the items can
+# be recalculated with the same algorithm when comparing with provenance
+JOINED_PREFIX = 'joined-'
+
+
+def digest_algorithm(digest):
+    """
+    Returns the name of the algorithm used to calculate a digest (or nested
+    container of digests as stored in provenance records) from its prefix
+
+    Parameters
+    ----------
+    digest : str | dict | list
+        A digest or a nested container of digests
+
+    Returns
+    -------
+    algorithm : str | None
+        The name of the algorithm, or None if no digests were found
+    """
+    if isinstance(digest, dict):
+        digest = list(digest.values())
+    if isinstance(digest, (list, tuple)):
+        for d in digest:
+            algorithm = digest_algorithm(d)
+            if algorithm is not None:
+                return algorithm
+        return None
+    if not isinstance(digest, str):
+        return None
+    if ALGORITHM_SEP in digest:
+        algorithm = digest.split(ALGORITHM_SEP)[0]
+        # Unrecognised prefixes are treated as part of an untagged digest, so
+        # they are reported as mismatches instead of failing to recalculate
+        if is_known_algorithm(algorithm):
+            return algorithm
+    return DEFAULT_HASH_ALGORITHM
+
+
+def is_known_algorithm(algorithm):
+    """
+    Whether the algorithm can be used to calculate checksums, i.e. it is
+    provided by hashlib or is the fingerprint algorithm, optionally with the
+    joined and/or Merkle prefixes
+    """
+    algorithm = leaf_algorithm(item_algorithm(algorithm))
+    return (algorithm == FINGERPRINT or
+            algorithm in hashlib.algorithms_available)
+
+
+def _tag(digest, algorithm):
+    if algorithm == DEFAULT_HASH_ALGORITHM:
+        return digest
+    return algorithm + ALGORITHM_SEP + digest
+
+
+def is_merkle(algorithm):
+    """
+    Whether the algorithm combines the digests of the files into a Merkle
+    root hash
+    """
+    return algorithm is not None and algorithm.startswith(MERKLE_PREFIX)
+
+
+def leaf_algorithm(algorithm):
+    """
+    Returns the algorithm used to hash the individual files for the given
+    algorithm (i.e. strips the Merkle prefix if present)
+    """
+    if is_merkle(algorithm):
+        return algorithm[len(MERKLE_PREFIX):]
+    return algorithm
+
+
+def is_joined(algorithm):
+    """
+    Whether the algorithm is that of a digest of a joined list of checksums
+    """
+    return algorithm is not None and algorithm.startswith(JOINED_PREFIX)
+
+
+def item_algorithm(algorithm):
+    """
+    Returns the algorithm used to calculate the checksums of the items that
+    were joined for the given algorithm (i.e. strips the joined prefix)
+    """
+    if is_joined(algorithm):
+        return algorithm[len(JOINED_PREFIX):]
+    return algorithm
+
+
+def joined_digest(items):
+    """
+    Calculates a single digest from a list of the checksums/values of joined
+    items, which is stored in provenance instead of the list when joins are
+    compacted. Items that are themselves joined digests (i.e. from an inner
+    join) are combined as they are, so nested lists are reduced to a digest
+    of digests. The serialised items are sorted before they are hashed, as
+    the order nodes are joined in isn't guaranteed (joined lists are
+    compared ignoring order otherwise).
+
+    Parameters
+    ----------
+    items : list[dict[str, str] | str | int | float | list]
+        The checksums of filesets or values of fields that were joined, in
+        the order they were joined
+
+    Returns
+    -------
+    digest : str
+        The digest of the joined items, prefixed by the joined prefix and the
+        algorithm of the checksums of the items
+    """
+    algorithm = digest_algorithm(items)
+    if algorithm is None:
+        algorithm = DEFAULT_HASH_ALGORITHM
+    if not is_joined(algorithm):
+        algorithm = JOINED_PREFIX + algorithm
+    serialised = []
+    for item in items:
+        if not (isinstance(item, str) and
+                is_joined(digest_algorithm(item))):
+            item = json.dumps(item, sort_keys=True)
+        serialised.append(item)
+    hsh = hashlib.new(DEFAULT_HASH_ALGORITHM)
+    for item in sorted(serialised):
+        hsh.update((item + '\n').encode())
+    return algorithm + ALGORITHM_SEP + hsh.hexdigest()
+
+
+def compact_joined(value, depth):
+    """
+    Reduces the (nested) lists of checksums/values joined over `depth`
+    iterators into a single digest (see joined_digest)
+
+    Parameters
+    ----------
+    value : list
+        The joined checksums/values, nested to `depth` levels
+    depth : int
+        The number of iterators the value was joined over
+
+    Returns
+    -------
+    compacted : str | *
+        The digest of the joined value, or the value itself if it wasn't
+        joined (i.e. depth == 0)
+    """
+    if not depth:
+        return value
+    return joined_digest([compact_joined(v, depth - 1) for v in value])
+
+
+def merkle_tree(digests, algorithm=MERKLE_PREFIX + DEFAULT_HASH_ALGORITHM):
+    """
+    Calculates the nodes of a Merkle tree from the digests of the files in a
+    fileset, where the hash of each directory is calculated from the sorted
+    names and digests of its contents. Only the digests of the directories
+    containing altered files therefore need to be recalculated when files
+    change, and filesets can be compared by their root hashes alone.
+
+    Parameters
+    ----------
+    digests : dict[str, str]
+        The digests of the files in the fileset, keyed by their paths
+        relative to the base path of the fileset
+    algorithm : str
+        The algorithm the digests were calculated with, with or without the
+        Merkle prefix. Directories are hashed with the same algorithm, or
+        MD5 if it isn't a hashlib algorithm (i.e. for fingerprints)
+
+    Returns
+    -------
+    tree : dict[str, str]
+        The hex digests of each directory in the tree, keyed by their
+        relative paths with the root keyed by '.'
+    """
+    node_algorithm = leaf_algorithm(algorithm)
+    if node_algorithm not in hashlib.algorithms_available:
+        node_algorithm = DEFAULT_HASH_ALGORITHM
+    # Arrange the digests into nested dictionaries mirroring the directories
+    root = {}
+    for relpath, digest in digests.items():
+        parts = relpath.split(os.sep)
+        node = root
+        for part in parts[:-1]:
+            node = node.setdefault(part, {})
+        node[parts[-1]] = digest
+    tree = {}
+
+    def hash_node(node, relpath):
+        hsh = hashlib.new(node_algorithm)
+        for name in sorted(node):
+            entry = node[name]
+            if isinstance(entry, dict):
+                entry = hash_node(entry, op.join(relpath, name))
+            hsh.update('{}\0{}\n'.format(name, entry).encode())
+        tree[op.normpath(relpath)] = digest = hsh.hexdigest()
+        return digest
+
+    hash_node(root, '.')
+    return tree
+
+
+def merkle_root(digests, algorithm=MERKLE_PREFIX + DEFAULT_HASH_ALGORITHM):
+    """
+    Calculates the root hash of the Merkle tree of the digests of the files
+    in a fileset (see merkle_tree), tagged with the name of the algorithm
+
+    Parameters
+    ----------
+    digests : dict[str, str]
+        The digests of the files in the fileset, keyed by their paths
+        relative to the base path of the fileset
+    algorithm : str
+        The algorithm the digests were calculated with
+
+    Returns
+    -------
+    root : str
+        The root hash of the Merkle tree
+    """
+    if not is_merkle(algorithm):
+        algorithm = MERKLE_PREFIX + algorithm
+    return _tag(merkle_tree(digests, algorithm)['.'], algorithm)
+
+
+def combine_checksums(digests, algorithm):
+    """
+    Combines the digests of the individual files of a fileset into the
+    checksums to be saved in provenance for the given algorithm, i.e. the
+    root hash of their Merkle tree if a Merkle algorithm is used
+
+    Parameters
+    ----------
+    digests : dict[str, str]
+        The digests of the files in the fileset calculated with the leaf
+        algorithm, keyed by their paths relative to the base path
+    algorithm : str
+        The checksum algorithm of the fileset
+
+    Returns
+    -------
+    checksums : dict[str, str]
+        The checksums of the fileset
+    """
+    if digests is None or not is_merkle(algorithm):
+        return digests
+    return {'.': merkle_root(digests, algorithm)}
+
+
+def fingerprint_file(path, block_size=FINGERPRINT_BLOCK_SIZE,
+                     num_blocks=FINGERPRINT_NUM_BLOCKS):
+    """
+    Calculates a fast fingerprint of a file from its size and a CRC32 of
+    sampled blocks at the head, tail and evenly spaced strides in between.
+    Files smaller than the combined size of the sampled blocks are read in
+    full. Unlike full digests, changes to the file that don't alter its size
+    or the sampled blocks won't be detected.
+
+    Parameters
+    ----------
+    path : str
+        Path to the file to fingerprint
+    block_size : int
+        The size of the sampled blocks
+    num_blocks : int
+        The number of blocks to sample (including the head and tail)
+
+    Returns
+    -------
+    fingerprint : str
+        The fingerprint of the file, prefixed by the 'fingerprint' tag
+    """
+    crc = 0
+    with open(path, 'rb') as f:
+        size = os.fstat(f.fileno()).st_size
+        if size <= block_size * num_blocks:
+            for chunk in iter(partial(f.read, block_size), b''):
+                crc = zlib.crc32(chunk, crc)
+        else:
+            last = size - block_size
+            for i in range(num_blocks):
+                f.seek((last * i) // (num_blocks - 1))
+                crc = zlib.crc32(f.read(block_size), crc)
+    return _tag('{}-{:08x}'.format(size, crc), FINGERPRINT)
+
+
+def hash_file(path, algorithm=DEFAULT_HASH_ALGORITHM,
+              chunk_size=HASH_CHUNK_SIZE):
+    """
+    Calculates the digest of a file, reading it in chunks
+
+    Parameters
+    ----------
+    path : str
+        Path to the file to hash
+    algorithm : str
+        Name of the hashlib algorithm to use or 'fingerprint'
+    chunk_size : int
+        The size of the chunks the file is read in
+
+    Returns
+    -------
+    digest : str
+        The hex digest of the file, prefixed by the name of the algorithm if
+        it isn't the default
+    """
+    if algorithm == FINGERPRINT:
+        return fingerprint_file(path)
+    hsh = hashlib.new(algorithm)
+    with open(path, 'rb') as f:
+        for chunk in iter(partial(f.read, chunk_size), b''):
+            hsh.update(chunk)
+    return _tag(hsh.hexdigest(), algorithm)
+
+
+def copy_and_hash(src_path, dst_path, algorithm=DEFAULT_HASH_ALGORITHM,
+                  chunk_size=HASH_CHUNK_SIZE):
+    """
+    Copies a file and calculates its digest in a single pass, reading it in
+    chunks so it is only read once
+
+    Parameters
+    ----------
+    src_path : str
+        Path to the file to copy
+    dst_path : str
+        Path to copy the file to
+    algorithm : str
+        Name of the hashlib algorithm to use or 'fingerprint'
+    chunk_size : int
+        The size of the chunks the file is read in
+
+    Returns
+    -------
+    digest : str
+        The hex digest of the file, prefixed by the name of the algorithm if
+        it isn't the default
+    """
+    if algorithm == FINGERPRINT:
+        # Fingerprints only sample the file so are cheap to calculate from
+        # the copy
+        shutil.copyfile(src_path, dst_path)
+        return fingerprint_file(dst_path)
+    hsh = hashlib.new(algorithm)
+    with open(src_path, 'rb') as fsrc, open(dst_path, 'wb') as fdst:
+        for chunk in iter(partial(fsrc.read, chunk_size), b''):
+            hsh.update(chunk)
+            fdst.write(chunk)
+    return _tag(hsh.hexdigest(), algorithm)
+
+
+def hash_files(paths, base_path=None, algorithm=DEFAULT_HASH_ALGORITHM,
+               chunk_size=HASH_CHUNK_SIZE, num_threads=None):
+    """
+    Calculates the digests of multiple files in parallel threads (hashlib
+    releases the GIL while hashing so the files are hashed concurrently)
+
+    Parameters
+    ----------
+    paths : iterable[str]
+        Paths to the files to hash
+    base_path : str | None
+        If provided, the digests are keyed by the paths relative to the
+        base path instead of the paths themselves
+    algorithm : str
+        Name of the hashlib algorithm to use or 'fingerprint'
+    chunk_size : int
+        The size of the chunks the files are read in
+    num_threads : int | None
+        The maximum number of threads to use. If None the default of
+        concurrent.futures.ThreadPoolExecutor is used
+
+    Returns
+    -------
+    digests : OrderedDict[str, str]
+        The hex digests of the files in the order they were provided
+    """
+    paths = list(paths)
+    hasher = partial(hash_file, algorithm=algorithm, chunk_size=chunk_size)
+    if len(paths) > 1 and num_threads != 1:
+        with ThreadPoolExecutor(num_threads) as executor:
+            digests = list(executor.map(hasher, paths))
+    else:
+        digests = [hasher(p) for p in paths]
+    if base_path is not None:
+        paths = (op.relpath(p, base_path) for p in paths)
+    return OrderedDict(zip(paths, digests))
+
+
+def copy_and_hash_files(src_and_dst_paths, algorithm=DEFAULT_HASH_ALGORITHM,
+                        chunk_size=HASH_CHUNK_SIZE, num_threads=None):
+    """
+    Copies multiple files and calculates their digests in parallel threads
+
+    Parameters
+    ----------
+    src_and_dst_paths : iterable[tuple[str, str]]
+        Pairs of source and destination paths of the files to copy
+    algorithm : str
+        Name of the hashlib algorithm to use or 'fingerprint'
+    chunk_size : int
+        The size of the chunks the files are read in
+    num_threads : int | None
+        The maximum number of threads to use. If None the default of
+        concurrent.futures.ThreadPoolExecutor is used
+
+    Returns
+    -------
+    digests : list[str]
+        The hex digests of the copied files in the order they were provided
+    """
+    src_and_dst_paths = list(src_and_dst_paths)
+    copier = partial(copy_and_hash, algorithm=algorithm,
+                     chunk_size=chunk_size)
+    if len(src_and_dst_paths) > 1 and num_threads != 1:
+        with ThreadPoolExecutor(num_threads) as executor:
+            return list(executor.map(lambda p: copier(*p),
+                                     src_and_dst_paths))
+    return [copier(*p) for p in src_and_dst_paths]
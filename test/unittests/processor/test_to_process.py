@@ -1,3 +1,7 @@
+import os
+import os.path as op
+import json
+from unittest import TestCase
 from nipype.interfaces.utility import Merge, Split
 from arcana.utils.testing import (
     BaseTestCase, BaseMultiSubjectTestCase, TestMath)
@@ -9,10 +13,13 @@ from arcana.data import (
     InputFieldSpec, InputFields)
 from arcana.data.file_format import text_format
 from arcana.data import Field
-from arcana.repository import Tree
+from arcana.repository import Tree, BasicRepo
+from arcana.pipeline.provenance import Record
+from arcana.utils.hashing import digest_algorithm, is_joined
 from arcana.environment import BaseRequirement
 from arcana.exceptions import (
-    ArcanaReprocessException, ArcanaProtectedOutputConflictError)
+    ArcanaReprocessException, ArcanaProtectedOutputConflictError,
+    ArcanaUsageError)
 
 
 class DummyRequirement(BaseRequirement):
@@ -309,6 +316,139 @@ class TestProvBasic(BaseTestCase):
             new_derived_field4.record.prov['outputs']['derived_field4'],
             new_value)
 
+    def test_run_manifest(self):
+        study_name = 'run_manifest'
+
+        def create_study():
+            study = self.create_study(
+                TestProvStudy,
+                study_name,
+                inputs=STUDY_INPUTS,
+                processor=SingleProc(self.work_dir, run_manifest=True))
+            # Count the pipelines that are constructed
+            study.num_pipelines = 0
+            pipeline_method = study.pipeline
+
+            def pipeline(*args, **kwargs):
+                study.num_pipelines += 1
+                return pipeline_method(*args, **kwargs)
+
+            study.pipeline = pipeline
+            return study
+
+        study = create_study()
+        self.assertEqual(
+            study.data('derived_field4').item(*self.SESSION).value, 155.0)
+        self.assertTrue(study.num_pipelines)
+        # Repeating the request shouldn't require the pipelines to be built
+        study = create_study()
+        self.assertEqual(
+            study.data('derived_field4').item(*self.SESSION).value, 155.0)
+        self.assertEqual(study.num_pipelines, 0)
+        # Or if data that isn't used by the pipelines is changed
+        study.data('derived_field3').item(*self.SESSION).value = -1.0
+        study = create_study()
+        study.data('derived_field4')
+        self.assertEqual(study.num_pipelines, 0)
+        # Until the data used by the pipelines is changed, in which case the
+        # derivatives are checked again (and need to be reprocessed)
+        study.data('derived_field1').item(*self.SESSION).value = [-1.0]
+        study = create_study()
+        self.assertRaises(ArcanaReprocessException, study.data,
+                          'derived_field4')
+        self.assertTrue(study.num_pipelines)
+
+    def test_snapshot_tree(self):
+        study_name = 'snapshot_tree'
+        study = self.create_study(
+            TestProvStudy,
+            study_name,
+            inputs=STUDY_INPUTS,
+            processor=SingleProc(self.work_dir, snapshot_tree=True))
+        self.assertEqual(
+            study.data('derived_field4').item(*self.SESSION).value, 155.0)
+        # The tree should be saved in the work dir for the worker processes
+        self.assertTrue(any(f.endswith(SingleProc.TREE_SNAPSHOT_SUFFIX)
+                            for f in os.listdir(self.work_dir)))
+
+    def test_retain_work_dir(self):
+        study_name = 'retain_work_dir'
+        processor = SingleProc(self.work_dir, retain_work_dir=True,
+                               reprocess=True)
+        study = self.create_study(
+            TestProvStudy,
+            study_name,
+            inputs=STUDY_INPUTS,
+            processor=processor)
+        retained_base = op.join(self.work_dir, SingleProc.RETAINED_DIR)
+        self.assertEqual(
+            study.data('derived_field4').item(*self.SESSION).value, 155.0)
+        retained = os.listdir(retained_base)
+        self.assertEqual(len(retained), 1)
+        # Rerunning the same pipelines should reuse the retained directory
+        study.data('derived_field4')
+        self.assertEqual(os.listdir(retained_base), retained)
+        # While pipelines with different parameters should get their own
+        study = self.create_study(
+            TestProvStudy,
+            study_name,
+            inputs=STUDY_INPUTS,
+            processor=processor,
+            parameters={'multiplier': 100.0})
+        study.data('derived_field4')
+        self.assertEqual(len(os.listdir(retained_base)), 2)
+        # Garbage collection should delete all but the directory in use
+        processor = SingleProc(self.work_dir, retain_work_dir=True,
+                               work_dir_budget_gb=0.0)
+        keep = op.join(retained_base, retained[0])
+        deleted = processor.collect_retained_garbage(keep=keep)
+        self.assertEqual(len(deleted), 1)
+        self.assertEqual(os.listdir(retained_base), retained)
+        # Outputs moved out of the retained directories couldn't be resunk
+        self.assertRaises(
+            ArcanaUsageError, self.create_study, TestProvStudy, study_name,
+            inputs=STUDY_INPUTS, processor=processor,
+            repository=BasicRepo(self.repository.root_dir,
+                                 sink_strategy='move'))
+
+    def test_plan(self):
+        study_name = 'plan'
+        study = self.create_study(
+            TestProvStudy,
+            study_name,
+            inputs=STUDY_INPUTS)
+        plan = study.processor.plan(study.pipeline('pipeline3'))
+        # The plan should be JSON-serialisable
+        json.dumps(plan)
+        self.assertEqual([p['name'] for p in plan['pipelines']],
+                         ['pipeline1', 'pipeline2', 'pipeline3'])
+        for pipeline_plan in plan['pipelines']:
+            self.assertEqual(pipeline_plan['to_process'], [list(self.SESSION)])
+            self.assertEqual(pipeline_plan['num_runs'], 1)
+        self.assertAlmostEqual(
+            plan['cpu_hours'],
+            sum(n['wall_time'] * n['n_procs']
+                for p in plan['pipelines'] for n in p['nodes']) / 60.0)
+        self.assertEqual(plan['peak_mem_gb'],
+                         SingleProc.DEFAULT_MEM_GB)
+        study.data('derived_field2')
+        # Nothing should need to be run once the derivatives have been
+        # generated
+        study = self.create_study(
+            TestProvStudy,
+            study_name,
+            inputs=STUDY_INPUTS,
+            parameters={'subtract': 100})
+        plan = study.processor.plan(study.pipeline('pipeline2'))
+        self.assertFalse(any(p['to_process'] for p in plan['pipelines']))
+        self.assertEqual(plan['cpu_hours'], 0)
+        # Changes to the provenance are reported instead of raising errors
+        plan = study.processor.plan(study.pipeline('pipeline3'))
+        self.assertEqual(
+            [(r['action'], r['subject_id'], r['visit_id'])
+             for r in plan['pipelines'][-1]['reasons']],
+            [('conflict',) + tuple(self.SESSION)])
+
     def test_protect_manually(self):
         """Protect manually altered files and fields from overwrite"""
         study_name = 'manual_protect'
@@ -398,6 +538,64 @@ class TestProvInputChange(BaseTestCase):
             new_study.data('derived_field2').value(*self.SESSION), 1145.0)
 
 
+class TestProvComparison(TestCase):
+
+    CHECK = SingleProc.DEFAULT_PROV_CHECK
+    IGNORE = SingleProc.DEFAULT_PROV_IGNORE
+
+    def record(self, value=1, pkg_version='1.0', inputs=None):
+        return Record('a_pipeline', 'per_session', 'subj', 'visit', 'study', {
+            'workflow': {'nodes': {'a_node': {'parameters': {'x': value},
+                                              'pkg_version': pkg_version}}},
+            'inputs': inputs if inputs is not None else {'a': 'abc'},
+            'outputs': {'b': 'def'},
+            'joined_ids': {}})
+
+    def test_static_hash(self):
+        record = self.record()
+        static_hash = record.static_hash(self.CHECK, self.IGNORE)
+        # The static hash shouldn't depend on node-specific sections or on
+        # ignored paths
+        self.assertEqual(
+            self.record(pkg_version='2.0',
+                        inputs={'a': 'xyz'}).static_hash(self.CHECK,
+                                                         self.IGNORE),
+            static_hash)
+        self.assertNotEqual(
+            self.record(value=2).static_hash(self.CHECK, self.IGNORE),
+            static_hash)
+        self.assertTrue(record.matches(self.record(pkg_version='2.0'),
+                                       self.CHECK, self.IGNORE,
+                                       other_static_hash=static_hash))
+        self.assertEqual(
+            record.mismatches(self.record(pkg_version='2.0'), self.CHECK,
+                              self.IGNORE), {})
+        # Node-specific changes are still reported by the full diff
+        self.assertFalse(record.matches(self.record(inputs={'a': 'xyz'}),
+                                        self.CHECK, self.IGNORE))
+        self.assertIn(
+            "root['inputs']['a']",
+            record.mismatches(self.record(inputs={'a': 'xyz'}), self.CHECK,
+                              self.IGNORE)['values_changed'])
+        self.assertTrue(record.mismatches(self.record(value=2), self.CHECK,
+                                          self.IGNORE))
+
+    def test_parallel_mismatches(self):
+        records = [self.record(value=i % 3) for i in range(20)]
+        expected = self.record(value=0)
+        serial = SingleProc('work', num_check_threads=1)._map_checks(
+            lambda r: r.mismatches(expected, self.CHECK, self.IGNORE),
+            records)
+        # The results of parallel checks should be returned in order
+        self.assertEqual(
+            SingleProc('work', num_check_threads=4)._map_checks(
+                lambda r: r.mismatches(expected, self.CHECK, self.IGNORE),
+                records),
+            serial)
+        self.assertEqual([bool(m) for m in serial],
+                         [bool(i % 3) for i in range(20)])
+
+
 class TestDialationStudy(Study, metaclass=StudyMetaClass):
 
     add_data_specs = [
@@ -738,6 +936,42 @@ class TestProvDialation(BaseMultiSubjectTestCase):
         self.assertEqual(field5.value(subject_id='1', visit_id='1'),
                          2000012 + 3000000 + 3000014)
 
+    def test_compact_joins(self):
+        study_name = 'compact_joins'
+        # The records of the second run should match those compacted in the
+        # first so the pipeline shouldn't be rerun
+        for sidecar in (True, False):
+            study = self.create_study(
+                TestDialationStudy,
+                study_name,
+                inputs=self.STUDY_INPUTS,
+                processor=SingleProc(self.work_dir, reprocess=True,
+                                     compact_joins=True,
+                                     joined_sidecar=sidecar))
+            self.assertEqual(study.data('derived_field4').value(), 26)
+            record = study.tree.record('pipeline4', study_name)
+            self.assertTrue(
+                record.inputs['derived_field1'].startswith('joined-'))
+            self.assertTrue(all(is_joined(digest_algorithm(i))
+                                for i in record.joined_ids.values()))
+            # The expected provenance should be compacted in the same way
+            pipeline = study.pipeline4()
+            pipeline.cap()
+            self.assertEqual(
+                pipeline.expected_record(study.tree, record).inputs,
+                record.inputs)
+            if sidecar:
+                with open(study.repository.joined_prov_path(record)) as f:
+                    joined = json.load(f)
+                self.assertEqual(len(joined['inputs']['derived_field1']),
+                                 self.NUM_SUBJECTS)
+                # Records without joined inputs don't need sidecars
+                self.assertFalse(op.exists(study.repository.joined_prov_path(
+                    next(study.tree.sessions).record('pipeline1',
+                                                     study_name))))
+        self.assertRaises(ArcanaUsageError, SingleProc, self.work_dir,
+                          joined_sidecar=True)
+
 
 class TestSkipMissing(BaseMultiSubjectTestCase):
     """
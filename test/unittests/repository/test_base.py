@@ -92,7 +92,11 @@ class TestSinkAndSource(BaseTestCase):
                 workflow.connect(
                     source, source_name + PATH_SUFFIX,
                     sink, sink_name + PATH_SUFFIX)
-        workflow.run()
+        execgraph = workflow.run()
+        # Check that the sunk node can be determined from the results so the
+        # cached trees can be updated in place
+        self.assertEqual(study.processor._sunk_nodes(execgraph),
+                         [('per_session', self.SUBJECT, self.VISIT)])
         # Check local directory was created properly
         outputs = [
             f for f in sorted(os.listdir(
@@ -1,11 +1,24 @@
 import os
+import time
+from concurrent.futures import ThreadPoolExecutor
+import json
+import hashlib
+import pickle as pkl
 import os.path as op
-from arcana.data.file_format import text_format
+from arcana.data.file_format import text_format, directory_format
 from arcana.study import Study, StudyMetaClass
 from arcana.data import (
     Fileset, InputFilesetSpec, FilesetSpec, Field)
 from arcana.utils.testing import BaseMultiSubjectTestCase
-from arcana.repository import Tree
+from arcana.repository import Tree, Session, BasicRepo, XnatRepo
+from arcana.repository.base import Repository
+from arcana.pipeline import Record
+from arcana.pipeline.provenance import STATIC_PROV_DIR
+from arcana.exceptions import ArcanaUsageError
+from arcana.repository.index import RepositoryIndex
+from arcana.utils.hashing import (
+    digest_algorithm, merkle_tree, FINGERPRINT_BLOCK_SIZE,
+    FINGERPRINT_NUM_BLOCKS)
 from future.utils import with_metaclass
 from arcana.utils.testing import BaseTestCase
 from arcana.data.file_format import FileFormat
@@ -52,6 +65,363 @@ class TestBasicRepo(BaseTestCase):
     def test_get_fileset(self):
         pass
 
+    def test_batched_fields(self):
+        repo = self.local_repository
+        fields = [Field(n, dtype=int, subject_id=self.SUBJECT,
+                        visit_id=self.VISIT, repository=repo,
+                        from_study=self.STUDY_NAME)
+                  for n in ('a', 'b', 'c')]
+        fpath = repo.fields_json_path(fields[0])
+        with repo:
+            for i, field in enumerate(fields):
+                field.value = i
+            # Field writes are deferred until the connection is closed but
+            # should still be visible to the repository
+            self.assertFalse(op.exists(fpath))
+            self.assertEqual(repo.get_field(fields[1]), 1)
+        self.assertEqual([repo.get_field(f) for f in fields], [0, 1, 2])
+        fields[0]._value = 10
+        fields[2]._value = 12
+        repo.put_fields([fields[0], fields[2]])
+        self.assertEqual([repo.get_field(f) for f in fields], [10, 1, 12])
+
+    def test_sink_strategies(self):
+        src_dir = op.join(self.work_dir, 'sink_strategies')
+        os.makedirs(src_dir)
+        for strategy in BasicRepo.SINK_STRATEGIES:
+            repo = BasicRepo(self.project_dir, depth=2,
+                             sink_strategy=strategy)
+            src_path = op.join(src_dir, strategy + '.txt')
+            with open(src_path, 'w') as f:
+                f.write(strategy)
+            fileset = Fileset(strategy, text_format, subject_id=self.SUBJECT,
+                              visit_id=self.VISIT, repository=repo,
+                              from_study=self.STUDY_NAME)
+            fileset.path = src_path
+            target_path = repo.fileset_path(fileset)
+            with open(target_path) as f:
+                self.assertEqual(f.read(), strategy)
+            self.assertNotIn(
+                '.' + op.basename(target_path) + BasicRepo.TMP_SUFFIX,
+                os.listdir(op.dirname(target_path)))
+            if strategy == 'move':
+                self.assertFalse(op.exists(src_path))
+                self.assertEqual(fileset.path, target_path)
+            else:
+                self.assertTrue(op.exists(src_path))
+            if strategy == 'hardlink':
+                self.assertTrue(op.samefile(src_path, target_path))
+            self.assertEqual(fileset.checksums,
+                             {'.': hashlib.md5(strategy.encode()).hexdigest()})
+
+    def test_checksum_cache(self):
+        repo = BasicRepo(self.project_dir, depth=2, cache_checksums=True)
+        fileset = repo.tree().session(self.SUBJECT, self.VISIT).fileset(
+            'source1')
+        fileset.format = text_format
+        ref_checksums = fileset.calculate_checksums()
+        self.assertEqual(repo.get_checksums(fileset), ref_checksums)
+        relpath = op.relpath(fileset.path, self.project_dir)
+        # Mark the cached digest as trusted and alter it to check that it is
+        # reused while the file is unchanged
+        size, mtime_ns, inode, _, _ = repo._checksum_cache.digests(
+            [relpath], 'md5')[relpath]
+        indexed_ns = mtime_ns + 2 * RepositoryIndex.RACY_INTERVAL
+        repo._checksum_cache.update_digests(
+            [(relpath, size, mtime_ns, inode, indexed_ns, 'cached')], 'md5')
+        self.assertEqual(repo.get_checksums(fileset), {'.': 'cached'})
+        # Digests calculated with other algorithms shouldn't replace it
+        repo._checksum_cache.update_digests(
+            [(relpath, size, mtime_ns, inode, indexed_ns, 'other')], 'sha1')
+        self.assertEqual(repo.get_checksums(fileset), {'.': 'cached'})
+        with open(fileset.path, 'a') as f:
+            f.write('modified')
+        self.assertNotEqual(repo.get_checksums(fileset), {'.': 'cached'})
+        self.assertEqual(repo.get_checksums(fileset),
+                         fileset.calculate_checksums())
+
+    def test_fingerprint_checksums(self):
+        repo = BasicRepo(self.project_dir, depth=2,
+                         checksum_algorithm='fingerprint')
+        src_path = op.join(self.work_dir, 'fingerprint.txt')
+        block_size = FINGERPRINT_BLOCK_SIZE
+        with open(src_path, 'wb') as f:
+            f.write(b'a' * block_size * FINGERPRINT_NUM_BLOCKS * 2)
+        fileset = Fileset('fingerprint', text_format, subject_id=self.SUBJECT,
+                          visit_id=self.VISIT, repository=repo,
+                          from_study=self.STUDY_NAME)
+        fileset.path = src_path
+        checksums = fileset.checksums
+        self.assertEqual(digest_algorithm(checksums), 'fingerprint')
+        self.assertEqual(checksums, fileset.calculate_checksums())
+        # Checksums with a different algorithm can still be calculated to
+        # compare with those recorded previously
+        self.assertEqual(digest_algorithm(fileset.checksums_for('md5')),
+                         'md5')
+        # Unrecognised tags should be treated as untagged (md5) digests so
+        # they are reported as mismatches instead of failing to calculate
+        recorded = {'.': 'garbage:0123'}
+        self.assertEqual(digest_algorithm(recorded), 'md5')
+        self.assertNotEqual(
+            fileset.checksums_for(digest_algorithm(recorded)), recorded)
+        # Alter the first block (which is always sampled)
+        with open(fileset.path, 'r+b') as f:
+            f.write(b'b')
+        self.assertNotEqual(fileset.calculate_checksums(), checksums)
+
+    def test_output_records(self):
+        fields = [Field(n, value=1, subject_id=self.SUBJECT,
+                        visit_id=self.VISIT, from_study=self.STUDY_NAME)
+                  for n in ('a', 'b', 'c')]
+        records = [
+            Record('pipeline1', 'per_session', self.SUBJECT, self.VISIT,
+                   self.STUDY_NAME, {'outputs': {'a': 1, 'b': 1}}),
+            Record('pipeline2', 'per_session', self.SUBJECT, self.VISIT,
+                   self.STUDY_NAME, {'outputs': {'b': 1}})]
+        session = Session(self.SUBJECT, self.VISIT, fields=fields,
+                          records=records)
+        self.assertEqual(session.output_records('a', self.STUDY_NAME),
+                         records[:1])
+        self.assertEqual(session.output_records('b', self.STUDY_NAME),
+                         records)
+        self.assertEqual(session.output_records('a', 'another_study'), [])
+        self.assertIs(session.field('a', self.STUDY_NAME).record, records[0])
+        self.assertEqual(session._duplicate_records, ['b'])
+        self.assertEqual(session._missing_records, ['c'])
+
+    def test_update_cache(self):
+        repo = self.local_repository
+        tree = repo.cached_tree()
+        field = Field('a_field', value=1, subject_id=self.SUBJECT,
+                      visit_id=self.VISIT, repository=repo,
+                      from_study=self.STUDY_NAME)
+        field.put()
+        repo.put_record(Record('a_pipeline', 'per_session', self.SUBJECT,
+                               self.VISIT, self.STUDY_NAME,
+                               {'outputs': {'a_field': 1}}))
+        repo.update_cache([('per_session', self.SUBJECT, self.VISIT)])
+        # The cached tree should be updated in place
+        self.assertIs(repo.cached_tree(), tree)
+        self.assertEqual(
+            tree.session(self.SUBJECT, self.VISIT).field(
+                'a_field', from_study=self.STUDY_NAME).value, 1)
+        # Trees that don't contain the node should be dropped from the cache
+        repo.update_cache([('per_session', 'another_subject', self.VISIT)])
+        self.assertIsNot(repo.cached_tree(), tree)
+
+    def test_find_nodes_data(self):
+        repo = self.local_repository
+        nodes = [('per_session', self.SUBJECT, self.VISIT),
+                 ('per_study', None, None)]
+        # The generic implementation should search the repository once for
+        # all nodes and match the node-by-node search of BasicRepo
+        find_data = repo.find_data
+        calls = []
+
+        def counted_find_data(*args, **kwargs):
+            calls.append(kwargs)
+            return find_data(*args, **kwargs)
+
+        repo.find_data = counted_find_data
+        generic = Repository.find_nodes_data(repo, nodes)
+        self.assertEqual(len(calls), 1)
+        for node, data in repo.find_nodes_data(nodes).items():
+            self.assertEqual(
+                [sorted(str(i) for i in items) for items in generic[node]],
+                [sorted(str(i) for i in items) for items in data])
+        self.assertTrue(generic[nodes[0]][0])
+
+    def test_tree_snapshot(self):
+        repo = self.local_repository
+        tree = repo.cached_tree()
+        snapshot_path = op.join(self.work_dir, 'tree_snapshot.pkl')
+        repo.save_snapshot(snapshot_path)
+        pkld = pkl.dumps(repo)
+        self.assertLess(len(pkld), len(pkl.dumps(tree)))
+        worker_repo = pkl.loads(pkld)
+        # The tree should be loaded from the snapshot instead of searching
+        # the repository again
+        worker_repo.find_data = None
+        worker_tree = worker_repo.cached_tree()
+        self.assertEqual(worker_tree, tree)
+        self.assertIs(worker_tree.repository, worker_repo)
+        self.assertIs(next(worker_tree.sessions).fileset(
+            'source1').repository, worker_repo)
+        # Modifying the cache should drop the reference to the snapshot
+        repo.clear_cache()
+        self.assertIsNone(repo.snapshot_path)
+
+    def test_dedup_prov(self):
+        repo = BasicRepo(self.local_repository.root_dir, dedup_prov=True)
+        static = {'workflow': {'nodes': ['a_node']}, 'study': {'a': 1}}
+        records = [
+            Record('a_pipeline', 'per_session', self.SUBJECT, self.VISIT,
+                   self.STUDY_NAME, dict(static, outputs={'a_field': 1})),
+            Record('a_pipeline', 'per_subject', self.SUBJECT, None,
+                   self.STUDY_NAME, dict(static, outputs={'b_field': 2}))]
+        for record in records:
+            repo.put_record(record)
+        # The static provenance should only be stored once
+        static_dir = op.join(repo.root_dir, BasicRepo.STATIC_PROV_DIR)
+        self.assertEqual(len(os.listdir(static_dir)), 1)
+        with open(repo.prov_json_path(records[0])) as f:
+            self.assertNotIn('workflow', json.load(f))
+        # But the full provenance should be accessible from the loaded records
+        tree = repo.tree()
+        self.assertEqual(
+            tree.session(self.SUBJECT, self.VISIT).record(
+                'a_pipeline', self.STUDY_NAME), records[0])
+        self.assertEqual(
+            tree.subject(self.SUBJECT).record('a_pipeline', self.STUDY_NAME),
+            records[1])
+        self.assertEqual(
+            Record.load('a_pipeline', 'per_session', self.SUBJECT, self.VISIT,
+                        self.STUDY_NAME, repo.prov_json_path(records[0])),
+            records[0])
+
+    def test_provenance_index(self):
+        repo = BasicRepo(self.local_repository.root_dir, index=True)
+        prov = {'workflow': {'nodes': ['a_node']}, 'inputs': {'a': 'abc'},
+                'outputs': {'b': 1}, 'joined_ids': {}}
+        record = Record('a_pipeline', 'per_session', self.SUBJECT,
+                        self.VISIT, self.STUDY_NAME, prov)
+        repo.put_record(record)
+        static_ref = record.static_prov()[0]
+        node = ('per_session', self.SUBJECT, self.VISIT)
+        self.assertEqual(
+            repo.stale_nodes(self.STUDY_NAME, 'a_pipeline', static_ref,
+                             [node + (prov,)]),
+            set())
+        self.assertEqual(
+            repo.stale_nodes(self.STUDY_NAME, 'a_pipeline', static_ref,
+                             [node + (dict(prov, inputs={'a': 'xyz'}),),
+                              ('per_subject', self.SUBJECT, None, prov)]),
+            set([node, ('per_subject', self.SUBJECT, None)]))
+        self.assertEqual(
+            repo.stale_nodes(self.STUDY_NAME, 'a_pipeline', 'another_ref',
+                             [node + (prov,)]),
+            set([node]))
+        # Records missing from the provenance table should be added when
+        # the repository is scanned
+        repo.index.update_provenance([], remove=repo.index.provenance_paths())
+        repo.tree()
+        self.assertEqual(
+            repo.stale_nodes(self.STUDY_NAME, 'a_pipeline', static_ref,
+                             [node + (prov,)]),
+            set())
+        # Node searches should only query the entries under the node
+        session_dir = op.join(self.SUBJECT, self.VISIT)
+        self.assertEqual(repo.index.provenance_paths(prefix=session_dir),
+                         repo.index.provenance_paths())
+        self.assertFalse(repo.index.provenance_paths(
+            prefix=self.SUBJECT + 'x'))
+        documents = repo.index.documents(prefix=session_dir)
+        self.assertTrue(documents)
+        self.assertTrue(all(p.startswith(session_dir + os.sep)
+                            for p in documents))
+        self.assertFalse(repo.index.documents(prefix=self.SUBJECT + 'x'))
+        repo.index.update_provenance([], remove=repo.index.provenance_paths())
+        repo.find_node_data(*node)
+        self.assertEqual(
+            repo.stale_nodes(self.STUDY_NAME, 'a_pipeline', static_ref,
+                             [node + (prov,)]),
+            set())
+        # Repositories without indices can't answer the query
+        self.assertIsNone(self.local_repository.stale_nodes(
+            self.STUDY_NAME, 'a_pipeline', static_ref, [node + (prov,)]))
+
+    def test_lazy_record(self):
+        prov = {'workflow': {'nodes': ['a_node']}, 'inputs': {'a': 'abc'},
+                'outputs': {'b': 1}, 'joined_ids': {}}
+        record = Record('a_pipeline', 'per_session', self.SUBJECT,
+                        self.VISIT, self.STUDY_NAME, prov)
+        self.local_repository.put_record(record)
+        loaded = self.local_repository.tree().session(
+            self.SUBJECT, self.VISIT).record('a_pipeline', self.STUDY_NAME)
+        # The sections saved at the start of the record should be accessible
+        # without decoding the workflow
+        self.assertEqual(loaded.outputs, prov['outputs'])
+        self.assertEqual(loaded.inputs, prov['inputs'])
+        self.assertEqual(loaded.datetime, record.datetime)
+        self.assertFalse(loaded.loaded)
+        self.assertEqual(loaded, record)
+        self.assertTrue(loaded.loaded)
+
+    def test_pickle_loaded_record(self):
+        prov = {'workflow': {'nodes': ['a_node']}, 'inputs': {'a': 'abc'},
+                'outputs': {'b': 1}, 'joined_ids': {}}
+        record = Record('a_pipeline', 'per_session', self.SUBJECT,
+                        self.VISIT, self.STUDY_NAME, prov)
+        record_dir = op.join(self.work_dir, 'pickle_record')
+        static_dir = op.join(record_dir, STATIC_PROV_DIR)
+        os.makedirs(static_dir)
+        static_ref, static = record.static_prov()
+        with open(op.join(static_dir, static_ref + '.json'), 'w') as f:
+            json.dump(static, f)
+        path = op.join(record_dir, 'a_pipeline.json')
+        record.save(path, static_ref=static_ref)
+        loaded = Record.load('a_pipeline', 'per_session', self.SUBJECT,
+                             self.VISIT, self.STUDY_NAME, path)
+        # Records should be picklable both before and after they are decoded
+        unpickled = pkl.loads(pkl.dumps(loaded))
+        self.assertFalse(unpickled.loaded)
+        self.assertEqual(unpickled, record)
+        self.assertEqual(pkl.loads(pkl.dumps(unpickled)), record)
+
+    def test_sink_directory(self):
+        src_path = op.join(self.work_dir, 'sink_directory')
+        contents = {op.join('sub', str(i)): str(i) for i in range(10)}
+        contents['top'] = 'top'
+        os.makedirs(op.join(src_path, 'sub'))
+        for fname, content in contents.items():
+            with open(op.join(src_path, fname), 'w') as f:
+                f.write(content)
+        repo = self.local_repository
+        fileset = Fileset('a_dir', directory_format, subject_id=self.SUBJECT,
+                          visit_id=self.VISIT, repository=repo,
+                          from_study=self.STUDY_NAME)
+        fileset.path = src_path
+        ref_checksums = {n: hashlib.md5(c.encode()).hexdigest()
+                         for n, c in contents.items()}
+        self.assertEqual(fileset.checksums, ref_checksums)
+        target_fileset = Fileset.from_path(repo.fileset_path(fileset),
+                                           format=directory_format)
+        self.assertEqual(target_fileset.calculate_checksums(), ref_checksums)
+
+    def test_merkle_checksums(self):
+        src_path = op.join(self.work_dir, 'merkle_directory')
+        os.makedirs(op.join(src_path, 'sub'))
+        for fname in ('top', op.join('sub', 'a'), op.join('sub', 'b')):
+            with open(op.join(src_path, fname), 'w') as f:
+                f.write(fname)
+        repo = BasicRepo(self.project_dir, depth=2, cache_checksums=True,
+                         checksum_algorithm='merkle-md5')
+        fileset = Fileset('merkle_dir', directory_format,
+                          subject_id=self.SUBJECT, visit_id=self.VISIT,
+                          repository=repo, from_study=self.STUDY_NAME)
+        fileset.path = src_path
+        checksums = fileset.checksums
+        self.assertEqual(list(checksums), ['.'])
+        self.assertEqual(digest_algorithm(checksums), 'merkle-md5')
+        self.assertEqual(checksums, fileset.calculate_checksums())
+        self.assertEqual(checksums, repo.get_checksums(fileset))
+        digests = fileset.calculate_checksums(algorithm='md5')
+        tree = merkle_tree(digests)
+        self.assertEqual(sorted(tree), ['.', 'sub'])
+        self.assertEqual(checksums['.'], 'merkle-md5:' + tree['.'])
+        # Only the altered branch of the tree should change
+        target_fileset = Fileset.from_path(repo.fileset_path(fileset),
+                                           format=directory_format,
+                                           repository=repo)
+        self.assertEqual(repo.get_checksums(target_fileset), checksums)
+        with open(op.join(target_fileset.path, 'sub', 'b'), 'a') as f:
+            f.write('modified')
+        new_tree = merkle_tree(
+            target_fileset.calculate_checksums(algorithm='md5'))
+        self.assertNotEqual(new_tree['.'], tree['.'])
+        self.assertNotEqual(new_tree['sub'], tree['sub'])
+        self.assertNotEqual(repo.get_checksums(target_fileset), checksums)
+
 
 class TestDirectoryProjectInfo(BaseMultiSubjectTestCase):
     """
@@ -224,3 +594,76 @@ class TestDirectoryProjectInfo(BaseMultiSubjectTestCase):
             tree, self.local_tree,
             "Generated project doesn't match reference:{}"
             .format(tree.find_mismatch(self.local_tree)))
+
+    def test_parallel_scan(self):
+        # Check that the scandir-based walk produces the same listings as
+        # os.walk and that the number of threads doesn't affect the tree
+        walked = sorted((p, sorted(d), sorted(f))
+                        for p, d, f in self.local_repository._walk())
+        ref = sorted((p, sorted(d), sorted(f))
+                     for p, d, f in os.walk(self.project_dir))
+        self.assertEqual(walked, ref)
+        serial_repo = BasicRepo(self.project_dir, depth=2,
+                                num_scan_threads=1)
+        self.assertEqual(serial_repo.tree(), self.local_repository.tree())
+
+    def test_index(self):
+        repo = BasicRepo(self.project_dir, index=True)
+        self.assertEqual(repo.depth, 2)
+        self.assertEqual(repo.index.get_meta('depth'), '2')
+        ref_tree = self.local_repository.tree()
+        # Check the tree matches when generated from scratch and when
+        # reusing the listings and documents stored in the index
+        self.assertEqual(repo.tree(), ref_tree)
+        self.assertTrue(repo.index.listings())
+        self.assertTrue(repo.index.documents())
+        indexed_ns = RepositoryIndex.now() + 2 * RepositoryIndex.RACY_INTERVAL
+        repo.index.update_listings(
+            [(p, m, indexed_ns, l)
+             for p, (m, _, l) in repo.index.listings().items()])
+        self.assertEqual(repo.tree(), ref_tree)
+        self.assertEqual(BasicRepo(self.project_dir, index=True).depth, 2)
+
+    def test_lazy_tree(self):
+        repo = BasicRepo(self.project_dir, depth=2, lazy_tree=True)
+        ref_tree = self.local_repository.tree()
+        tree = repo.tree()
+        self.assertTrue(all(n.lazy for n in tree.nodes()))
+        # Only the accessed node should be loaded
+        session = next(tree.sessions)
+        ref_session = ref_tree.session(session.subject_id, session.visit_id)
+        self.assertEqual(list(session.filesets), list(ref_session.filesets))
+        self.assertFalse(session.lazy)
+        self.assertEqual(sum(not n.lazy for n in tree.nodes()), 1)
+        self.assertEqual(tree, ref_tree,
+                         "Lazy tree doesn't match reference:{}"
+                         .format(tree.find_mismatch(ref_tree)))
+        # Repositories that can't search single nodes efficiently would
+        # need to search the whole repository for each node
+        self.assertRaises(ArcanaUsageError, XnatRepo, 'http://localhost',
+                          'PROJECT', op.join(self.work_dir, 'xnat-cache'),
+                          lazy_tree=True)
+
+    def test_lazy_tree_threads(self):
+        repo = BasicRepo(self.project_dir, depth=2, lazy_tree=True)
+        ref_session = next(self.local_repository.tree().sessions)
+        tree = repo.tree()
+        session = tree.session(ref_session.subject_id, ref_session.visit_id)
+        # Slow down the loading of the node so that the threads overlap
+        find_node_data = repo.find_node_data
+        num_loads = []
+
+        def slow_find_node_data(*args, **kwargs):
+            num_loads.append(None)
+            time.sleep(0.2)
+            return find_node_data(*args, **kwargs)
+
+        repo.find_node_data = slow_find_node_data
+        with ThreadPoolExecutor(4) as executor:
+            filesets = list(executor.map(lambda _: list(session.filesets),
+                                         range(4)))
+        # The node should only be loaded once and by then be accessible from
+        # all threads
+        self.assertEqual(len(num_loads), 1)
+        for loaded in filesets:
+            self.assertEqual(loaded, list(ref_session.filesets))
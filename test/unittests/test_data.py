@@ -1,3 +1,4 @@
+import sys
 import tempfile
 import shutil
 import os
@@ -9,9 +10,12 @@ from arcana.utils.testing import BaseTestCase, BaseMultiSubjectTestCase
 from arcana.study.base import Study, StudyMetaClass
 from arcana.study.parameter import SwitchSpec
 from arcana.data import (
-    InputFilesetSpec, FilesetSpec, FieldSpec, InputFilesets)
+    InputFilesetSpec, FilesetSpec, FieldSpec, InputFilesets, Fileset, Field)
 from arcana.data.file_format import text_format, FileFormat
+from arcana.data.collection import FieldCollection
+from arcana.pipeline.provenance import Record
 from arcana.exceptions import ArcanaDesignError, ArcanaError
+from arcana.repository import Session
 from future.utils import PY2
 from future.utils import with_metaclass
 import pydicom
@@ -101,6 +105,93 @@ class TestFilesetSpecPickle(TestCase):
             self.assertEqual(obj, re_obj)
 
 
+class TestCompactItems(TestCase):
+
+    def test_slots(self):
+        subject_id = ''.join(['sub', '01'])
+        items = [Fileset('a', text_format, subject_id=subject_id,
+                         visit_id='visit1'),
+                 Field('b', value=1, subject_id=subject_id,
+                       visit_id='visit1')]
+        for item in items:
+            self.assertFalse(hasattr(item, '__dict__'))
+            # Subject/visit IDs should be shared between items
+            self.assertIs(item.subject_id, sys.intern('sub01'))
+            self.assertEqual(pkl.loads(pkl.dumps(item)), item)
+        # Format methods should still be accessible via the fileset
+        self.assertRaises(AttributeError, getattr, items[0], 'not_a_method')
+
+    def test_name_index(self):
+        sessions = [
+            Session('subj', str(i), filesets=[
+                Fileset(n, text_format, subject_id='subj', visit_id=str(i))
+                for n in ('t1_mprage', 't2_spc', 'bold')])
+            for i in range(3)]
+        exact = InputFilesets('a_spec', 't2_spc', text_format)
+        regex = InputFilesets('a_spec', 't[12]_.*', text_format,
+                              is_regex=True)
+        for session in sessions:
+            self.assertEqual(
+                [f.name for f in exact._filtered_matches(session)],
+                ['t2_spc'])
+            self.assertEqual(
+                [f.name for f in regex._filtered_matches(session)],
+                ['t1_mprage', 't2_spc'])
+        # The regex should only be evaluated once per distinct name
+        self.assertEqual(regex._name_matches,
+                         {'bold': False, 't1_mprage': True, 't2_spc': True})
+
+    def test_name_index_order(self):
+        # Interleaved names (e.g. XNAT scans) should be matched in node order
+        session = Session('subj', 'visit', filesets=[
+            Fileset(n, text_format, id=i, subject_id='subj',
+                    visit_id='visit')
+            for i, n in enumerate(('t1', 't2', 't1'), start=1)])
+        regex = InputFilesets('a_spec', 't[12]', text_format, is_regex=True)
+        self.assertEqual(
+            [(f.name, f.id) for f in regex._filtered_matches(session)],
+            [('t1', 1), ('t2', 2), ('t1', 3)])
+        ordered = InputFilesets('a_spec', 't[12]', text_format,
+                                is_regex=True, order=1)
+        self.assertEqual(ordered.match_node(session).id, 2)
+
+    def test_presence_arrays(self):
+        subject_inds = {'subj1': 0, 'subj2': 1}
+        visit_inds = {'visit1': 0, 'visit2': 1, 'visit3': 2}
+        fields = []
+        for subj_id in subject_inds:
+            for visit_id in visit_inds:
+                # The value recorded in the provenance doesn't match for
+                # 'subj2'/'visit2', i.e. it has been altered
+                record = Record(
+                    'a_pipeline', 'per_session', subj_id, visit_id, 'study',
+                    {'outputs': {'a': int(
+                        (subj_id, visit_id) == ('subj2', 'visit2'))}})
+                fields.append(Field(
+                    'a', value=0, subject_id=subj_id, visit_id=visit_id,
+                    exists=(visit_id != 'visit3'), record=record))
+        collection = FieldCollection('a', fields)
+        exists, missing, altered = collection.presence_arrays(
+            subject_inds, visit_inds)
+        self.assertEqual(exists.tolist(), [[True, True, False],
+                                           [True, True, False]])
+        self.assertEqual(missing.tolist(), [[False, False, True],
+                                            [False, False, True]])
+        self.assertEqual(altered.tolist(), [[False, False, False],
+                                            [False, True, False]])
+        self.assertEqual(
+            collection.masked_items(collection.altered_mask, subject_inds,
+                                    visit_inds),
+            [((1, 1), fields[4])])
+        # Summary items are placed in the first row/column
+        summary = FieldCollection('b', [
+            Field('b', value=0, frequency='per_visit', visit_id=v,
+                  exists=False) for v in visit_inds])
+        self.assertEqual(
+            summary.presence_arrays(subject_inds, visit_inds)[1].tolist(),
+            [[True, True, True], [False, False, False]])
+
+
 class TestMatchStudy(with_metaclass(StudyMetaClass, Study)):
 
     add_data_specs = [